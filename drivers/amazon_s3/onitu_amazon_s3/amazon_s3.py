@@ -307,6 +307,23 @@ def move_file(old_metadata, new_metadata):
                            .format(httpe))
 
 
+@plug.handler()
+def copy_file(old_metadata, new_metadata):
+    old_filename = old_metadata.path
+    new_filename = new_metadata.path
+    bucket = plug.options['bucket']
+    plug.logger.debug(u"Copying file '{}' to '{}' on bucket '{}'"
+                      .format(old_filename, new_filename, bucket))
+    try:
+        S3Conn.copy(old_filename, bucket, new_filename, bucket)
+        timestamp = get_file_timestamp(new_filename)
+        new_metadata.extra['timestamp'] = timestamp
+        new_metadata.write()
+    except requests.HTTPError as httpe:
+        raise ServiceError(u"Network problem while copying file - {}"
+                           .format(httpe))
+
+
 @plug.handler()
 def delete_file(metadata):
     try:
@@ -383,6 +400,13 @@ class CheckChanges(threading.Thread):
                                   u" of file {}".format(metadata.path))
                 metadata.size = int(key['size'])
                 metadata.extra['timestamp'] = remote_ts
+                # The ETag of an object is the MD5 of its content, unless
+                # it was created by a multipart upload
+                etag = key.get('etag', '').strip('"')
+                if etag and '-' not in etag:
+                    metadata.checksum = etag
+                else:
+                    metadata.checksum = None
                 plug.update_file(metadata)
         plug.logger.debug(u"Next check in folder {} in {} seconds",
                           self.folder.path, self.timer)
@@ -326,6 +326,7 @@ class CheckChanges(threading.Thread):
             # write=False because metadata.write() will be performed
             # anyway in plug.update_file
             update_metadata_info(metadata, db_metadata, write=False)
+            metadata.checksum = None
             plug.update_file(metadata)
             plug.logger.debug(u"Updating metadata of '{}'"
                               .format(metadata.filename))
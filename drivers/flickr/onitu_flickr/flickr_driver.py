@@ -381,6 +381,7 @@ class CheckChanges(threading.Thread):
                 # data length there, if necessary.
                 metadata.size = 1
             metadata.extra['last_update'] = flickrLastUpdate
+            metadata.checksum = None
             plug.logger.debug(u"Updating {}".format(filename))
             plug.update_file(metadata)
         else:
@@ -296,6 +296,7 @@ class CheckChanges(threading.Thread):
                 metadata.size = int(
                     hubic.get_object_details(f)['content-length'])
                 metadata.extra['revision'] = hubic_rev
+                metadata.checksum = None
                 plug.update_file(metadata)
 
     def list_folder(self, path):
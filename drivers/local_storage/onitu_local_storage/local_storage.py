@@ -1,8 +1,9 @@
 import os
+import shutil
 
 from onitu.plug import Plug, DriverError, ServiceError
 from onitu.escalator.client import EscalatorClosed
-from onitu.utils import IS_WINDOWS, u, log_traceback
+from onitu.utils import IS_WINDOWS, u, log_traceback, get_checksum
 
 if IS_WINDOWS:
     import threading
@@ -27,6 +28,18 @@ def to_tmp(filename):
     )
 
 
+def rename(old_path, new_path):
+    """Move a file or a directory, creating the parent directories of
+    the destination if needed. Unlike `os.renames`, the parent
+    directories left empty are kept.
+    """
+    parent = os.path.dirname(new_path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    os.rename(old_path, new_path)
+
+
 def walkfiles(root):
     return (
         os.path.join(dirpath, f)
@@ -34,6 +47,13 @@ def walkfiles(root):
     )
 
 
+def file_checksum(path):
+    size = plug.options['chunk_size']
+
+    with open(path, 'rb') as f:
+        return get_checksum(iter(lambda: f.read(size), b''))
+
+
 def update(metadata, mtime=None):
     try:
         metadata.size = os.path.getsize(metadata.path)
@@ -41,6 +61,12 @@ def update(metadata, mtime=None):
         if not mtime:
             mtime = os.path.getmtime(metadata.path)
         metadata.extra['revision'] = mtime
+
+        # The checksum of the previous content must not be kept
+        if plug.options['compute_checksum']:
+            metadata.checksum = file_checksum(metadata.path)
+        else:
+            metadata.checksum = None
     except (IOError, OSError) as e:
         raise ServiceError(
             u"Error updating file '{}': {}".format(metadata.path, e)
@@ -70,6 +96,30 @@ def move(old_metadata, new_filename):
     new_metadata.write()
 
 
+def move_tree(folder, old_path, new_path):
+    if old_path in ignore_move:
+        ignore_move.discard(old_path)
+        return
+
+    moved = set()
+
+    for new_metadata in plug.move_directory(
+            folder, folder.relpath(old_path), folder.relpath(new_path)):
+        new_metadata.extra['revision'] = os.path.getmtime(new_metadata.path)
+        new_metadata.size = os.path.getsize(new_metadata.path)
+        new_metadata.write()
+        moved.add(new_metadata.path)
+
+    # The files which were not synchronized yet are new files
+    for path in walkfiles(new_path):
+        path = u(path)
+
+        if path in moved or os.path.splitext(path)[1] == TMP_EXT:
+            continue
+
+        update(plug.get_metadata(folder.relpath(path), folder))
+
+
 def check_changes(folder):
     expected_files = set()
 
@@ -145,6 +195,29 @@ def start_upload(metadata):
         )
 
 
+@plug.handler()
+def start_patch(metadata):
+    # The blocks which did not change are taken from the current version
+    # of the file, so we patch a copy of it and replace the file at the end
+    # of the transfer, like a regular upload
+    tmp_file = to_tmp(metadata.path)
+
+    try:
+        shutil.copyfile(metadata.path, tmp_file)
+
+        with open(tmp_file, 'r+b') as f:
+            f.truncate(metadata.size)
+
+        if IS_WINDOWS:
+            win32api.SetFileAttributes(
+                tmp_file, win32con.FILE_ATTRIBUTE_HIDDEN)
+    except (IOError, OSError) as e:
+        raise ServiceError(
+            u"Error copying file '{}': {}".format(metadata.path, e)
+        )
+
+
+@plug.handler('patch_chunk')
 @plug.handler()
 def upload_chunk(metadata, offset, chunk):
     tmp_file = to_tmp(metadata.path)
@@ -197,6 +270,25 @@ def abort_upload(metadata):
         )
 
 
+@plug.handler()
+def copy_file(old_metadata, new_metadata):
+    tmp_file = to_tmp(new_metadata.path)
+
+    try:
+        try:
+            os.makedirs(os.path.dirname(tmp_file))
+        except OSError:
+            pass
+
+        shutil.copyfile(old_metadata.path, tmp_file)
+    except (IOError, OSError) as e:
+        raise ServiceError(
+            u"Error copying file '{}': {}".format(old_metadata.path, e)
+        )
+
+    end_upload(new_metadata)
+
+
 @plug.handler()
 def delete_file(metadata):
     try:
@@ -213,7 +305,7 @@ def delete_file(metadata):
 def move_file(old_metadata, new_metadata):
     try:
         ignore_move.add(old_metadata.path)
-        os.renames(old_metadata.path, new_metadata.path)
+        rename(old_metadata.path, new_metadata.path)
     except (IOError, OSError) as e:
         ignore_move.discard(old_metadata.path)
         raise ServiceError(
@@ -221,6 +313,32 @@ def move_file(old_metadata, new_metadata):
         )
 
 
+@plug.handler()
+def move_directory(old_path, new_path):
+    try:
+        ignore_move.add(old_path)
+        rename(old_path, new_path)
+    except (IOError, OSError) as e:
+        ignore_move.discard(old_path)
+        raise ServiceError(
+            u"Error moving directory '{}': {}".format(old_path, e)
+        )
+
+
+@plug.handler()
+def delete_directory(path):
+    files = set(u(f) for f in walkfiles(path))
+
+    try:
+        ignore_delete.update(files)
+        shutil.rmtree(path)
+    except (IOError, OSError) as e:
+        ignore_delete.difference_update(files)
+        raise ServiceError(
+            u"Error deleting directory '{}': {}".format(path, e)
+        )
+
+
 if IS_WINDOWS:
     FILE_LIST_DIRECTORY = 0x0001
 
@@ -296,11 +414,14 @@ else:
 
         def process_IN_MOVED_TO(self, event):
             if event.dir:
-                for new in walkfiles(event.pathname):
-                    if hasattr(event, 'src_pathname'):
-                        old = new.replace(event.pathname, event.src_pathname)
-                        self.process_event(old, move, u(new))
-                    else:
+                if hasattr(event, 'src_pathname'):
+                    # The whole directory is moved with a single event
+                    self.run(
+                        move_tree, self.folder,
+                        u(event.src_pathname), u(event.pathname)
+                    )
+                else:
+                    for new in walkfiles(event.pathname):
                         self.process_event(new, update)
             else:
                 if hasattr(event, 'src_pathname'):
@@ -316,9 +437,15 @@ else:
             if os.path.splitext(filename)[1] == TMP_EXT:
                 return
 
+            self.run(self.call_with_metadata, filename, callback, *args)
+
+        def call_with_metadata(self, filename, callback, *args):
+            metadata = plug.get_metadata(filename, self.folder)
+            callback(metadata, *args)
+
+        def run(self, callback, *args):
             try:
-                metadata = plug.get_metadata(filename, self.folder)
-                callback(metadata, *args)
+                callback(*args)
             except EscalatorClosed:
                 pass
             except OSError as e:
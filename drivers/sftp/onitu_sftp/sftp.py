@@ -1,4 +1,5 @@
 import os
+import posixpath
 import threading
 
 import paramiko
@@ -8,9 +9,19 @@ from stat import S_ISDIR
 from onitu.plug import Plug, DriverError, ServiceError
 from onitu.escalator.client import EscalatorClosed
 
+TMP_EXT = '.onitu-tmp'
+
 plug = Plug()
 events_to_ignore = set()
 sftp = None
+# The remote temporary files being patched, by path of the patched file
+patches = {}
+
+
+def to_tmp(path):
+    return posixpath.join(
+        posixpath.dirname(path), '.' + posixpath.basename(path) + TMP_EXT
+    )
 
 
 def get_private_key(pkey_path, passphrase):
@@ -97,6 +108,9 @@ def create_file_subdirs(sftpClient, filepath):
 
 def update_metadata(metadata, mtime, update_file=False):
     metadata.extra['mtime'] = mtime
+    if update_file:
+        # The checksum of the previous content must not be kept
+        metadata.checksum = None
     metadata.write()
     if update_file:
         plug.update_file(metadata)
@@ -119,11 +133,23 @@ def get_file(metadata):
         # http://docs.paramiko.org/en/latest/api/sftp.html
         # #paramiko.sftp_file.SFTPFile.prefetch
         f.prefetch()
-        data = f.read()
-        return data
     except IOError as e:
         raise ServiceError("Error getting file '{}': {}"
                            .format(metadata.path, e))
+    # The file is read chunk by chunk, so it is never fully in memory
+    return read_file(f, metadata.path)
+
+
+def read_file(f, path):
+    try:
+        with f:
+            while True:
+                data = f.read(plug.options['chunk_size'])
+                if not data:
+                    break
+                yield data
+    except IOError as e:
+        raise ServiceError("Error getting file '{}': {}".format(path, e))
 
 
 @plug.handler()
@@ -139,22 +165,79 @@ def start_upload(metadata):
 
 
 @plug.handler()
-def upload_file(metadata, content):
+def upload_stream(metadata, chunks):
     plug.logger.debug(u"Uploading file {}", metadata.path)
     try:
-        f = sftp.open(metadata.path, 'w+')
-        f.write(content)
-        f.close()
+        with sftp.open(metadata.path, 'w+') as f:
+            for chunk in chunks:
+                f.write(chunk)
     except (IOError, OSError) as e:
         raise ServiceError("Error writing file '{}': {}"
                            .format(metadata.path, e))
     plug.logger.debug(u"Uploading file {} - Done", metadata.path)
 
 
+@plug.handler()
+def start_patch(metadata):
+    # The blocks which did not change are taken from the current version
+    # of the file, so we patch a remote copy of it and replace the file at
+    # the end of the transfer. The copy is kept open during the transfer.
+    plug.logger.debug(u"Starting patch of {}", metadata.path)
+    tmp_path = to_tmp(metadata.path)
+    try:
+        plug.logger.debug(u"Adding {} to ignored files", metadata.path)
+        events_to_ignore.add(metadata.path)
+        tmp = sftp.open(tmp_path, 'w+')
+        try:
+            f = sftp.open(metadata.path, 'r')
+            f.prefetch()
+            for chunk in read_file(f, metadata.path):
+                tmp.write(chunk)
+            tmp.truncate(metadata.size)
+        except Exception:
+            tmp.close()
+            raise
+        patches[metadata.path] = tmp
+    except (IOError, OSError) as e:
+        raise ServiceError(u"Failed to start patch of {}: {}"
+                           .format(metadata.path, e))
+
+
+@plug.handler()
+def patch_chunk(metadata, offset, chunk):
+    plug.logger.debug(u"Patching file {} at offset {}", metadata.path, offset)
+    try:
+        f = patches[metadata.path]
+        f.seek(offset)
+        f.write(chunk)
+    except KeyError:
+        raise ServiceError(u"No patch started for file '{}'"
+                           .format(metadata.path))
+    except (IOError, OSError) as e:
+        raise ServiceError(u"Error patching file '{}': {}"
+                           .format(metadata.path, e))
+
+
+def end_patch(metadata):
+    """Replace the file by its patched copy, if it has been patched."""
+    f = patches.pop(metadata.path, None)
+    if f is None:
+        return
+
+    f.close()
+    try:
+        sftp.posix_rename(to_tmp(metadata.path), metadata.path)
+    except IOError:
+        # The server does not support the atomic rename extension
+        sftp.remove(metadata.path)
+        sftp.rename(to_tmp(metadata.path), metadata.path)
+
+
 @plug.handler()
 def end_upload(metadata):
     plug.logger.debug(u"Ending upload of file {}", metadata.path)
     try:
+        end_patch(metadata)
         stat_res = sftp.stat(metadata.path)
         update_metadata(metadata, stat_res.st_mtime,
                         update_file=False)
@@ -170,7 +253,20 @@ def end_upload(metadata):
 @plug.handler()
 def abort_upload(metadata):
     plug.logger.debug(u"Aborting upload of file {}", metadata.path)
-    delete_file(metadata)
+    f = patches.pop(metadata.path, None)
+    if f is None:
+        delete_file(metadata)
+        return
+
+    # The current version of the file is kept, only its copy is removed
+    try:
+        f.close()
+        sftp.remove(to_tmp(metadata.path))
+    except (IOError, OSError) as e:
+        raise ServiceError(u"Error deleting file '{}': {}"
+                           .format(to_tmp(metadata.path), e))
+    finally:
+        events_to_ignore.discard(metadata.path)
 
 
 @plug.handler()
@@ -199,6 +295,37 @@ def move_file(old_metadata, new_metadata):
                            .format(old_metadata.path, new_metadata.path, ioe))
 
 
+@plug.handler()
+def move_directory(old_path, new_path):
+    plug.logger.debug(u"Moving directory {} to {}", old_path, new_path)
+    try:
+        create_file_subdirs(sftp, new_path)
+        sftp.rename(old_path, new_path)
+    except IOError as ioe:
+        raise ServiceError(u"Error while moving directory {} to {}: {}"
+                           .format(old_path, new_path, ioe))
+
+
+def remove_tree(path):
+    for attr in sftp.listdir_attr(path):
+        child = u"{}/{}".format(path, attr.filename)
+        if S_ISDIR(attr.st_mode):
+            remove_tree(child)
+        else:
+            sftp.remove(child)
+    sftp.rmdir(path)
+
+
+@plug.handler()
+def delete_directory(path):
+    plug.logger.debug(u"Deleting directory {}", path)
+    try:
+        remove_tree(path)
+    except (IOError, OSError) as e:
+        raise ServiceError(u"Error deleting directory '{}': {}"
+                           .format(path, e))
+
+
 class CheckChanges(threading.Thread):
 
     def __init__(self, folder, sftpClient, timer):
@@ -208,6 +335,7 @@ class CheckChanges(threading.Thread):
         self.sftp = sftpClient
         self.timer = timer
         self.deletedFiles = {}  # useful for deletion detection
+        self.directories = set()  # the directories found during a check
         dirPath = folder.path
         if not dirPath.endswith(u"/"):
             dirPath += u"/"
@@ -235,6 +363,7 @@ class CheckChanges(threading.Thread):
             dirPath = folder.filename
             if path != ".":
                 dirPath = "{}/{}".format(path, dirPath)
+            self.directories.add(dirPath)
             self.check_directory(dirPath)
 
     def check_regular_file(self, path, regFile):
@@ -242,6 +371,9 @@ class CheckChanges(threading.Thread):
         actual modification time. If the latter is more recent, triggers an
         update."""
         filePath = regFile.filename
+        if filePath.endswith(TMP_EXT):
+            # A file being patched by Onitu
+            return
         if path != ".":
             filePath = "{}/{}".format(path, filePath)
         plug.logger.debug(u"Checking regular file {}", filePath)
@@ -262,14 +394,33 @@ class CheckChanges(threading.Thread):
         if filePath in self.deletedFiles:
             del self.deletedFiles[filePath]
 
+    def removed_directory(self, filePath):
+        """Return the topmost directory of the file which hasn't been
+        found, or None if the file was directly removed."""
+        parts = filePath.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            dirPath = "/".join(parts[:i])
+            if dirPath not in self.directories:
+                return dirPath
+        return None
+
     def delete_removed_files(self):
         """After having checked remote files, files still sitting in the
         self.deletedFiles haven't been found, so we delete them on Onitu
-        side."""
+        side. The files of a removed directory are deleted with a single
+        event."""
+        removedDirs = set()
         for filePath in self.deletedFiles.keys():
-            if filePath not in events_to_ignore:
+            if filePath in events_to_ignore:
+                continue
+            dirPath = self.removed_directory(filePath)
+            if dirPath is None:
                 metadata = plug.get_metadata(filePath, self.folder)
                 plug.delete_file(metadata)
+            elif dirPath not in removedDirs:
+                removedDirs.add(dirPath)
+                plug.logger.debug(u"Directory {} removed", dirPath)
+                plug.delete_directory(self.folder, dirPath)
 
     def run(self):
         while not self.stopEvent.isSet():
@@ -280,6 +431,7 @@ class CheckChanges(threading.Thread):
                 # them. The remaining are files that were deleted when we
                 # weren't looking.
                 self.deletedFiles = plug.list(self.folder)
+                self.directories = set()
                 self.check_directory(".")
                 self.delete_removed_files()
             except EscalatorClosed:
@@ -117,10 +117,39 @@ def move_file(old_metadata, new_metadata):
     events_to_ignore.remove(new_metadata.path)
 
 
+@plug.handler()
+def move_directory(old_path, new_path):
+    webd = get_WEBDAV_client_from_plug()
+    plug.logger.debug(u"move directory: {} to {}", old_path, new_path)
+    try:
+        create_dirs(webd, dirname(new_path))
+        webd.move(
+            remote_path_from=b(old_path + u'/'),
+            remote_path_to=b(new_path + u'/')
+        )
+    except Exception as e:
+        raise ServiceError(
+            u"Error moving directory '{}': {}".format(old_path, e)
+        )
+
+
+@plug.handler()
+def delete_directory(path):
+    webd = get_WEBDAV_client_from_plug()
+    plug.logger.debug(u"delete directory: {}", path)
+    try:
+        webd.clean(b(path + u'/'))
+    except Exception as e:
+        raise ServiceError(
+            u"Error deleting directory '{}': {}".format(path, e)
+        )
+
+
 def update_file(metadata, infos):
     try:
         metadata.size = int(infos['size'])
         metadata.extra['revision'] = infos['modified']
+        metadata.checksum = None
         metadata.write()
         plug.update_file(metadata)
     except Exception as e:
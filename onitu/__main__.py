@@ -71,10 +71,23 @@ def start_setup(*args, **kwargs):
 
                 batch.put(u'folder:{}'.format(name), options)
 
+            batch.put('options', setup.get('options', {}))
+
         services = setup.get('services', {})
         escalator.put('services', list(services.keys()))
 
-        yield start_watcher("Referee", 'onitu.referee')
+        # The events are dispatched between several Referees by fid
+        partitions = setup.get('options', {}).get('referee_partitions', 1)
+        escalator.put('referee:partitions', partitions)
+
+        if partitions > 1:
+            for partition in range(partitions):
+                yield start_watcher(
+                    u"Referee {}".format(partition), 'onitu.referee',
+                    str(partition), str(partitions)
+                )
+        else:
+            yield start_watcher("Referee", 'onitu.referee')
         yield start_watcher("Brocker", 'onitu.brocker')
 
         for service, conf in services.items():
@@ -6,13 +6,15 @@ import pkg_resources
 
 from logbook import Logger
 from logbook.queues import ZeroMQHandler
-from bottle import Bottle, run, response, redirect, static_file
+from bottle import Bottle, run, request, response, redirect, static_file
 from circus.client import CircusClient
 
-from onitu.escalator.client import Escalator
+from onitu.escalator.client import Escalator, Log
 from onitu.utils import get_fid, u, b, PY2, get_circusctl_endpoint
-from onitu.utils import get_brocker_uri, get_logs_uri
-from onitu.brocker.commands import GET_FILE
+from onitu.utils import get_brocker_uri, get_logs_uri, get_referee_uri
+from onitu.referee import RELOAD
+from onitu.referee.folder import validate as validate_folder_options
+from onitu.brocker.commands import GET_CHUNK
 from onitu.brocker.responses import ERROR
 
 if PY2:
@@ -27,11 +29,15 @@ FACET_STATIC_ROOT = pkg_resources.resource_filename('onitu', 'facet/static/')
 host = 'localhost'
 port = 3862
 
+# The size of the chunks in which the content of the files is sent
+chunk_size = 1 << 20
+
 app = Bottle()
 
 session = u(sys.argv[1])
 circus_client = CircusClient(endpoint=get_circusctl_endpoint(session))
 escalator = Escalator(session)
+queues = Escalator.queues(session)
 logger = Logger("REST API")
 
 
@@ -107,6 +113,87 @@ def service_not_found(name):
     )
 
 
+def folder_not_found(name):
+    return error(
+        error_code=404,
+        error_message=u"folder {} not found".format(name)
+    )
+
+
+def invalid_folder_options(e):
+    return error(
+        error_code=400,
+        error_message=u"invalid folder options: {}".format(e)
+    )
+
+
+def read_folder_options():
+    """Read the options of a folder given in the body of the request.
+    Raise a `ValueError` if they cannot be compiled into rules.
+    """
+    options = request.json
+    validate_folder_options(options)
+    return options
+
+
+def bump_folders_version(batch=None):
+    """Increment the version of the options of the folders, so the
+    Referees compile their rules again when they are notified.
+    """
+    version = escalator.get('folders:version', default=0) + 1
+
+    if batch:
+        batch.put('folders:version', version)
+    else:
+        escalator.put('folders:version', version)
+
+    return version
+
+
+def notify_referees():
+    context = zmq.Context.instance()
+    partitions = escalator.get('referee:partitions', default=1)
+
+    for partition in range(partitions):
+        pusher = context.socket(zmq.PUSH)
+        # We don't want to hang if a Referee is not running
+        pusher.linger = 1000
+        pusher.connect(get_referee_uri(session, partition))
+        pusher.send(RELOAD)
+        pusher.close()
+
+
+def log_stats(name):
+    """Return the number of events of the service which were not
+    handled yet by the Referee, and by the service itself.
+    """
+    partitions = escalator.get('referee:partitions', default=1)
+    cursors = queues.get(u'service:{}:cursors'.format(name), default=[])
+    cursors = cursors + [0] * (partitions - len(cursors))
+
+    referee_lag = 0
+    queue_lag = 0
+
+    for partition in range(partitions):
+        referee_cursors = queues.get(
+            u'referee:{}:cursors'.format(partition), default={}
+        )
+        referee_lag += Log(
+            queues, u'referee:{}:log:{}:'.format(partition, name)
+        ).lag(referee_cursors.get(name, 0))
+        queue_lag += Log(
+            queues, u'service:{}:queue:{}:'.format(name, partition)
+        ).lag(cursors[partition])
+
+    return {
+        'sequence': queues.get(
+            u'service:{}:sequence'.format(name), default=0
+        ),
+        'referee_lag': referee_lag,
+        'queue_lag': queue_lag,
+    }
+
+
 def service_not_running(name, already=False):
     fmt = u"service {} is {}stopped".format
     # "already" in case a stop has been requested on an already stopped service
@@ -124,6 +211,33 @@ def timeout():
     )
 
 
+def read_rates(names):
+    """Read the rates given in the body of the request. Return `None` if
+    one of them is invalid.
+    """
+    body = request.json or {}
+    rates = {}
+
+    for name in names:
+        if name not in body:
+            continue
+
+        rate = body[name]
+        if not isinstance(rate, int) or isinstance(rate, bool) or rate < 0:
+            return None
+
+        rates[name] = rate
+
+    return rates
+
+
+def invalid_rates():
+    return error(
+        error_code=400,
+        error_message="the rates must be positive integers"
+    )
+
+
 def call_brocker(cmd, *args):
     context = zmq.Context.instance()
     dealer = context.socket(zmq.DEALER)
@@ -137,6 +251,23 @@ def call_brocker(cmd, *args):
         dealer.close()
 
 
+def get_chunk(fid, offset):
+    resp = call_brocker(GET_CHUNK, fid, str(offset), str(chunk_size))
+    if len(resp) < 2 or resp[0] == ERROR:
+        return None
+    return resp[1]
+
+
+def iter_content(fid, size, chunk):
+    offset = 0
+    while chunk:
+        yield chunk
+        offset += len(chunk)
+        if offset >= size:
+            break
+        chunk = get_chunk(fid, offset)
+
+
 @app.route('/')
 def app_root():
     redirect('facet/index.html')
@@ -196,14 +327,17 @@ def get_file_content(fid):
     metadata = escalator.get('file:{}'.format(fid), default=None)
     if not metadata:
         return file_not_found(fid)
-    content = call_brocker(GET_FILE, fid)
-    if content[0] != ERROR:
-        response.content_type = metadata['mimetype']
-        response.headers['Content-Disposition'] = (
-            'attachment; filename="{}"'.format(b(metadata['filename']))
-        )
-        return content[1]
-    return error()
+    # We get the first chunk before answering, so we can still return
+    # an error if the file cannot be read
+    chunk = get_chunk(fid, 0)
+    if chunk is None:
+        return error()
+    response.content_type = metadata['mimetype']
+    response.content_length = metadata['size']
+    response.headers['Content-Disposition'] = (
+        'attachment; filename="{}"'.format(b(metadata['filename']))
+    )
+    return iter_content(fid, metadata['size'], chunk)
 
 
 @app.route('/api/v1.0/services', method='GET')
@@ -252,6 +386,13 @@ def get_service_stats(name):
             "name": stats['name'],
             "status": stats['status'],
             "time": stats['time'],
+            "events": queues.get(
+                u'service:{}:events'.format(name), default={}
+            ),
+            "log": log_stats(name),
+            "usage": queues.get(
+                u'service:{}:usage'.format(name), default={}
+            ),
         }
     except Exception as e:
         resp = error(error_message=str(e))
@@ -362,6 +503,131 @@ def restart_service(name):
     return resp
 
 
+@app.route('/api/v1.0/services/<name>/rates', method='PUT')
+def set_service_rates(name):
+    name = unquote(name)
+    e = service(name)
+    if not e:
+        return service_not_found(name)
+
+    rates = read_rates(('max_upload_rate', 'max_download_rate'))
+    if rates is None:
+        return invalid_rates()
+
+    options = e['options']
+    options.update(rates)
+    # The service reloads its rates periodically
+    escalator.put(u'service:{}:options'.format(name), options)
+
+    return {
+        "name": name,
+        "max_upload_rate": options.get('max_upload_rate', 0),
+        "max_download_rate": options.get('max_download_rate', 0),
+    }
+
+
+@app.route('/api/v1.0/rates', method='GET')
+def get_rates():
+    options = escalator.get('options', default={})
+    return {"max_rate": options.get('max_rate', 0)}
+
+
+@app.route('/api/v1.0/rates', method='PUT')
+def set_rates():
+    rates = read_rates(('max_rate',))
+    if rates is None:
+        return invalid_rates()
+
+    options = escalator.get('options', default={})
+    options.update(rates)
+    # The Brocker reloads the global rate periodically
+    escalator.put('options', options)
+
+    return {"max_rate": options.get('max_rate', 0)}
+
+
+@app.route('/api/v1.0/folders/<name>/options', method='GET')
+def get_folder_options(name):
+    name = unquote(name)
+    options = escalator.get(u'folder:{}'.format(name), default=None)
+    if options is None:
+        return folder_not_found(name)
+    return options
+
+
+@app.route('/api/v1.0/folders/<name>/options', method='PUT')
+def set_folder_options(name):
+    name = unquote(name)
+    key = u'folder:{}'.format(name)
+    if not escalator.exists(key):
+        return folder_not_found(name)
+
+    try:
+        options = read_folder_options()
+    except ValueError as e:
+        return invalid_folder_options(e)
+
+    with escalator.write_batch() as batch:
+        batch.put(key, options)
+        bump_folders_version(batch)
+
+    notify_referees()
+    return options
+
+
+@app.route('/api/v1.0/services/<name>/folders/<folder>/options',
+           method='GET')
+def get_service_folder_options(name, folder):
+    name = unquote(name)
+    folder = unquote(folder)
+    if not service(name):
+        return service_not_found(name)
+
+    options = escalator.get(
+        u'service:{}:folder:{}:options'.format(name, folder), default=None
+    )
+    if options is None:
+        return folder_not_found(folder)
+    return options
+
+
+@app.route('/api/v1.0/services/<name>/folders/<folder>/options',
+           method='PUT')
+def set_service_folder_options(name, folder):
+    name = unquote(name)
+    folder = unquote(folder)
+    if not service(name):
+        return service_not_found(name)
+
+    key = u'service:{}:folder:{}:options'.format(name, folder)
+    if not escalator.exists(key):
+        return folder_not_found(folder)
+
+    try:
+        options = read_folder_options()
+    except ValueError as e:
+        return invalid_folder_options(e)
+
+    with escalator.write_batch() as batch:
+        batch.put(key, options)
+        bump_folders_version(batch)
+
+    notify_referees()
+    return options
+
+
+@app.route('/api/v1.0/rules/reload', method='PUT')
+def reload_rules():
+    version = bump_folders_version()
+    notify_referees()
+    return {"status": "ok", "version": version}
+
+
+@app.route('/api/v1.0/brocker/stats', method='GET')
+def get_brocker_stats():
+    return queues.get('brocker:stats', default={})
+
+
 @app.error(404)
 def error404(error_data):
     # we have to define the content type ourselves and to use the
@@ -1,19 +1,38 @@
+import time
 import functools
+import threading
+from collections import deque
 
 import zmq
 
 from concurrent.futures import ThreadPoolExecutor
 
+from tornado import ioloop
 from logbook import Logger
-from zmq.eventloop import ioloop, zmqstream
+from zmq.eventloop import zmqstream
 
 from onitu.escalator.client import Escalator, EscalatorClosed
 from onitu.utils import log_traceback, get_brocker_uri, get_events_uri
-from onitu.utils import cpu_count
+from onitu.utils import pool_size, TokenBucket, Budget
 
-from .responses import ERROR
+from .commands import GET_CHUNK, GET_SOURCES
+from .responses import SOURCES, ERROR
+from .stats import SourceStats
+from .cache import ChunkCache
 
-ioloop.install()
+# The interval between two reloads of the global options, in milliseconds
+REFRESH_INTERVAL = 5000
+
+# The number of seconds during which the velocity of the services and the
+# up-to-date services of each file are cached
+CACHE_TTL = 5
+
+# The default size of the cache of the chunks, in bytes
+CHUNK_CACHE_SIZE = 64 << 20
+
+# The number of seconds a source has to answer a request, after which
+# the next source is tried
+RESPONSE_TIMEOUT = 30
 
 
 class Brocker(object):
@@ -21,20 +40,50 @@ class Brocker(object):
         self.logger = Logger("Brocker")
         self.context = zmq.Context.instance()
         self.escalator = Escalator(session)
+        # The statistics are rewritten often, so they are kept out of
+        # the metadata
+        self.queues = Escalator.queues(session)
         self.session = session
         self.futures = {}
         self.stream = None
         self.loop = None
         self.pool = None
+        self.refresher = None
+        # The idle DEALER sockets connected to the Router of each source,
+        # reused across the requests
+        self.dealers = {}
+        self.dealers_lock = threading.Lock()
+        self.closed = False
+        # Limit the number of bytes per second transferred between all
+        # the services
+        self.bucket = TokenBucket()
+        # Limit the number of bytes of the chunks being forwarded, the
+        # requests exceeding it wait for the previous ones to be answered
+        self.buffers = Budget()
+        self.buffered = {}
+        self.waiting = deque()
+        # The statistics of the requests sent to each source
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        # The cached velocities of the sources, and up-to-date services
+        # and revision of the files, along with the time they were fetched
+        self.velocities = {}
+        self.uptodate = {}
+        # The chunks recently forwarded, so they can be sent to the
+        # other services without reading them again from the source
+        self.cache = ChunkCache(CHUNK_CACHE_SIZE)
 
     def start(self):
         router = None
 
         try:
-            self.loop = ioloop.IOLoop.instance()
-            # We create a thread pool with a *lot* of threads because
-            # they will block on IO bound stuff
-            self.pool = ThreadPoolExecutor(cpu_count() * 3)
+            self.loop = ioloop.IOLoop.current()
+            # The threads block on IO bound stuff, the `max_threads`
+            # option bounds their number on the machines with many CPUs
+            options = self.escalator.get('options', default={})
+            self.pool = ThreadPoolExecutor(
+                pool_size(options.get('max_threads'))
+            )
 
             router = self.context.socket(zmq.ROUTER)
             router.bind(get_brocker_uri(self.session))
@@ -42,6 +91,15 @@ class Brocker(object):
             self.stream = zmqstream.ZMQStream(router, self.loop)
             self.stream.on_recv(self.handle)
 
+            # The statistics used to be in the metadata
+            self.escalator.delete('brocker:stats')
+
+            self.refresh()
+            self.refresher = ioloop.PeriodicCallback(
+                self.refresh, REFRESH_INTERVAL
+            )
+            self.refresher.start()
+
             self.logger.info("Started")
             self.loop.start()
         except zmq.ZMQError as e:
@@ -54,22 +112,89 @@ class Brocker(object):
         except Exception:
             log_traceback(self.logger)
         finally:
+            if self.refresher:
+                self.refresher.stop()
+
             if self.stream:
                 self.stream.close()
 
+    def refresh(self):
+        """Reload the global rate and budget, which can be changed while
+        Onitu is running.
+        """
+        try:
+            options = self.escalator.get('options', default={})
+            self.bucket.rate = options.get('max_rate', 0)
+            self.buffers.limit = options.get('max_buffered', 0)
+            self.admit_waiting()
+
+            deadline = time.time() - CACHE_TTL
+            for fid, (timestamp, _, _) in list(self.uptodate.items()):
+                if timestamp < deadline:
+                    self.uptodate.pop(fid, None)
+
+            self.cache.configure(
+                options.get('cache_size', CHUNK_CACHE_SIZE),
+                options.get('cache_ttl', 60),
+                options.get('cache_disk_size', 0)
+            )
+            self.cache.purge()
+
+            self.queues.put('brocker:stats', self.report())
+        except EscalatorClosed:
+            self.loop.stop()
+        except Exception:
+            log_traceback(self.logger)
+
     def handle(self, msg):
+        # The requests which do not hold chunks in memory, like
+        # GET_SOURCES and GET_DELTA, do not wait for the others
+        if not self.buffered_size(tuple(msg[1:])):
+            self.admit(msg)
+            return
+
+        # The requests are admitted in order, so the big ones are not
+        # overtaken forever by the smaller ones
+        self.waiting.append(msg)
+        self.admit_waiting()
+
+    def admit_waiting(self):
+        while self.waiting:
+            if not self.admit(self.waiting[0]):
+                break
+            self.waiting.popleft()
+
+    def admit(self, msg):
+        """Forward the request if the chunk it asks for fits in the
+        budget, and return whether it was.
+        """
         identity = msg[0]
         args = tuple(msg[1:])
 
         if args in self.futures:
             future = self.futures[args]
         else:
+            size = self.buffered_size(args)
+
+            if size and not self.buffers.try_acquire(size):
+                return False
+
             future = self.pool.submit(self.get_response, *args)
             self.futures[args] = future
+            self.buffered[future] = size
 
         self.loop.add_future(
             future, functools.partial(self.reply, identity)
         )
+        return True
+
+    def buffered_size(self, args):
+        """Return the maximum number of bytes the answer to a request
+        holds in memory.
+        """
+        if args[0] == GET_CHUNK and len(args) > 3:
+            return int(args[3])
+        return 0
 
     def reply(self, identity, future):
         try:
@@ -77,7 +202,9 @@ class Brocker(object):
                 self.stream.send_multipart([identity] + [ERROR])
                 raise future.exception()
 
-            self.stream.send_multipart([identity] + future.result())
+            self.stream.send_multipart(
+                [identity] + future.result(), copy=False
+            )
         except zmq.ZMQError as e:
             if e.errno == zmq.ETERM:
                 self.loop.stop()
@@ -92,65 +219,230 @@ class Brocker(object):
                 k: v for k, v in self.futures.items() if v != future
             }
 
+            # The answer is shared by all the addressees, it is released
+            # only once
+            size = self.buffered.pop(future, 0)
+            if size:
+                self.buffers.release(size)
+                self.admit_waiting()
+
     def close(self):
+        with self.dealers_lock:
+            self.closed = True
+
+            for dealers in self.dealers.values():
+                for dealer in dealers:
+                    dealer.close(linger=0)
+            self.dealers = {}
+
+        self.cache.close()
         self.escalator.close()
+        self.queues.close()
         self.context.term()
 
+    def get_dealer(self, source):
+        """Return a socket connected to the Router of the source. Each
+        socket is only used by one thread at a time.
+        """
+        with self.dealers_lock:
+            dealers = self.dealers.get(source)
+            if dealers:
+                return dealers.pop()
+
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect(get_events_uri(self.session, source, 'router'))
+        return dealer
+
+    def release_dealer(self, source, dealer):
+        with self.dealers_lock:
+            if self.closed:
+                dealer.close(linger=0)
+            else:
+                self.dealers.setdefault(source, []).append(dealer)
+
     def get_response(self, cmd, fid, *args):
-        for source in self.select_best_source(fid.decode()):
-            dealer = None
+        if cmd == GET_SOURCES:
+            return self.get_sources(fid.decode())
+
+        refresh = True
+        key = None
+
+        if cmd == GET_CHUNK:
+            # The revision is read again for each chunk, as a transfer
+            # resumed after an update must not get the chunks of the
+            # previous content from the cache. The up-to-date services
+            # are read along with it.
+            revision = self.get_revision(fid.decode(), refresh=True)
+            refresh = False
+
+            if revision is not None:
+                # The codecs accepted are part of the key, as the chunks
+                # can be compressed
+                key = (fid, revision) + args
+                response = self.cache.get(key)
+
+                if response is not None:
+                    self.bucket.consume(
+                        sum(len(part) for part in response[1:])
+                    )
+                    return response
+
+        for source in self.select_best_source(fid.decode(), refresh):
+            dealer = self.get_dealer(source)
+            stats = self.get_stats(source)
+            started = stats.start()
 
             try:
-                dealer = self.context.socket(zmq.DEALER)
-                dealer.connect(get_events_uri(self.session, source, 'router'))
-
                 dealer.send_multipart((cmd, fid) + args)
 
-                response = dealer.recv_multipart()
-                if not response or response[0] == ERROR:
-                    self.logger.debug("Error with source {}", source)
+                if not dealer.poll(RESPONSE_TIMEOUT * 1000):
+                    stats.end(started, error=True)
+                    # The reply might still come, so the socket can't be
+                    # reused
+                    dealer.close(linger=0)
+                    self.logger.debug("Source {} timed out", source)
                     continue
 
-                return response
-            finally:
-                if dealer:
-                    dealer.close()
+                # The frames are forwarded to the addressee as they are,
+                # without copying their content
+                response = dealer.recv_multipart(copy=False)
+            except Exception:
+                stats.end(started, error=True)
+                # The socket might still expect a reply, so it can't be
+                # reused
+                dealer.close(linger=0)
+                raise
+
+            self.release_dealer(source, dealer)
+
+            size = sum(len(part) for part in response[1:])
+
+            if not response or response[0].bytes == ERROR:
+                stats.end(started, error=True)
+                self.logger.debug("Error with source {}", source)
+                continue
+
+            stats.end(started, size)
+
+            if key:
+                self.cache.put(key, response)
+
+            self.bucket.consume(size)
+            return response
 
         self.logger.debug("No more source available.")
         return [ERROR]
 
-    def select_best_source(self, fid):
-        excluded = set()
+    def get_sources(self, fid):
+        """Reply with the names of the services which can send the
+        file, from the best to the worst. The addressee then gets the
+        chunks directly from the Router of those sources.
 
-        while True:
-            # We get all the services each time in case there are new
-            # up-to-date services
-            services = set(
-                key.split(':')[-1] for key in
-                self.escalator.range(
-                    'file:{}:uptodate:'.format(fid), include_value=False
-                )
-            )
+        The transfers must go through the Brocker when the global rate
+        is limited.
+        """
+        if self.bucket.rate:
+            return [ERROR]
+
+        sources = self.get_uptodate(fid, refresh=True)
+
+        if not sources:
+            return [ERROR]
 
-            sources = services - excluded
+        sources = sorted(sources, key=self.rank)
+        return [SOURCES] + [source.encode() for source in sources]
 
-            max_velocity = 0.
-            source = None
+    def select_best_source(self, fid, refresh=True):
+        excluded = set()
 
-            for candidate in sources:
-                options = self.escalator.get(
-                    u'service:{}:options'.format(candidate), default={}
-                )
-                velocity = options.get('velocity', 0.5)
-                if velocity > max_velocity:
-                    max_velocity = velocity
-                    source = candidate
+        while True:
+            # After an error we get all the services again, in case
+            # there are new up-to-date services
+            refresh = refresh or bool(excluded)
+            sources = self.get_uptodate(fid, refresh) - excluded
 
-            if not source:
+            if not sources:
                 break
 
+            source = min(sources, key=self.rank)
+
             self.logger.debug("Selecting source {}", source)
             yield source
 
             # Apparently there was an issue with this source, so we exclude it.
             excluded.add(source)
+
+    def rank(self, source):
+        """Sort the sources by the estimated time they need to answer,
+        which takes into account their load. The velocity of the
+        services is used for the ones which were never used.
+        """
+        return (self.get_stats(source).cost(), -self.get_velocity(source))
+
+    def get_stats(self, source):
+        with self.stats_lock:
+            if source not in self.stats:
+                self.stats[source] = SourceStats()
+            return self.stats[source]
+
+    def get_velocity(self, source):
+        now = time.time()
+        cached = self.velocities.get(source)
+
+        if cached and now - cached[0] < CACHE_TTL:
+            return cached[1]
+
+        options = self.escalator.get(
+            u'service:{}:options'.format(source), default={}
+        )
+        velocity = options.get('velocity', 0.5)
+        self.velocities[source] = (now, velocity)
+        return velocity
+
+    def get_uptodate(self, fid, refresh=False):
+        """Return the services which have an up-to-date version of the
+        file.
+        """
+        return self._get_uptodate(fid, refresh)[1]
+
+    def get_revision(self, fid, refresh=False):
+        """Return the time of the last update of the file, which
+        identifies its content. All the up-to-date services are reset
+        when a file is updated, so it's the oldest of their timestamps.
+        """
+        return self._get_uptodate(fid, refresh)[2]
+
+    def _get_uptodate(self, fid, refresh):
+        now = time.time()
+        cached = self.uptodate.get(fid)
+
+        if not refresh and cached and now - cached[0] < CACHE_TTL:
+            return cached
+
+        timestamps = dict(
+            (key.split(':')[-1], timestamp) for key, timestamp in
+            self.escalator.range(u'file:{}:uptodate:'.format(fid))
+        )
+        revision = min(timestamps.values()) if timestamps else None
+
+        cached = (now, frozenset(timestamps), revision)
+        self.uptodate[fid] = cached
+        return cached
+
+    def report(self):
+        """Return the statistics of the cache, of the sources and of the
+        bytes being forwarded.
+        """
+        with self.stats_lock:
+            sources = dict(
+                (name, stats.get()) for name, stats in self.stats.items()
+            )
+
+        buffers = self.buffers.stats()
+        buffers['waiting'] = len(self.waiting)
+
+        return {
+            'cache': self.cache.stats(),
+            'sources': sources,
+            'buffers': buffers,
+        }
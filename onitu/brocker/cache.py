@@ -0,0 +1,194 @@
+"""
+This module implements the cache of the chunks forwarded by the
+:class:`.Brocker`.
+
+When a file changes, all the other services request the same chunks
+from the source. The responses are kept in memory, so the source is only
+read once. The chunks are identified by the fid and revision of the
+file, so an update of the file never returns stale content.
+
+The least recently used chunks are evicted when the cache is full, and
+the chunks expire after a while. The evicted chunks can be written to a
+temporary directory instead of being dropped, if a disk size is given.
+"""
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import msgpack
+
+
+class ChunkCache(object):
+    def __init__(self, max_size=0, ttl=60, disk_size=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_size = disk_size
+
+        # The entries are (timestamp, frames, size) tuples in memory,
+        # and (timestamp, path, size) tuples on disk, from the least to
+        # the most recently used
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._memory_size = 0
+        self._disk_usage = 0
+        self._directory = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_size, ttl, disk_size):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self.disk_size = disk_size
+            self._evict()
+
+    def get(self, key):
+        """Return the frames cached for the given key, or `None`."""
+        with self._lock:
+            if not self.max_size:
+                return None
+
+            now = time.time()
+
+            entry = self._memory.pop(key, None)
+            if entry and now - entry[0] < self.ttl:
+                self._memory[key] = entry
+                self.hits += 1
+                return entry[1]
+            elif entry:
+                self._memory_size -= entry[2]
+
+            entry = self._disk.pop(key, None)
+            if entry:
+                self._disk_usage -= entry[2]
+
+                if now - entry[0] < self.ttl:
+                    frames = self._read(entry[1])
+                    if frames is not None:
+                        # The chunk is used again, so we keep it in memory
+                        self._store(key, entry[0], frames, entry[2])
+                        self.hits += 1
+                        return frames
+                else:
+                    self._remove(entry[1])
+
+            self.misses += 1
+            return None
+
+    def put(self, key, frames):
+        with self._lock:
+            if not self.max_size:
+                return
+
+            size = sum(len(frame) for frame in frames)
+
+            if size > self.max_size:
+                return
+
+            self._store(key, time.time(), frames, size)
+
+    def purge(self):
+        """Remove the expired entries."""
+        with self._lock:
+            deadline = time.time() - self.ttl
+
+            for key, entry in list(self._memory.items()):
+                if entry[0] < deadline:
+                    del self._memory[key]
+                    self._memory_size -= entry[2]
+
+            for key, entry in list(self._disk.items()):
+                if entry[0] < deadline:
+                    del self._disk[key]
+                    self._disk_usage -= entry[2]
+                    self._remove(entry[1])
+
+    def close(self):
+        with self._lock:
+            self._memory.clear()
+            self._disk.clear()
+            self._memory_size = 0
+            self._disk_usage = 0
+
+            if self._directory:
+                shutil.rmtree(self._directory, ignore_errors=True)
+                self._directory = None
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / requests if requests else 0.,
+                'evictions': self.evictions,
+                'entries': len(self._memory) + len(self._disk),
+                'memory_size': self._memory_size,
+                'disk_size': self._disk_usage,
+            }
+
+    def _store(self, key, timestamp, frames, size):
+        old = self._memory.pop(key, None)
+        if old:
+            self._memory_size -= old[2]
+
+        self._memory[key] = (timestamp, frames, size)
+        self._memory_size += size
+        self._evict()
+
+    def _evict(self):
+        while self._memory and self._memory_size > self.max_size:
+            key, entry = self._memory.popitem(last=False)
+            self._memory_size -= entry[2]
+            self.evictions += 1
+
+            if self.disk_size and entry[2] <= self.disk_size:
+                self._spill(key, entry)
+
+        while self._disk and self._disk_usage > self.disk_size:
+            _, entry = self._disk.popitem(last=False)
+            self._disk_usage -= entry[2]
+            self._remove(entry[1])
+
+    def _spill(self, key, entry):
+        if not self._directory:
+            self._directory = tempfile.mkdtemp(prefix='onitu-cache-')
+
+        name = hashlib.md5(repr(key).encode()).hexdigest()
+        path = os.path.join(self._directory, name)
+
+        try:
+            with open(path, 'wb') as f:
+                f.write(msgpack.packb(
+                    [bytes(frame) for frame in entry[1]], use_bin_type=True
+                ))
+        except (IOError, OSError):
+            return
+
+        self._disk[key] = (entry[0], path, entry[2])
+        self._disk_usage += entry[2]
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                frames = msgpack.unpackb(f.read())
+        except (IOError, OSError):
+            return None
+        finally:
+            self._remove(path)
+
+        return frames
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -1,2 +1,4 @@
 GET_CHUNK = b'1'
 GET_FILE = b'2'
+GET_DELTA = b'3'
+GET_SOURCES = b'4'
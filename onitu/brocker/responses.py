@@ -1,4 +1,6 @@
 CHUNK = b'C'
 FILE = b'F'
+DELTA = b'D'
+SOURCES = b'S'
 ERROR = b'E'
 OK = b'O'
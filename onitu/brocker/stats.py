@@ -0,0 +1,85 @@
+"""
+This module tracks the statistics of the sources used by the
+:class:`.Brocker`, in order to send each request to the source which
+should answer it the fastest.
+
+The latency, throughput and error rate of each source are exponentially
+weighted moving averages (EWMA), so the recent requests matter more
+than the old ones.
+"""
+import time
+import threading
+
+# The weight of the last request in the averages
+ALPHA = 0.2
+
+# The maximum error rate taken into account, so a source which failed a
+# lot can still be selected again when the others are busy
+MAX_ERROR_RATE = 0.9
+
+
+def ewma(average, value, alpha=ALPHA):
+    if average is None:
+        return value
+    return alpha * value + (1 - alpha) * average
+
+
+class SourceStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        # Seconds per request
+        self.latency = None
+        # Bytes per second
+        self.throughput = None
+        self.error_rate = 0.
+
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Called when a request is sent to the source. Return the time
+        which should be given to :meth:`end`.
+        """
+        with self._lock:
+            self.in_flight += 1
+        return time.time()
+
+    def end(self, started, size=0, error=False):
+        """Called when the source replied to a request, or failed to."""
+        elapsed = max(time.time() - started, 1e-6)
+
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.error_rate = ewma(self.error_rate, 1. if error else 0.)
+
+            if error:
+                return
+
+            self.latency = ewma(self.latency, elapsed)
+            if size:
+                self.throughput = ewma(self.throughput, size / elapsed)
+
+    def cost(self):
+        """Return the estimated time needed by the source to answer a
+        new request, taking into account the requests it is already
+        handling and its errors.
+
+        A source which was never used has a cost of 0, so it is tried.
+        """
+        with self._lock:
+            if self.latency is None:
+                return 0.
+
+            error_rate = min(self.error_rate, MAX_ERROR_RATE)
+            return self.latency * (self.in_flight + 1) / (1 - error_rate)
+
+    def get(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'in_flight': self.in_flight,
+                'latency': self.latency,
+                'throughput': self.throughput,
+                'error_rate': self.error_rate,
+            }
@@ -1,5 +1,6 @@
 from onitu.escalator.protocol.status import EscalatorClosed
 from .escalator import Escalator
+from .log import Log
 
 
-__all__ = ['Escalator', 'EscalatorClosed']
+__all__ = ['Escalator', 'EscalatorClosed', 'Log']
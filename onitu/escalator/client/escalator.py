@@ -7,20 +7,42 @@ from onitu.utils import get_escalator_uri, b, u
 
 from .batch import WriteBatch
 
+# The options of the database of the queues. Their keys are written and
+# deleted all the time, so a bigger write buffer absorbs most of them
+# before they reach the disk, and they are not worth compressing
+QUEUES_DB_OPTIONS = {
+    'write_buffer_size': 32 << 20,
+    'compression': None,
+}
+
 
 class Escalator(object):
     def __init__(self, session, prefix=None, create_db=False,
-                 context=None):
+                 context=None, name=None, options=None):
         super(Escalator, self).__init__()
         self.uri = get_escalator_uri(session)
         self.session = session
+        self.name = name or session
+        self.options = options
         self.db_uid = None
         self.context = context or zmq.Context().instance()
         self.socket = self.context.socket(zmq.REQ)
         self.socket.linger = 0  # don't wait for data to be sent when closing
         self.lock = Lock()
         self.socket.connect(self.uri)
-        self.connect(session, prefix, create_db)
+        self.connect(self.name, prefix, create_db, options)
+
+    @classmethod
+    def queues(cls, session, context=None):
+        """Connect to the database of the queues of events, of the
+        progress of the transfers and of the statistics, which is
+        separated from the metadata so its churn does not slow down
+        their reads.
+        """
+        return cls(
+            session, create_db=True, context=context,
+            name=u'{}-queues'.format(session), options=QUEUES_DB_OPTIONS
+        )
 
     def _request(self, cmd, *args):
         with self.lock:
@@ -56,16 +78,19 @@ class Escalator(object):
                 self.lock.release()
 
     def clone(self, *args, **kwargs):
+        kwargs.setdefault('name', self.name)
+        kwargs.setdefault('options', self.options)
         return Escalator(self.session, *args, **kwargs)
 
     def create(self, name):
         self._request(protocol.cmd.CREATE, name)
 
-    def connect(self, name, prefix=None, create=False):
+    def connect(self, name, prefix=None, create=False, options=None):
         self.db_uid = self._request(protocol.cmd.CONNECT,
                                     name,
                                     b(prefix),
-                                    create)[0]
+                                    create,
+                                    options)[0]
 
     def get(self, key, **kwargs):
         try:
@@ -81,6 +106,23 @@ class Escalator(object):
 
         return value
 
+    def multi_get(self, keys, default=None, pack=True):
+        """Return the values of several keys with a single request, in the
+        same order. The keys not found have the `default` value.
+        """
+        keys = [b(key) for key in keys]
+
+        if not keys:
+            return ()
+
+        values = self._request_multi(protocol.cmd.MULTI_GET, *keys)
+
+        return tuple(
+            default if value is None else
+            protocol.msg.unpack_msg(value) if pack else value
+            for value in values
+        )
+
     def exists(self, key):
         return self._request(protocol.cmd.EXISTS, b(key))[0]
 
@@ -114,5 +156,12 @@ class Escalator(object):
 
         return values
 
+    def compact(self, start=None, stop=None):
+        """Compact the storage of the given range of keys, so the space
+        of the deleted keys is reclaimed and they are not read anymore
+        by the next ranges.
+        """
+        self._request(protocol.cmd.COMPACT, b(start), b(stop))
+
     def write_batch(self, transaction=False):
         return WriteBatch(self, transaction)
@@ -0,0 +1,59 @@
+class Log(object):
+    """An append-only log stored in the database. Each record has a
+    sequence number, given by its producer, and the records are read in
+    this order.
+
+    The records are never overwritten nor deleted one by one. The
+    consumers keep a cursor, the sequence number of the last record they
+    handled, and the records before it are regularly truncated at once.
+    """
+
+    def __init__(self, escalator, prefix):
+        self.escalator = escalator
+        self.prefix = prefix
+
+    def key(self, sequence):
+        return u'{}{:016x}'.format(self.prefix, sequence)
+
+    def append(self, sequence, value, batch=None):
+        (batch or self.escalator).put(self.key(sequence), value)
+
+    def read(self, cursor=0):
+        """Return the records after the cursor, as (sequence, value)
+        tuples.
+        """
+        records = self.escalator.range(
+            start=self.key(cursor), stop=self.prefix + u'~',
+            include_start=False
+        )
+        return [
+            (int(key[len(self.prefix):], 16), value)
+            for key, value in records
+        ]
+
+    def lag(self, cursor=0):
+        """Return the number of records after the cursor."""
+        return len(self.escalator.range(
+            start=self.key(cursor), stop=self.prefix + u'~',
+            include_start=False, include_value=False
+        ))
+
+    def truncate(self, cursor):
+        """Delete the records up to the cursor, and compact their range
+        so the next reads do not go through them. Return the number of
+        records deleted.
+        """
+        keys = self.escalator.range(
+            start=self.prefix, stop=self.key(cursor),
+            include_stop=True, include_value=False
+        )
+
+        if not keys:
+            return 0
+
+        with self.escalator.write_batch() as batch:
+            for key in keys:
+                batch.delete(key)
+
+        self.escalator.compact(self.prefix, self.key(cursor))
+        return len(keys)
@@ -20,3 +20,5 @@ PUT = command('PUT', b'\x05')
 DELETE = command('DELETE', b'\x06')
 RANGE = command('RANGE', b'\x07')
 BATCH = command('BATCH', b'\x08')
+MULTI_GET = command('MULTI_GET', b'\x09')
+COMPACT = command('COMPACT', b'\x0a')
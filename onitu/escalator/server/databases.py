@@ -34,13 +34,17 @@ class Databases(object):
     def get(self, uid):
         return self.get_db(self.get_name(uid))
 
-    def connect(self, name, prefix=None, create=False):
+    def connect(self, name, prefix=None, create=False, options=None):
+        # The options only apply when the database is opened
+        options = {u(key): value for key, value in (options or {}).items()}
+
         with self._lock:
             try:
                 name = os.path.join(self._working_dir, name)
                 if name not in self._databases:
                     self._databases[name] = plyvel.DB(name,
-                                                      create_if_missing=create)
+                                                      create_if_missing=create,
+                                                      **options)
                     self._names.append(name)
                 if prefix:
                     db = self._databases[name]
@@ -29,11 +29,13 @@ class Worker(Thread):
 
         self.commands = {
             protocol.cmd.GET: self.get,
+            protocol.cmd.MULTI_GET: self.multi_get,
             protocol.cmd.EXISTS: self.exists,
             protocol.cmd.PUT: self.put,
             protocol.cmd.DELETE: self.delete,
             protocol.cmd.RANGE: self.range,
-            protocol.cmd.BATCH: self.batch
+            protocol.cmd.BATCH: self.batch,
+            protocol.cmd.COMPACT: self.compact
         }
 
         self.batch_commands = {
@@ -94,10 +96,10 @@ class Worker(Thread):
     def create(self, name):
         return self.connect(name, None, True)
 
-    def connect(self, name, prefix, create):
+    def connect(self, name, prefix, create, options=None):
         name = u(name)
         try:
-            uid = self.databases.connect(name, prefix, create)
+            uid = self.databases.connect(name, prefix, create, options)
             resp = protocol.msg.format_response(uid, status=protocol.status.OK)
         except self.databases.NotExistError as e:
             self.logger.warning("No such database: {}", name)
@@ -116,6 +118,11 @@ class Worker(Thread):
                 key, status=protocol.status.KEY_NOT_FOUND)
         return protocol.msg.format_response(value)
 
+    def multi_get(self, db, *keys):
+        values = Multipart(protocol.msg.pack_arg(db.get(key)) for key in keys)
+        values.insert(0, protocol.msg.format_response())
+        return values
+
     def exists(self, db, key):
         value = db.get(key)
         return protocol.msg.format_response(value is not None)
@@ -145,6 +152,15 @@ class Worker(Thread):
         values.insert(0, protocol.msg.format_response())
         return values
 
+    def compact(self, db, start, stop):
+        # The prefixed databases share the storage of their parent
+        if hasattr(db, 'prefix'):
+            start = db.prefix + start if start is not None else db.prefix
+            stop = db.prefix + stop if stop is not None else None
+            db = db.db
+        db.compact_range(start=start, stop=stop)
+        return protocol.msg.format_response()
+
     def batch(self, db, transaction):
         with db.write_batch(transaction=transaction) as wb:
             while self.socket.get(zmq.RCVMORE):
@@ -0,0 +1,113 @@
+"""
+This module implements the compression of the chunks sent by the
+:class:`.Router` to the :class:`.TransferWorker` of another service.
+
+The worker sends the list of the codecs it accepts along with its
+request, and the Router compresses the content with the best codec
+available on its side. zlib is always available, zstd and lz4 are used
+if the `zstandard` and `lz4` modules are installed.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# The codecs, from the most to the least preferred
+PREFERENCE = (b'zstd', b'lz4', b'zlib')
+
+CODECS = {
+    b'zlib': (zlib.compress, zlib.decompress),
+}
+
+if zstandard:
+    CODECS[b'zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+if lz4:
+    CODECS[b'lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+# The types whose content is already compressed, and thus not worth
+# compressing again
+COMPRESSED_TYPES = ('image/', 'video/', 'audio/')
+
+UNCOMPRESSED_TYPES = frozenset((
+    'image/bmp',
+    'image/svg+xml',
+    'image/x-ms-bmp',
+    'image/x-portable-pixmap',
+    'image/tiff',
+    'audio/x-wav',
+    'audio/wav',
+))
+
+COMPRESSED_MIMETYPES = frozenset((
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-lzma',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/x-compress',
+    'application/java-archive',
+    'application/pdf',
+    'application/epub+zip',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.presentation',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml'
+    '.presentation',
+))
+
+
+def available():
+    """Return the codecs available, as a comma-separated byte string."""
+    return b','.join(name for name in PREFERENCE if name in CODECS)
+
+
+def is_compressed(mimetype):
+    """Return whether the content of a file of the given type is already
+    compressed.
+    """
+    if mimetype in COMPRESSED_MIMETYPES:
+        return True
+
+    if mimetype in UNCOMPRESSED_TYPES:
+        return False
+
+    return mimetype.startswith(COMPRESSED_TYPES)
+
+
+def choose(accepted):
+    """Choose the best codec among the ones accepted by the addressee,
+    given as a comma-separated byte string. Return `None` if there
+    isn't any.
+    """
+    accepted = accepted.split(b',')
+
+    for name in PREFERENCE:
+        if name in accepted and name in CODECS:
+            return name
+
+    return None
+
+
+def compress(codec, data):
+    return CODECS[codec][0](data)
+
+
+def decompress(codec, data):
+    return CODECS[codec][1](data)
@@ -1,5 +1,6 @@
 import time
 import socket
+import threading
 
 import zmq
 
@@ -7,16 +8,22 @@ from multiprocessing.pool import ThreadPool
 
 from logbook import Logger
 
-from onitu.utils import get_events_uri, b, log_traceback
-from onitu.escalator.client import EscalatorClosed
+from onitu.utils import get_referee_uri, b, log_traceback
+from onitu.escalator.client import EscalatorClosed, Log
 
-from .workers import WORKERS, UP
+from .events import EventQueue, subtree
+from .workers import WORKERS, UP, TransferWorker
+
+# The events handled are deleted from the queues at most once per
+# interval, in seconds
+TRUNCATE_INTERVAL = 60
 
 
 class Dealer(object):
     """Receive and reply to orders from the Referee.
 
-    All the requests are handled in a thread-pool.
+    The events of each file are debounced and folded by an
+    :class:`.EventQueue`, and then handled in a thread-pool.
     """
 
     def __init__(self, plug):
@@ -24,20 +31,47 @@ class Dealer(object):
         self.plug = plug
         self.name = plug.name
         self.escalator = plug.escalator
+        self.queues = plug.queues
         self.logger = Logger(u"{} - Dealer".format(self.name))
         self.context = plug.context
         self.in_progress = {}
         self.pool = ThreadPool()
+        self.queue = EventQueue(plug.options['event_debounce'])
+        # The events waiting in the queue, indexed by fid. They are
+        # (partition, sequence) tuples, or the keys of the events of the
+        # previous versions
+        self.pending_keys = {}
+        # The sequence numbers of the events read from each queue but
+        # not handled yet
+        self.unhandled = []
+        # The sequence number of the last event read from each queue,
+        # and of the last event before which all the events have been
+        # handled
+        self.read = []
+        self.cursors = []
+        self.truncated = []
+        # Wake up the loop when a transfer is over, so the events waiting
+        # for it are admitted
+        self.waker = None
+        self.waker_lock = threading.Lock()
+        plug.transfers.subscribe(self.wake)
 
     def run(self):
         listener = None
 
-        uri = get_events_uri(self.plug.session, 'referee', 'publisher')
+        partitions = self.escalator.get('referee:partitions', default=1)
+        uris = [
+            get_referee_uri(self.plug.session, partition, 'publisher')
+            for partition in range(partitions)
+        ]
 
         # If the URI is an IPC, we will never get messages if we connect before
         # the publisher is bound. ZeroMQ does not provide any solution to see
         # if the socket is bound, so we have to use a raw socket to find it out
-        if uri.startswith(u'ipc://'):
+        for uri in uris:
+            if not uri.startswith(u'ipc://'):
+                continue
+
             while True:
                 try:
                     s = socket.socket(socket.AF_UNIX)
@@ -47,89 +81,270 @@ class Dealer(object):
                 except socket.error:
                     time.sleep(0.1)
 
+        wakeup = None
+
         try:
             listener = self.context.socket(zmq.SUB)
             listener.setsockopt(zmq.SUBSCRIBE, b(self.name))
-            listener.connect(uri)
+            for uri in uris:
+                listener.connect(uri)
+
+            wakeup_uri = u'inproc://dealer-{}'.format(id(self))
+            wakeup = self.context.socket(zmq.PULL)
+            wakeup.bind(wakeup_uri)
+            with self.waker_lock:
+                self.waker = self.context.socket(zmq.PUSH)
+                self.waker.connect(wakeup_uri)
 
             self.logger.info("Started")
 
-            self.listen(listener)
+            self.listen(listener, partitions, wakeup)
         except EscalatorClosed:
             pass
         except Exception:
             log_traceback(self.logger)
         finally:
+            with self.waker_lock:
+                if self.waker:
+                    self.waker.close(linger=0)
+                    self.waker = None
+
+            if wakeup:
+                wakeup.close()
+
             if listener:
                 listener.close()
 
-    def listen(self, listener):
+    def listen(self, listener, partitions=1, wakeup=None):
+        # Each partition of the Referee has its own queue, as their events
+        # are not ordered between them
+        queues = [
+            Log(self.queues, u'service:{}:queue:{}:'.format(
+                self.name, partition
+            ))
+            for partition in range(partitions)
+        ]
+
+        cursors = self.queues.get(
+            u'service:{}:cursors'.format(self.name), default=[]
+        )
+        self.cursors = (cursors + [0] * partitions)[:partitions]
+        self.truncated = list(self.cursors)
+        self.read = list(self.cursors)
+        self.unhandled = [set() for _ in range(partitions)]
+        last_truncation = time.time()
+
+        poller = zmq.Poller()
+        poller.register(listener, zmq.POLLIN)
+        if wakeup:
+            poller.register(wakeup, zmq.POLLIN)
+
+        # The events of the previous versions, which were indexed by fid
+        for prefix in (u'service:{}:inprogress:', u'service:{}:event:'):
+            for key, (cmd, args) in self.escalator.range(
+                    prefix.format(self.name)):
+                self.push(key, key.split(':')[-1], cmd, args)
+
         while True:
-            events = self.escalator.range(
-                prefix=u'service:{}:event:'.format(self.name)
-            )
+            # The events are kept in the queue until they are handled, so
+            # if old events are still there (maybe after a crash) we are
+            # sure to handle them. Each event is only read once.
+            events = []
 
-            # We copy the current events in another key. That way, we keep in
-            # the db the events not handled yet, but if a new event with the
-            # same fid comes before we finished handling the first one we
-            # don't erase it
-            for key, event in events:
-                self.escalator.delete(key)
+            for partition, queue in enumerate(queues):
+                for sequence, event in queue.read(self.read[partition]):
+                    events.append(((partition, sequence), event))
+                    self.unhandled[partition].add(sequence)
+                    self.read[partition] = sequence
 
-                fid = key.split(':')[-1]
-                self.escalator.put(
-                    u'service:{}:inprogress:{}'.format(self.name, fid), event
-                )
+            for key, (fid, cmd, args) in events:
+                self.push(key, fid, cmd, args)
 
-            # We get the inprogress events from the DB, so that if old events
-            # are still there (maybe after a crash) we are sure to handle them
-            events = self.escalator.range(
-                u'service:{}:inprogress:'.format(self.name)
-            )
+            # The events are only handled when a transfer can start, the
+            # others stay in the queue
+            ready = self.queue.pop_ready(limit=self.admissible())
 
-            for key, (cmd, args) in events:
-                fid = key.split(':')[-1]
+            for fid, cmd, args in ready:
                 self.call(cmd, fid, *args)
-                self.escalator.delete(
-                    u'service:{}:inprogress:{}'.format(self.name, fid)
+                # The next events of the file are still waiting
+                if fid not in self.queue:
+                    self.ack(fid)
+
+            if events or ready:
+                self.commit()
+                self.queues.put(
+                    u'service:{}:events'.format(self.name), self.queue.stats()
                 )
 
+            if time.time() - last_truncation >= TRUNCATE_INTERVAL:
+                self.truncate(queues)
+                last_truncation = time.time()
+
+            timeout = self.queue.timeout()
+            if not timeout:
+                # The events ready are waiting for a transfer to finish,
+                # which wakes us up
+                timeout = TRUNCATE_INTERVAL
+
             try:
-                listener.recv()
+                poller.poll(timeout * 1000)
+
+                # All the notifications received meanwhile are handled
+                # by the next read of the queue
+                for sock in (listener, wakeup):
+                    while sock and sock.poll(0):
+                        sock.recv()
             except zmq.ZMQError as e:
                 if e.errno == zmq.ETERM:
                     break
                 raise
 
+    def wake(self):
+        """Wake up the loop of the Dealer. It can be called from any
+        thread.
+        """
+        with self.waker_lock:
+            if not self.waker:
+                return
+
+            try:
+                self.waker.send(b'', zmq.NOBLOCK)
+            except zmq.ZMQError:
+                # The loop already has wake-ups waiting, or is closing
+                pass
+
+    def push(self, key, fid, cmd, args):
+        """Add an event read from the database to the queue. It is
+        acknowledged once the event, or the event it is folded in, is
+        handled.
+        """
+        target = self.queue.push(fid, cmd, args)
+        keys = self.pending_keys.setdefault(target, [])
+        keys.append(key)
+
+        for folded in [fid] + subtree(cmd, args):
+            if folded != target:
+                keys.extend(self.pending_keys.pop(folded, ()))
+
+    def ack(self, fid):
+        legacy = []
+
+        for key in self.pending_keys.pop(fid, ()):
+            if isinstance(key, tuple):
+                partition, sequence = key
+                self.unhandled[partition].discard(sequence)
+            else:
+                legacy.append(key)
+
+        if legacy:
+            with self.escalator.write_batch() as batch:
+                for key in legacy:
+                    batch.delete(key)
+
+    def commit(self):
+        """Move the cursor of each queue after the events handled, up
+        to the first event which is still waiting.
+        """
+        cursors = [
+            min(unhandled) - 1 if unhandled else read
+            for unhandled, read in zip(self.unhandled, self.read)
+        ]
+
+        if cursors != self.cursors:
+            self.cursors = cursors
+            self.queues.put(
+                u'service:{}:cursors'.format(self.name), cursors
+            )
+
+    def truncate(self, queues):
+        """Delete the events handled from the queues."""
+        for partition, queue in enumerate(queues):
+            cursor = self.cursors[partition]
+
+            if cursor != self.truncated[partition]:
+                queue.truncate(cursor)
+                self.truncated[partition] = cursor
+
+    def admissible(self):
+        """Return the number of workers which can start now, within the
+        limits on the transfers of the service and of all the services,
+        or `None` if there is no limit.
+        """
+        transfers = self.plug.transfers
+        counts = [transfers.available()]
+
+        if self.plug.global_transfers:
+            counts.append(max(
+                self.plug.global_transfers - self.plug.other_transfers -
+                transfers.used, 0
+            ))
+
+        counts = [count for count in counts if count is not None]
+        return min(counts) if counts else None
+
     def stop_transfer(self, fid):
+        """Ask the worker handling the file to stop, without waiting for
+        it. Return the result of the worker, or `None` if there was none.
+        """
         if fid in self.in_progress:
             worker, result = self.in_progress[fid]
-            worker.stop()
-            result.wait()
-            return True
+            worker.stop(fid)
+            return result
+
+        return None
 
-        return False
+    def supersede(self, fid):
+        """Return the result of the worker handling the file, or `None`
+        if there is none. A transfer is outdated by the next event of
+        the file, so it is stopped, but the other operations must be
+        done before it is handled.
+        """
+        if fid not in self.in_progress:
+            return None
+
+        worker, result = self.in_progress[fid]
+        if isinstance(worker, TransferWorker):
+            worker.stop()
+        return result
 
     def resume_transfers(self):
         """Resume transfers after a crash. Called in
         :meth:`.Plug.listen`.
         """
-        transfers = self.escalator.range(
-            prefix=u'service:{}:transfer:'.format(self.name)
-        )
+        prefix = u'service:{}:transfer:'.format(self.name)
 
-        if not transfers:
-            return
+        # The transfers of the previous versions were in the database
+        # of the metadata
+        legacy = self.escalator.range(prefix=prefix)
+        if legacy:
+            with self.queues.write_batch() as batch:
+                for key, offset in legacy:
+                    batch.put(key, offset)
+
+            with self.escalator.write_batch() as batch:
+                for key, _ in legacy:
+                    batch.delete(key)
 
-        for key, offset in transfers:
-            fid = key.split(':')[-1]
-            self.call(UP, fid, offset=offset, restart=True)
+        # The transfers are resumed when they are admitted, like the
+        # other events
+        for key, offset in self.queues.range(prefix=prefix):
+            self.queue.push(key.split(':')[-1], UP, (offset, True))
 
     def call(self, cmd, fid, *args, **kwargs):
         if cmd not in WORKERS:
             return
 
-        self.stop_transfer(fid)
         worker = WORKERS[cmd](self, fid, *args, **kwargs)
+        # The worker waits for the previous ones to abort, or to finish,
+        # before touching the files
+        worker.previous = [
+            result for result in map(self.supersede, worker.fids)
+            if result
+        ]
+        # The worker releases it when it is over
+        self.plug.transfers.acquire()
+        worker.admitted = True
         result = self.pool.apply_async(worker)
-        self.in_progress[fid] = (worker, result)
+        # The workers on a directory can be found from its files
+        for fid in worker.fids:
+            self.in_progress[fid] = (worker, result)
@@ -0,0 +1,60 @@
+"""
+This module provides the block signatures used by the delta transfers.
+
+A target keeps the signature of each block of its copy of a file. When
+the file changes, it sends those signatures to the source, which only
+reports the blocks whose content differ. Only those blocks are then
+transferred.
+
+Each block is described by a weak checksum (Adler-32, the rolling
+checksum used by rsync) and a strong checksum (MD5). The strong
+checksum is only computed when the weak one matches.
+"""
+import zlib
+import hashlib
+
+import msgpack
+
+
+def weak_checksum(block):
+    return zlib.adler32(block) & 0xffffffff
+
+
+def strong_checksum(block):
+    return hashlib.md5(block).hexdigest()
+
+
+def block_signature(block):
+    """Return the signature of a block, as a (weak, strong) tuple."""
+    return (weak_checksum(block), strong_checksum(block))
+
+
+def file_signature(content, block_size):
+    """Return the list of the signatures of each block of `content`."""
+    return [
+        block_signature(content[offset:offset + block_size])
+        for offset in range(0, len(content), block_size)
+    ]
+
+
+def block_changed(signature, index, block):
+    """Return whether the block at the given index differs from the
+    one described in `signature`.
+    """
+    if index >= len(signature):
+        return True
+
+    weak, strong = signature[index]
+
+    if weak_checksum(block) != weak:
+        return True
+
+    return strong_checksum(block) != strong
+
+
+def pack(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def unpack(packed):
+    return msgpack.unpackb(packed, use_list=False, encoding='utf-8')
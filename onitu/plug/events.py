@@ -0,0 +1,229 @@
+"""
+This module implements the queue of the events waiting to be handled by
+the :class:`.Dealer`.
+
+An event is only handled once no other event came for the same file
+during the debounce window, so a file changed many times in a row is
+transferred once. The events of a file are folded when it does not
+change the result: a transfer or a deletion replaces the pending
+transfer of the file, and the moves are followed, so a file moved then
+deleted is only deleted. A move is never replaced, the events of the
+file which follow it are handled after it. The pending events of the
+files of a directory are replaced by the move or the deletion of the
+directory.
+"""
+import time
+import heapq
+
+from onitu.referee import UP, DEL, MOV, MOV_DIR, DEL_DIR
+
+# An event is handled after at most this number of debounce windows,
+# even if the file keeps changing
+MAX_DELAY_FACTOR = 10
+
+
+def subtree(cmd, args):
+    """Return the fids of the files affected by an event on a
+    directory, or an empty list for the other events.
+    """
+    if cmd == MOV_DIR:
+        return [old_fid for old_fid, _ in args[3]]
+    if cmd == DEL_DIR:
+        return list(args[2])
+    return []
+
+
+class EventQueue(object):
+    def __init__(self, debounce=0):
+        self.debounce = debounce
+
+        # The pending events, indexed by fid. The values are the list of
+        # the (command, arguments) of the file in order, the time of the
+        # first event, the time of the last one and the time the events
+        # are ready
+        self.events = {}
+        # The (deadline, fid) of the files, the first ready at the top.
+        # The entries are not removed when the events of a file change,
+        # the ones whose deadline is outdated are skipped instead.
+        self.deadlines = []
+        # The fid of the source of each pending move, indexed by the fid
+        # of its destination
+        self.moves = {}
+
+        self.received = 0
+        self.coalesced = 0
+
+    def __contains__(self, fid):
+        return fid in self.events
+
+    def push(self, fid, cmd, args, now=None):
+        """Add an event to the queue, folded with the pending events of
+        the file when possible.
+
+        Return the fid under which the event is now stored, which is the
+        fid of the original file when the event follows a move.
+        """
+        if now is None:
+            now = time.time()
+
+        self.received += 1
+        args = tuple(args)
+
+        if cmd in (DEL, MOV) and fid in self.moves:
+            # The file is the destination of a pending move, which now
+            # moves the original file to its new destination, or
+            # deletes it
+            source = self.moves.pop(fid)
+            record = self.events[source]
+            events = record[0]
+            index = next(
+                i for i, (old_cmd, old_args) in enumerate(events)
+                if old_cmd == MOV and old_args[0] == fid
+            )
+
+            if cmd == DEL:
+                events[index] = (DEL, ())
+            else:
+                events[index] = (MOV, args)
+                self.moves[args[0]] = source
+
+            record[2] = now
+            self._schedule(source, record)
+            self._remove(fid)
+            self.coalesced += 1
+            return source
+
+        for folded in subtree(cmd, args):
+            if self._remove(folded):
+                self.coalesced += 1
+
+        record = self.events.get(fid)
+
+        if record is None:
+            record = self.events[fid] = [[(cmd, args)], now, now, None]
+            self._schedule(fid, record)
+        else:
+            events = record[0]
+            record[2] = now
+            self._schedule(fid, record)
+            last = events[-1][0]
+
+            # Only the transfers and the deletions replace the pending
+            # event, a move is kept and handled first
+            if (cmd == UP and last == UP) or (cmd == DEL and last != MOV):
+                events[-1] = (cmd, args)
+                self.coalesced += 1
+                return fid
+
+            events.append((cmd, args))
+
+        if cmd == MOV:
+            self.moves[args[0]] = fid
+
+        return fid
+
+    def get(self, fid):
+        """Return the last pending event of the file, as a (cmd, args)
+        tuple, or `None` if there is none.
+        """
+        record = self.events.get(fid)
+        return record[0][-1] if record else None
+
+    def pop_ready(self, now=None, limit=None):
+        """Remove and return the events which should be handled now, as
+        (fid, cmd, args) tuples. At most `limit` events are returned if
+        it is given, the oldest first.
+
+        The events of a file are returned in order.
+        """
+        if now is None:
+            now = time.time()
+
+        events = []
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            if limit is not None and len(events) >= limit:
+                break
+
+            deadline, fid = heapq.heappop(self.deadlines)
+            record = self.events.get(fid)
+
+            if record is None or record[3] != deadline:
+                continue
+
+            while record[0]:
+                if limit is not None and len(events) >= limit:
+                    # The next events of the file stay at the top
+                    heapq.heappush(self.deadlines, (deadline, fid))
+                    return events
+
+                cmd, args = record[0].pop(0)
+                if cmd == MOV:
+                    self.moves.pop(args[0], None)
+                events.append((fid, cmd, args))
+
+            del self.events[fid]
+
+        return events
+
+    def timeout(self, now=None):
+        """Return the number of seconds until the next event is ready, or
+        `None` if the queue is empty.
+        """
+        while self.deadlines:
+            deadline, fid = self.deadlines[0]
+            record = self.events.get(fid)
+
+            if record is not None and record[3] == deadline:
+                if now is None:
+                    now = time.time()
+                return max(deadline - now, 0)
+
+            heapq.heappop(self.deadlines)
+
+        return None
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'pending': len(self.events),
+        }
+
+    def _remove(self, fid):
+        """Remove the pending events of a file. Return whether there
+        were some.
+        """
+        record = self.events.pop(fid, None)
+
+        if not record:
+            return False
+
+        for cmd, args in record[0]:
+            if cmd == MOV:
+                self.moves.pop(args[0], None)
+        return True
+
+    def _schedule(self, fid, record):
+        """Update the time at which the events of the file are ready."""
+        deadline = self._deadline(record)
+
+        if deadline == record[3]:
+            return
+
+        record[3] = deadline
+        heapq.heappush(self.deadlines, (deadline, fid))
+
+        # The outdated entries are dropped when they outnumber the files
+        if len(self.deadlines) > 2 * len(self.events) + 16:
+            self.deadlines = [
+                (record[3], fid) for fid, record in self.events.items()
+            ]
+            heapq.heapify(self.deadlines)
+
+    def _deadline(self, record):
+        _, first, last, _ = record
+        return min(
+            last + self.debounce,
+            first + self.debounce * MAX_DELAY_FACTOR
+        )
@@ -23,6 +23,16 @@ class Metadata(object):
         The size of the file, in octets
     **mimetype**
         The MIME type of the file, as detected by python
+    **checksum**
+        The MD5 checksum of the content of the file, as an hexadecimal
+        string. It is optional and is `None` if the service which
+        updated the file didn't compute it. A driver computing it must
+        set it before each call to :meth:`.Plug.update_file`, otherwise
+        the checksum of the previous content is discarded
+    **partition**
+        The partition of the Referee handling the events of the file, if
+        it was moved from another file. Otherwise it is `None`, and the
+        partition is given by the id of the file
 
     Each service can also store extra informations via the :attr:`.extra`
     attribute. It's a dictionary which can contain any kind of information,
@@ -31,19 +41,29 @@ class Metadata(object):
     are stocked separately.
     """
 
-    PROPERTIES = ('filename', 'folder_name', 'size', 'mimetype')
+    PROPERTIES = (
+        'filename', 'folder_name', 'size', 'mimetype', 'checksum', 'partition'
+    )
 
     def __init__(self, plug=None, filename=None, folder=None, folder_name=None,
-                 size=0, fid=None, mimetype=None):
+                 size=0, fid=None, mimetype=None, checksum=None,
+                 partition=None):
         super(Metadata, self).__init__()
 
         self._filename = None
         self._folder_name = None
         self._size = None
+        self._checksum = None
+        # Whether the checksum was set since the metadata were loaded
+        self._checksum_set = False
 
         self.filename = filename
         self.size = size
         self.mimetype = mimetype
+        self.checksum = checksum
+        self.partition = partition
+        # The checksum currently indexed in the database
+        self._indexed_checksum = None
 
         if folder_name and not folder:
             folder = Folder.get(plug, folder_name)
@@ -85,6 +105,8 @@ class Metadata(object):
             return None
 
         metadata = cls(plug, fid=fid, **values)
+        metadata._indexed_checksum = metadata.checksum
+        metadata._checksum_set = False
 
         metadata.extra = plug.escalator.get(
             u'file:{}:service:{}'.format(fid, plug.name),
@@ -126,6 +148,22 @@ class Metadata(object):
         else:
             self._size = int(value)
 
+    @property
+    def checksum(self):
+        return self._checksum
+
+    @checksum.setter
+    def checksum(self, value):
+        self._checksum = value
+        self._checksum_set = True
+
+    @property
+    def checksum_is_fresh(self):
+        """Whether the checksum was set since the metadata were loaded
+        from the database, and so describes the current content.
+        """
+        return self._checksum_set
+
     @property
     def path(self):
         if not self._path:
@@ -187,6 +225,34 @@ class Metadata(object):
                 self.extra
             )
 
+            if self._indexed_checksum != self.checksum:
+                if self._indexed_checksum:
+                    batch.delete(u'checksum:{}:{}'.format(
+                        self._indexed_checksum, self.fid
+                    ))
+                if self.checksum:
+                    batch.put(
+                        u'checksum:{}:{}'.format(self.checksum, self.fid),
+                        None
+                    )
+
+        self._indexed_checksum = self.checksum
+
+    def duplicates(self):
+        """Return the fids of the other files known to have the same
+        content than this one, according to their checksum.
+        """
+        if not self.checksum:
+            return ()
+
+        keys = self.plug.escalator.range(
+            u'checksum:{}:'.format(self.checksum), include_value=False
+        )
+        return tuple(
+            fid for fid in (key.split(':')[-1] for key in keys)
+            if fid != self.fid
+        )
+
     def clone(self, new_folder, new_filename):
         """
         Return a new Metadata object with the same properties than the current,
@@ -227,3 +293,8 @@ class Metadata(object):
             self.plug.escalator.delete(
                 u'path:{}:{}'.format(self.folder_name, self.filename)
             )
+
+            if self._indexed_checksum:
+                self.plug.escalator.delete(u'checksum:{}:{}'.format(
+                    self._indexed_checksum, self.fid
+                ))
@@ -2,10 +2,17 @@
 The Plug is the part of any driver that communicates with the rest of
 Onitu. This part is common between all the drivers.
 """
+import time
+import uuid
+import inspect
 import threading
 
 import zmq
 
+from concurrent import futures
+
+from tornado import gen
+from tornado.concurrent import chain_future
 from logbook import Logger
 
 from .metadata import Metadata
@@ -14,9 +21,19 @@ from .dealer import Dealer
 from .folder import Folder
 from .exceptions import DriverError, AbortOperation
 
-from onitu.escalator.client import Escalator
-from onitu.utils import get_events_uri, log_traceback
-from onitu.referee import UP, DEL, MOV
+from onitu.escalator.client import Escalator, Log
+from onitu.utils import get_referee_uri, get_partition
+from onitu.utils import log_traceback, TokenBucket, Budget
+from onitu.referee import UP, DEL, MOV, MOV_DIR, DEL_DIR
+
+# The interval at which a call waiting for a coroutine handler checks
+# whether it should be aborted, in seconds
+ABORT_INTERVAL = 0.1
+
+# Native coroutines only exist in Python 3
+iscoroutinefunction = getattr(
+    inspect, 'iscoroutinefunction', lambda func: False
+)
 
 
 class Plug(object):
@@ -41,13 +58,37 @@ class Plug(object):
         self.logger = None
         self.router = None
         self.dealer = None
-        self.publisher = None
+        # A socket to wake up each partition of the Referee, and the
+        # log of the events sent to it
+        self.publishers = []
+        self.logs = []
         self.publisher_lock = threading.Lock()
+        # The sequence number of the last event sent to the Referee
+        self.sequence = 0
         self.escalator = None
+        # The database of the queues and of the progress of the transfers
+        self.queues = None
         self.options = {}
         self._handlers = {}
         self._service_db = None
 
+        # Limit the number of bytes per second written to the service
+        # and read from it
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
+
+        # Limit the number of transfers in progress, and the number of
+        # bytes held in memory by the transfers to the service and from
+        # it. They are separated so two services waiting for each other
+        # cannot exhaust the same budget.
+        self.transfers = Budget()
+        self.upload_buffers = Budget()
+        self.download_buffers = Budget()
+        # The global limit on the number of transfers between all the
+        # services, and the number of transfers of the other services
+        self.global_transfers = 0
+        self.other_transfers = 0
+
         self.context = zmq.Context.instance()
 
     def initialize(self, name, session, manifest):
@@ -59,15 +100,31 @@ class Plug(object):
         self.name = name
         self.session = session
         self.escalator = Escalator(session)
+        self.queues = Escalator.queues(session)
         self.logger = Logger(self.name)
-        self.publisher = self.context.socket(zmq.PUSH)
-        self.publisher.connect(get_events_uri(session, 'referee'))
+
+        partitions = self.escalator.get('referee:partitions', default=1)
+        for partition in range(partitions):
+            publisher = self.context.socket(zmq.PUSH)
+            publisher.connect(get_referee_uri(session, partition))
+            self.publishers.append(publisher)
+            self.logs.append(Log(
+                self.queues, u'referee:{}:log:{}:'.format(partition, name)
+            ))
+
+        self.sequence = self.queues.get(
+            u'service:{}:sequence'.format(name), default=0
+        )
+        # The statistics of the queue used to be in the metadata
+        self.escalator.delete(u'service:{}:events'.format(name))
 
         options = self.escalator.get(
             u'service:{}:options'.format(name), default={}
         )
         self.validate_options(manifest, options)
         self.options = options
+        self.refresh_rates(options)
+        self.refresh_budgets(options)
 
         self.escalator.put(u'service:{}:options'.format(name), options)
         self.escalator.put(u'drivers:{}:manifest'.format(name), manifest)
@@ -142,9 +199,33 @@ class Plug(object):
 
         # If the file is being uploaded, we stop it
         self.dealer.stop_transfer(fid)
+        # The chunks read in advance are not valid anymore
+        self.router.invalidate(fid)
         # We make sure that the key has been deleted
         # (if this event occurs before the transfer was restarted)
-        self.escalator.delete(u'service:{}:transfer:{}'.format(self.name, fid))
+        self.queues.delete(u'service:{}:transfer:{}'.format(self.name, fid))
+        # The signature of the blocks of the file is not valid anymore
+        self.escalator.delete(
+            u'service:{}:signature:{}'.format(self.name, fid)
+        )
+
+        # A checksum left from the previous content must not be trusted
+        # nor written back
+        if not metadata.checksum_is_fresh:
+            metadata.checksum = None
+
+        if self.has_same_content(metadata):
+            # The file already has the content known by Onitu (e.g. it was
+            # there before the service was added), so there is nothing to
+            # transfer
+            metadata.set_uptodate()
+            metadata.write()
+
+            self.logger.debug(
+                "'{}' in folder {} is already up-to-date",
+                metadata.filename, metadata.folder
+            )
+            return
 
         metadata.set_uptodate(reset=True)
         metadata.write()
@@ -153,7 +234,28 @@ class Plug(object):
             "Notifying the Referee about '{}' in folder {}",
             metadata.filename, metadata.folder
         )
-        self.notify_referee(fid, UP, self.name)
+        self.notify_referee(self.partition(metadata), fid, UP, self.name)
+
+    def has_same_content(self, metadata):
+        """Return whether the content described by the given metadata is
+        the same than the one of the up-to-date copies of the file, by
+        comparing their size and checksum. Only a checksum computed by
+        the driver for this update is taken into account.
+        """
+        if not metadata.checksum or not metadata.checksum_is_fresh:
+            return False
+
+        values = self.escalator.get(
+            u'file:{}'.format(metadata.fid), default=None
+        )
+
+        if not values or values.get('checksum') != metadata.checksum:
+            return False
+
+        if values['size'] != metadata.size:
+            return False
+
+        return bool(metadata.uptodate_services)
 
     def delete_file(self, metadata):
         if not metadata.is_uptodate:
@@ -164,7 +266,13 @@ class Plug(object):
             return
 
         metadata.delete()
-        self.notify_referee(metadata.fid, DEL, self.name)
+        self.router.invalidate(metadata.fid)
+        self.escalator.delete(
+            u'service:{}:signature:{}'.format(self.name, metadata.fid)
+        )
+        self.notify_referee(
+            self.partition(metadata), metadata.fid, DEL, self.name
+        )
 
     def move_file(self, metadata, new_path):
         if not metadata.is_uptodate:
@@ -182,15 +290,121 @@ class Plug(object):
 
         new_filename = new_folder.relpath(new_path)
         new_metadata = metadata.clone(new_folder, new_filename)
+        # The events of the new file go through the same partition than
+        # the move, so they cannot overtake it
+        partition = self.partition(metadata)
+        new_metadata.partition = partition
         new_metadata.set_uptodate(reset=True)
         new_metadata.write()
 
         metadata.delete()
+        self.router.invalidate(metadata.fid)
+        self.move_signature(metadata.fid, new_metadata.fid)
 
-        self.notify_referee(metadata.fid, MOV, self.name, new_metadata.fid)
+        self.notify_referee(
+            partition, metadata.fid, MOV, self.name, new_metadata.fid
+        )
 
         return new_metadata
 
+    def move_directory(self, folder, old_path, new_path):
+        """Move all the files of a directory of the folder, and notify
+        the Referee with a single event instead of one per file.
+
+        The paths are relative to the folder. Return the new metadata
+        of the files moved.
+        """
+        old_prefix = old_path.rstrip(u'/') + u'/'
+        new_prefix = new_path.rstrip(u'/') + u'/'
+
+        pairs = []
+        partitions = []
+        moved = []
+
+        for filename, fid in self.list(folder.name, old_prefix).items():
+            metadata = Metadata.get_by_id(self, fid)
+            if not metadata:
+                continue
+
+            new_metadata = metadata.clone(folder, new_prefix + filename)
+            new_metadata.partition = self.partition(metadata)
+            new_metadata.set_uptodate(reset=True)
+            new_metadata.write()
+
+            metadata.delete()
+            self.router.invalidate(metadata.fid)
+            self.move_signature(metadata.fid, new_metadata.fid)
+
+            pairs.append((metadata.fid, new_metadata.fid))
+            partitions.append(new_metadata.partition)
+            moved.append(new_metadata)
+
+        if len(set(partitions)) == 1:
+            self.notify_referee(
+                partitions[0], str(uuid.uuid4()), MOV_DIR, self.name,
+                folder.name, old_prefix, new_prefix, pairs
+            )
+        else:
+            # A single event would not be ordered with the events of the
+            # files handled by the other partitions
+            for (old_fid, new_fid), partition in zip(pairs, partitions):
+                self.notify_referee(
+                    partition, old_fid, MOV, self.name, new_fid
+                )
+
+        return moved
+
+    def delete_directory(self, folder, path):
+        """Delete all the files of a directory of the folder, and notify
+        the Referee with a single event instead of one per file.
+
+        The path is relative to the folder.
+        """
+        prefix = path.rstrip(u'/') + u'/'
+
+        fids = []
+        partitions = []
+
+        for fid in self.list(folder.name, prefix).values():
+            metadata = Metadata.get_by_id(self, fid)
+            if not metadata:
+                continue
+
+            metadata.delete()
+            self.router.invalidate(fid)
+            self.escalator.delete(
+                u'service:{}:signature:{}'.format(self.name, fid)
+            )
+
+            fids.append(fid)
+            partitions.append(self.partition(metadata))
+
+        if len(set(partitions)) == 1:
+            self.notify_referee(
+                partitions[0], str(uuid.uuid4()), DEL_DIR, self.name,
+                folder.name, prefix, fids
+            )
+        else:
+            for fid, partition in zip(fids, partitions):
+                self.notify_referee(partition, fid, DEL, self.name)
+
+    def move_signature(self, old_fid, new_fid):
+        """Keep the signature of the blocks of a file after it has been
+        moved, so the next update can still be transferred as a delta.
+        """
+        old_key = u'service:{}:signature:{}'.format(self.name, old_fid)
+        signature = self.escalator.get(old_key, default=None)
+
+        if not signature:
+            return
+
+        with self.escalator.write_batch() as batch:
+            batch.put(
+                u'service:{}:signature:{}'.format(self.name, new_fid),
+                signature
+            )
+            batch.delete(old_key)
+
     def get_folder(self, filename):
         for folder in self.folders.values():
             if folder.contains(filename):
@@ -272,6 +486,50 @@ class Plug(object):
             'velocity': {
                 'type': 'float',
                 'default': manifest.get('velocity', 0.5)
+            },
+            'compute_checksum': {
+                'type': 'boolean',
+                'default': False
+            },
+            'compression': {
+                'type': 'boolean',
+                'default': False
+            },
+            'max_upload_rate': {
+                'type': 'integer',
+                'default': 0  # bytes per second, 0 means unlimited
+            },
+            'max_download_rate': {
+                'type': 'integer',
+                'default': 0
+            },
+            'direct_transfers': {
+                'type': 'boolean',
+                'default': False
+            },
+            'prefetch_chunks': {
+                'type': 'integer',
+                'default': 2
+            },
+            'prefetch_memory': {
+                'type': 'integer',
+                'default': 16 << 20  # 16 MB
+            },
+            'max_threads': {
+                'type': 'integer',
+                'default': 0  # depends on the number of CPUs
+            },
+            'event_debounce': {
+                'type': 'float',
+                'default': 0.5  # seconds
+            },
+            'max_transfers': {
+                'type': 'integer',
+                'default': 0  # 0 means unlimited
+            },
+            'max_buffered': {
+                'type': 'integer',
+                'default': 0  # bytes, 0 means unlimited
             }
         })
 
@@ -314,32 +572,175 @@ class Plug(object):
                         "configuration.".format(name)
                     )
 
+    def refresh_rates(self, options=None):
+        """Update the maximum upload and download rates of the service.
+
+        If the options are not given, they are read from the database,
+        so the rates can be changed while the service is running. This
+        method is called periodically by the :class:`.Router`.
+        """
+        if options is None:
+            options = self.escalator.get(
+                u'service:{}:options'.format(self.name), default={}
+            )
+
+        for name, bucket in (('max_upload_rate', self.upload_bucket),
+                             ('max_download_rate', self.download_bucket)):
+            rate = options.get(name, 0)
+            self.options[name] = rate
+            bucket.rate = rate
+
+    def refresh_budgets(self, options=None):
+        """Update the limits on the transfers and on the memory used by
+        the service, and publish their usage. The usage of the other
+        services is read to respect the global limit on the number of
+        transfers.
+
+        This method is called periodically by the :class:`.Router`, like
+        :meth:`.refresh_rates`.
+        """
+        if options is None:
+            options = self.escalator.get(
+                u'service:{}:options'.format(self.name), default={}
+            )
+
+        self.options['max_transfers'] = options.get('max_transfers', 0)
+        self.options['max_buffered'] = options.get('max_buffered', 0)
+        self.transfers.limit = self.options['max_transfers']
+        self.upload_buffers.limit = self.options['max_buffered']
+        self.download_buffers.limit = self.options['max_buffered']
+
+        self.global_transfers = self.escalator.get(
+            'options', default={}
+        ).get('max_transfers', 0)
+
+        if self.global_transfers:
+            others = [
+                name for name in self.escalator.get('services', default=[])
+                if name != self.name
+            ]
+            self.other_transfers = sum(
+                usage['transfers']['used'] for usage in
+                self.queues.multi_get(
+                    u'service:{}:usage'.format(name) for name in others
+                )
+                if usage
+            )
+
+        self.queues.put(
+            u'service:{}:usage'.format(self.name), self.usage()
+        )
+
+    def usage(self):
+        """Return the number of transfers in progress and of bytes held
+        in memory by the service, with their limits.
+        """
+        return {
+            'transfers': self.transfers.stats(),
+            'upload_buffers': self.upload_buffers.stats(),
+            'download_buffers': self.download_buffers.stats(),
+        }
+
     def call(self, handler_name, *args, **kwargs):
         """Call a handler registered by the driver.
 
         The drivers themselves should not have to call this method,
         it is only intended to be used by the Plug components.
 
+        A coroutine handler is run on the loop of the :class:`.Router`,
+        and this method waits for its result, so it must not be called
+        from this loop.
+
         :return: `None` if the handler is not defined, the return
         value of the handler otherwise.
         :raise AbortOperation: if the operation should be aborted
         """
+        return self.call_abortable(None, handler_name, *args, **kwargs)
+
+    def call_abortable(self, stop, handler_name, *args, **kwargs):
+        """Call a handler like :meth:`call`, but stop waiting for a
+        coroutine handler as soon as the `stop` event is set.
+
+        :raise AbortOperation: if the operation should be aborted, or
+        has been stopped
+        """
         handler = self._handlers.get(handler_name)
 
         if not handler:
             return None
 
+        if self.is_coroutine(handler_name):
+            future = futures.Future()
+            self.router.loop.add_callback(
+                lambda: chain_future(
+                    self.call_coroutine(handler_name, *args, **kwargs),
+                    future
+                )
+            )
+
+            if stop is None:
+                return future.result()
+
+            # The coroutine can't be interrupted, it finishes on the loop
+            # but its result is ignored
+            while True:
+                try:
+                    return future.result(timeout=ABORT_INTERVAL)
+                except futures.TimeoutError:
+                    if stop.is_set():
+                        raise AbortOperation()
+
         try:
             return handler(*args, **kwargs)
-        except DriverError as e:
+        except Exception as e:
+            raise self._abort(handler_name, e)
+
+    @gen.coroutine
+    def call_coroutine(self, handler_name, *args, **kwargs):
+        """Call a coroutine handler registered by the driver, without
+        blocking the current loop.
+
+        :raise AbortOperation: if the operation should be aborted
+        """
+        handler = self._handlers.get(handler_name)
+
+        if not handler:
+            raise gen.Return(None)
+
+        try:
+            result = yield handler(*args, **kwargs)
+        except Exception as e:
+            raise self._abort(handler_name, e)
+
+        raise gen.Return(result)
+
+    def is_coroutine(self, handler_name):
+        """
+        Return whether the given handler is a coroutine, either a native
+        one or a Tornado one.
+        """
+        handler = self._handlers.get(handler_name)
+
+        if not handler:
+            return False
+
+        return (gen.is_coroutine_function(handler) or
+                iscoroutinefunction(handler))
+
+    def _abort(self, handler_name, error):
+        if isinstance(error, AbortOperation):
+            # Raised by the iterator given to the `upload_stream` handler
+            return error
+
+        if isinstance(error, DriverError):
             self.logger.error(
                 "An error occurred during the call of '{}': {}",
-                handler_name, e
+                handler_name, error
             )
-            raise AbortOperation()
-        except Exception:
+        else:
             log_traceback(self.logger)
-            raise AbortOperation()
+
+        return AbortOperation()
 
     def has_handler(self, handler_name):
         """
@@ -347,24 +748,46 @@ class Plug(object):
         """
         return handler_name in self._handlers
 
-    def notify_referee(self, fid, *args):
-        self.escalator.put(
-            'referee:event:{}'.format(fid), args
-        )
+    def partition(self, metadata):
+        """Return the partition of the Referee handling the events of a
+        file. A file moved keeps the partition of the file it was moved
+        from, so all the events of the file are handled in order.
+        """
+        partitions = len(self.publishers)
+
+        if metadata.partition is not None and metadata.partition < partitions:
+            return metadata.partition
 
+        return get_partition(metadata.fid, partitions)
+
+    def notify_referee(self, partition, fid, *args):
         with self.publisher_lock:
-            self.publisher.send(b'')
+            self.sequence += 1
+
+            with self.queues.write_batch() as batch:
+                # The time orders the events of the different services
+                self.logs[partition].append(
+                    self.sequence, (fid, args, time.time()), batch=batch
+                )
+                batch.put(
+                    u'service:{}:sequence'.format(self.name), self.sequence
+                )
+
+            self.publishers[partition].send(b'')
 
     def close(self):
         self.call('close')
 
-        if self.publisher:
-            with self.publisher_lock:
-                self.publisher.close(linger=0)
+        with self.publisher_lock:
+            for publisher in self.publishers:
+                publisher.close(linger=0)
 
         if self.escalator:
             self.escalator.close()
 
+        if self.queues:
+            self.queues.close()
+
         if self._service_db:
             self.service_db.close()
 
@@ -1,29 +1,38 @@
+import time
 import functools
+import threading
 
 import zmq
 
 from concurrent.futures import ThreadPoolExecutor
 
-from tornado import gen
+from tornado import gen, ioloop, locks
 from logbook import Logger
-from zmq.eventloop import ioloop, zmqstream
+from zmq.eventloop import zmqstream
 
-from onitu.utils import b, get_events_uri, log_traceback, cpu_count
+from onitu.utils import b, get_events_uri, log_traceback, pool_size
 from onitu.escalator.client import EscalatorClosed
-from onitu.brocker.commands import GET_CHUNK, GET_FILE
-from onitu.brocker.responses import CHUNK, FILE, OK, ERROR
+from onitu.brocker.commands import GET_CHUNK, GET_FILE, GET_DELTA
+from onitu.brocker.responses import CHUNK, FILE, DELTA, OK, ERROR
 
+from . import delta, compression
+from .stream import FileStream
 from .metadata import Metadata
-from .exceptions import AbortOperation
+from .exceptions import AbortOperation, DriverError
 
-ioloop.install()
+# The interval between two reloads of the options which can be changed
+# while the service is running, in milliseconds
+REFRESH_INTERVAL = 5000
+
+# The number of seconds after which an unfinished stream is closed
+STREAM_TIMEOUT = 60
 
 
 class Router(object):
     """Receive and reply to requests from other drivers. This is the
     component which calls the `get_chunk` handler.
-    It uses a single thread, which means that only one call to
-    `get_chunk` can be made at a time.
+    The handlers are called in a thread pool of `max_threads` threads,
+    except the coroutines which run directly on the event loop.
     """
 
     def __init__(self, plug):
@@ -35,18 +44,55 @@ class Router(object):
         self.context = plug.context
         self.stream = None
         self.loop = None
+        self.refresher = None
+
+        # The files being sent chunk by chunk from the `get_file`
+        # handler, indexed by fid and offset of their next chunk
+        self.streams = {}
+
+        # The chunks read in advance when a file is read sequentially,
+        # indexed by fid, offset and size. The values are the revision of
+        # the file when the read started, the future of the read and its
+        # creation time
+        self.prefetched = {}
+        self.prefetched_size = 0
+        # The offset of the next chunk of each file if it is read
+        # sequentially, and the time of the last read, indexed by fid
+        # and size
+        self.next_offsets = {}
+
+        # The metadata of the files being transferred, so they are not
+        # read from the database for each chunk. The values are the
+        # revision of the file, its metadata and the time of the last use
+        self.sessions = {}
+
+        # A counter incremented each time a file changes, so the data read
+        # before can be discarded
+        self.revisions = {}
+        self.revisions_lock = threading.Lock()
+
+        # Notified when memory is released, so the requests waiting for
+        # it try again
+        self.released = None
+        plug.download_buffers.subscribe(self._buffers_released)
 
         self.handlers = {
             GET_CHUNK: self._handle_get_chunk,
             GET_FILE: self._handle_get_file,
+            GET_DELTA: self._handle_get_delta,
         }
 
     def run(self):
         try:
-            self.loop = ioloop.IOLoop.instance()
-            # We create a thread pool with a *lot* of threads because
-            # they will block on IO bound stuff
-            self.pool = ThreadPoolExecutor(cpu_count() * 3)
+            # Each thread needs its own loop, as the Router shares its
+            # process with the other components of the Plug
+            self.loop = ioloop.IOLoop()
+            self.released = locks.Condition()
+            # The threads block on IO bound stuff, but the coroutine
+            # handlers do not need them
+            self.pool = ThreadPoolExecutor(
+                pool_size(self.plug.options.get('max_threads'))
+            )
 
             uri = get_events_uri(self.plug.session, self.name, 'router')
             router = self.context.socket(zmq.ROUTER)
@@ -55,6 +101,11 @@ class Router(object):
             self.stream = zmqstream.ZMQStream(router, self.loop)
             self.stream.on_recv(self.handle)
 
+            self.refresher = ioloop.PeriodicCallback(
+                self.refresh, REFRESH_INTERVAL
+            )
+            self.refresher.start()
+
             self.logger.info("Started")
 
             self.loop.start()
@@ -63,9 +114,25 @@ class Router(object):
         except Exception:
             log_traceback(self.logger)
         finally:
+            if self.refresher:
+                self.refresher.stop()
+
             if self.stream:
                 self.stream.close()
 
+            for stream in self.streams.values():
+                stream.close()
+
+    def refresh(self):
+        try:
+            self.close_idle_streams()
+            self.plug.refresh_rates()
+            self.plug.refresh_budgets()
+        except EscalatorClosed:
+            self.loop.stop()
+        except Exception:
+            log_traceback(self.logger)
+
     def handle(self, msg):
         try:
             identity, cmd, fid = msg[:3]
@@ -76,16 +143,22 @@ class Router(object):
             if not handler:
                 raise RuntimeError("Received an unknown command")
 
-            metadata = Metadata.get_by_id(self.plug, fid.decode())
+            # The metadata are read again at the beginning of a transfer
+            refresh = cmd != GET_CHUNK or not args or args[0] == b'0'
+            metadata = self.get_metadata(fid.decode(), refresh)
 
             if not metadata:
                 raise RuntimeError(
                     "Cannot get metadata for fid {}".format(fid)
                 )
 
+            # The content of the reply is held in memory until it is
+            # sent, so the request waits until it fits in the budget
+            size = self.buffered_size(cmd, metadata, args)
+
             self.loop.add_future(
-                handler(metadata, *args),
-                functools.partial(self.reply, identity)
+                self.admit(size, handler, metadata, *args),
+                functools.partial(self.reply, identity, size)
             )
         except EscalatorClosed:
             self.loop.stop()
@@ -94,13 +167,45 @@ class Router(object):
         except Exception:
             log_traceback(self.logger)
 
-    def reply(self, identity, future):
+    @gen.coroutine
+    def admit(self, size, handler, metadata, *args):
+        while size and not self.plug.download_buffers.try_acquire(size):
+            yield self.released.wait()
+
+        result = yield handler(metadata, *args)
+        raise gen.Return(result)
+
+    def buffered_size(self, cmd, metadata, args):
+        """Return the number of bytes held in memory to reply to a
+        request.
+        """
+        try:
+            if cmd == GET_CHUNK:
+                offset, size = int(args[0].decode()), int(args[1].decode())
+                # A chunk read in advance is already in the budget
+                if (metadata.fid, offset, size) in self.prefetched:
+                    return 0
+                return size
+            elif cmd == GET_DELTA:
+                # The blocks are read one by one
+                return int(args[0].decode())
+        except (IndexError, ValueError):
+            return 0
+
+        return metadata.size
+
+    def reply(self, identity, size, future):
         try:
             if future.exception():
                 self.stream.send_multipart([identity] + [ERROR])
                 raise future.exception()
 
-            self.stream.send_multipart([identity] + future.result() or [OK])
+            # The content returned by the driver is sent without being
+            # copied, so it can be any object supporting the buffer
+            # protocol
+            self.stream.send_multipart(
+                [identity] + future.result() or [OK], copy=False
+            )
         except AbortOperation:
             pass
         except zmq.ZMQError as e:
@@ -112,14 +217,173 @@ class Router(object):
             self.loop.stop()
         except Exception:
             log_traceback(self.logger)
+        finally:
+            self.plug.download_buffers.release(size)
 
     @gen.coroutine
-    def call(self, *args):
-        result = yield self.pool.submit(self.plug.call, *args)
+    def call(self, handler_name, *args):
+        if self.plug.is_coroutine(handler_name):
+            result = yield self.plug.call_coroutine(handler_name, *args)
+        else:
+            result = yield self.pool.submit(
+                self.plug.call, handler_name, *args
+            )
         raise gen.Return(result)
 
     @gen.coroutine
-    def _handle_get_chunk(self, metadata, offset, size):
+    def throttle(self, size):
+        """Waits until `size` bytes can be read from the service without
+        exceeding its maximum download rate.
+        """
+        if self.plug.download_bucket.rate:
+            yield self.pool.submit(self.plug.download_bucket.consume, size)
+
+    def close_idle_streams(self):
+        deadline = time.time() - STREAM_TIMEOUT
+
+        for key, stream in list(self.streams.items()):
+            if stream.last_access < deadline:
+                del self.streams[key]
+                stream.close()
+
+        for key, (_, _, created) in list(self.prefetched.items()):
+            if created < deadline:
+                self._drop_prefetched(key)
+
+        for key, (_, accessed) in list(self.next_offsets.items()):
+            if accessed < deadline:
+                del self.next_offsets[key]
+
+        for fid, (_, _, accessed) in list(self.sessions.items()):
+            if accessed < deadline:
+                del self.sessions[fid]
+
+    def get_metadata(self, fid, refresh=False):
+        """Return the metadata of the file, from the session of its
+        transfer if there is one.
+        """
+        revision = self.revision(fid)
+        session = self.sessions.get(fid)
+
+        if not refresh and session and session[0] == revision:
+            metadata = session[1]
+        else:
+            metadata = Metadata.get_by_id(self.plug, fid)
+
+        if metadata:
+            self.sessions[fid] = (revision, metadata, time.time())
+        else:
+            self.sessions.pop(fid, None)
+
+        return metadata
+
+    def invalidate(self, fid):
+        """Discard the content of the file read in advance. This method
+        is called by the :class:`.Plug` when the file changes, and can be
+        called from any thread.
+        """
+        with self.revisions_lock:
+            self.revisions[fid] = self.revisions.get(fid, 0) + 1
+
+        if self.loop:
+            self.loop.add_callback(self._drop_file, fid)
+
+    def _buffers_released(self):
+        # The memory can be released from any thread
+        if self.loop:
+            self.loop.add_callback(self.released.notify_all)
+
+    def revision(self, fid):
+        with self.revisions_lock:
+            return self.revisions.get(fid, 0)
+
+    def _drop_file(self, fid):
+        self.sessions.pop(fid, None)
+
+        for key in list(self.prefetched):
+            if key[0] == fid:
+                self._drop_prefetched(key)
+
+        for key in list(self.streams):
+            if key[0] == fid:
+                self.streams.pop(key).close()
+
+    def _drop_prefetched(self, key):
+        entry = self.prefetched.pop(key, None)
+        if entry:
+            self.prefetched_size -= key[2]
+            self.plug.download_buffers.release(key[2])
+        return entry
+
+    @gen.coroutine
+    def _get_chunk(self, metadata, offset, size):
+        """Return a chunk read by the `get_chunk` handler. When the file is
+        read sequentially, the next chunks are read in advance.
+        """
+        fid = metadata.fid
+        revision = self.revision(fid)
+        entry = self._drop_prefetched((fid, offset, size))
+        last = self.next_offsets.get((fid, size))
+        sequential = last is not None and last[0] == offset
+        self.next_offsets[(fid, size)] = (offset + size, time.time())
+
+        if entry or sequential:
+            self.prefetch(metadata, offset + size, size, revision)
+
+        if entry and entry[0] == revision:
+            try:
+                chunk = yield entry[1]
+            except AbortOperation:
+                chunk = None
+
+            # The file could have changed during the read
+            if chunk is not None and self.revision(fid) == revision:
+                raise gen.Return(chunk)
+
+        yield self.throttle(size)
+        chunk = yield self.call('get_chunk', metadata, offset, size)
+        raise gen.Return(chunk)
+
+    def prefetch(self, metadata, offset, size, revision):
+        """Read the chunks following the given offset in the background,
+        within the limits given by the `prefetch_chunks` and
+        `prefetch_memory` options.
+        """
+        options = self.plug.options
+
+        for index in range(options['prefetch_chunks']):
+            start = offset + index * size
+            key = (metadata.fid, start, size)
+
+            if start >= metadata.size:
+                break
+
+            if key in self.prefetched:
+                continue
+
+            if self.prefetched_size + size > options['prefetch_memory']:
+                break
+
+            # The chunks are not read in advance when the memory is
+            # needed by the requests
+            if not self.plug.download_buffers.try_acquire(size):
+                break
+
+            future = self._prefetch_chunk(metadata, start, size)
+            # The errors are raised again when the chunk is requested,
+            # the chunks dropped before must not log them
+            self.loop.add_future(future, lambda f: f.exception())
+            self.prefetched[key] = (revision, future, time.time())
+            self.prefetched_size += size
+
+    @gen.coroutine
+    def _prefetch_chunk(self, metadata, offset, size):
+        yield self.throttle(size)
+        chunk = yield self.call('get_chunk', metadata, offset, size)
+        raise gen.Return(chunk)
+
+    @gen.coroutine
+    def _handle_get_chunk(self, metadata, offset, size, codecs=b''):
         """Calls the `get_chunk` handler defined by the driver to get
         the chunk and send it to the addressee.
         """
@@ -131,28 +395,149 @@ class Router(object):
                 "Getting chunk of size {} from offset {} in '{}'",
                 size, offset, metadata.filename
             )
-            chunk = yield self.call('get_chunk', metadata, offset, size)
+            chunk = yield self._get_chunk(metadata, offset, size)
             if chunk is not None:
-                raise gen.Return([CHUNK, chunk])
+                result = yield self._content(CHUNK, metadata, chunk, codecs)
+                raise gen.Return(result)
             else:
                 raise gen.Return([ERROR])
         elif self.plug.has_handler('get_file'):
-            result = yield self._handle_get_file(metadata)
-            raise gen.Return(result)
+            yield self.throttle(size)
+            chunk = yield self._read_stream(metadata, offset, size)
+            if chunk is not None:
+                result = yield self._content(CHUNK, metadata, chunk, codecs)
+                raise gen.Return(result)
+            else:
+                raise gen.Return([ERROR])
 
     @gen.coroutine
-    def _handle_get_file(self, metadata):
+    def _read_stream(self, metadata, offset, size):
+        """Reads a chunk from the content returned by the `get_file`
+        handler. The stream is kept open until the last chunk is read,
+        so the next request can continue from there.
+        """
+        revision = self.revision(metadata.fid)
+        stream = self.streams.pop((metadata.fid, offset), None)
+
+        if stream and stream.revision != revision:
+            # The file changed since the beginning of the stream
+            stream.close()
+            stream = None
+
+        if not stream:
+            self.logger.debug(
+                "Streaming file '{}' from offset {}", metadata.filename, offset
+            )
+            content = yield self.call('get_file', metadata)
+            if content is None:
+                raise gen.Return(None)
+
+            stream = FileStream(content, revision)
+
+            if offset:
+                yield self.pool.submit(self._read, stream, size, offset)
+
+        chunk = yield self.pool.submit(self._read, stream, size)
+
+        if chunk and stream.offset < metadata.size:
+            key = (metadata.fid, stream.offset)
+            if key in self.streams:
+                self.streams.pop(key).close()
+            self.streams[key] = stream
+        else:
+            stream.close()
+
+        raise gen.Return(chunk)
+
+    def _read(self, stream, size, skip=None):
+        """Reads the next chunk of a stream, or skips its content until
+        the given offset. The errors raised by the driver while reading
+        are handled like in :meth:`.Plug.call`.
+        """
+        try:
+            if skip is not None:
+                return stream.skip(skip, size)
+            return stream.read(size)
+        except DriverError as e:
+            stream.close()
+            self.logger.error(
+                "An error occurred while reading the file: {}", e
+            )
+            raise AbortOperation()
+        except Exception:
+            stream.close()
+            log_traceback(self.logger)
+            raise AbortOperation()
+
+    @gen.coroutine
+    def _handle_get_file(self, metadata, codecs=b''):
         if self.plug.has_handler('get_file'):
             self.logger.debug(
                 "Getting file '{}'", metadata.filename
             )
+            yield self.throttle(metadata.size)
             content = yield self.call('get_file', metadata)
             if content is not None:
-                raise gen.Return([FILE, content])
+                result = yield self._content(FILE, metadata, content, codecs)
+                raise gen.Return(result)
             else:
                 raise gen.Return([ERROR])
         elif self.plug.has_handler('get_chunk'):
             result = yield self._handle_get_chunk(
-                metadata, b'0', b(str(metadata.size))
+                metadata, b'0', b(str(metadata.size)), codecs
             )
             raise gen.Return(result)
+
+    @gen.coroutine
+    def _content(self, kind, metadata, content, codecs):
+        """Compresses the content with one of the codecs accepted by the
+        addressee, unless it is not worth it. The codec used is sent
+        after the content.
+        """
+        if not codecs or compression.is_compressed(metadata.mimetype):
+            raise gen.Return([kind, content])
+
+        codec = compression.choose(codecs)
+
+        if not codec:
+            raise gen.Return([kind, content])
+
+        compressed = yield self.pool.submit(
+            compression.compress, codec, content
+        )
+
+        if len(compressed) >= len(content):
+            raise gen.Return([kind, content])
+
+        raise gen.Return([kind, compressed, codec])
+
+    @gen.coroutine
+    def _handle_get_delta(self, metadata, block_size, signature):
+        """Compares each block of the file with the signature of the
+        addressee's copy, and replies with the offsets of the blocks
+        which changed.
+        """
+        if not self.plug.has_handler('get_chunk'):
+            raise gen.Return([ERROR])
+
+        block_size = int(block_size.decode())
+        signature = delta.unpack(signature)
+
+        self.logger.debug(
+            "Computing the delta of '{}' with blocks of size {}",
+            metadata.filename, block_size
+        )
+
+        offsets = []
+
+        for offset in range(0, metadata.size, block_size):
+            yield self.throttle(block_size)
+            block = yield self.call('get_chunk', metadata, offset, block_size)
+
+            if block is None:
+                raise gen.Return([ERROR])
+
+            if delta.block_changed(signature, offset // block_size, block):
+                offsets.append(offset)
+
+        raise gen.Return([DELTA, delta.pack(offsets)])
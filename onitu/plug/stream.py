@@ -0,0 +1,68 @@
+"""
+This module allows the :class:`.Router` to send the content of a file
+chunk by chunk when the driver only defines the `get_file` handler.
+
+The `get_file` handler can either return the whole content of the file
+or an iterator over its content, yielding parts of any size. The
+:class:`FileStream` regroups those parts in chunks of the size requested
+by the addressee, so only one chunk is held in memory at a time when the
+driver returns an iterator.
+
+The content and its parts can be any object supporting the buffer
+protocol. The chunks are views on those parts, and are only copied when
+a chunk spans several parts.
+"""
+import time
+import mmap
+
+
+class FileStream(object):
+    def __init__(self, content, revision=None):
+        if isinstance(content, (bytes, bytearray, memoryview, mmap.mmap)):
+            content = (content,)
+
+        self._parts = iter(content)
+        self._buffer = memoryview(b'')
+        self._position = 0
+
+        # The offset of the next chunk in the file
+        self.offset = 0
+        # The version of the file being read
+        self.revision = revision
+        self.last_access = time.time()
+
+    def read(self, size):
+        """Return the next chunk of the file, which can be smaller than
+        `size` at the end of the file.
+        """
+        self.last_access = time.time()
+
+        while len(self._buffer) - self._position < size:
+            try:
+                part = next(self._parts)
+            except StopIteration:
+                break
+
+            if self._position < len(self._buffer):
+                part = self._buffer[self._position:].tobytes() + part
+
+            self._buffer = memoryview(part)
+            self._position = 0
+
+        chunk = self._buffer[self._position:self._position + size]
+        self._position += len(chunk)
+        self.offset += len(chunk)
+
+        return chunk
+
+    def skip(self, offset, size):
+        """Drop the content until the given offset, by chunks of the
+        given size.
+        """
+        while self.offset < offset:
+            if not self.read(min(size, offset - self.offset)):
+                break
+
+    def close(self):
+        if hasattr(self._parts, 'close'):
+            self._parts.close()
@@ -1,16 +1,110 @@
-from threading import Event
+import functools
+from threading import Event, Lock
 
 import zmq
 
-from onitu.referee import UP, DEL, MOV
-from onitu.utils import get_brocker_uri, log_traceback
-from onitu.brocker.commands import GET_CHUNK, GET_FILE
+from onitu.referee import UP, DEL, MOV, MOV_DIR, DEL_DIR
+from onitu.utils import get_brocker_uri, get_events_uri, log_traceback
+from onitu.brocker.commands import GET_CHUNK, GET_DELTA, GET_SOURCES
 from onitu.brocker.responses import ERROR
 from onitu.escalator.client import EscalatorClosed
 
+from . import delta, compression
 from .metadata import Metadata
 from .exceptions import AbortOperation
 
+# The interval at which a worker waiting for a reply checks whether its
+# transfer has been stopped, in milliseconds
+POLL_INTERVAL = 100
+
+
+def receive(socket, stop, copy=True):
+    """Wait for a reply on the socket, and raise :class:`.AbortOperation`
+    as soon as the `stop` event is set.
+    """
+    while not socket.poll(POLL_INTERVAL):
+        if stop.is_set():
+            raise AbortOperation()
+
+    return socket.recv_multipart(copy=copy)
+
+
+def is_error(resp):
+    if not resp:
+        return True
+
+    status = resp[0]
+    if isinstance(status, zmq.Frame):
+        status = status.bytes
+
+    return status == ERROR
+
+
+class BrockerChannel(object):
+    """Send the requests of a worker to the Brocker, which forwards
+    each of them to the best source available.
+    """
+
+    def __init__(self, context, session, stop):
+        self.stop = stop
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.connect(get_brocker_uri(session))
+
+    def request(self, frames, copy=True):
+        self.socket.send_multipart(frames)
+        return receive(self.socket, self.stop, copy=copy)
+
+    def close(self):
+        self.socket.close()
+
+
+class DirectChannel(object):
+    """Send the requests of a worker directly to the Router of a
+    source, without going through the Brocker. When the source replies
+    with an error, the next source is used.
+    """
+
+    def __init__(self, context, session, stop, sources, logger):
+        self.context = context
+        self.session = session
+        self.stop = stop
+        self.sources = list(sources)
+        self.logger = logger
+        self.socket = None
+
+        self.connect()
+
+    def connect(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+        if not self.sources:
+            return
+
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect(
+            get_events_uri(self.session, self.sources[0], 'router')
+        )
+
+    def request(self, frames, copy=True):
+        while self.socket:
+            self.socket.send_multipart(frames)
+            resp = receive(self.socket, self.stop, copy=copy)
+
+            if not is_error(resp):
+                return resp
+
+            self.logger.debug("Error with source {}", self.sources.pop(0))
+            self.connect()
+
+        self.logger.debug("No more source available.")
+        return [ERROR]
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+
 
 class Worker(object):
     def __init__(self, dealer, fid):
@@ -19,41 +113,126 @@ class Worker(object):
         self.dealer = dealer
         self.fid = fid
         self.logger = dealer.logger
-        self.call = dealer.plug.call
         self.session = dealer.plug.session
         self._stop = Event()
+        # The calls to the handlers are aborted when the worker is stopped
+        self.call = functools.partial(dealer.plug.call_abortable, self._stop)
+        # Held while the result of the operation is written, so it
+        # cannot be stopped halfway
+        self._commit = Lock()
+        # The files affected by the operation
+        self.fids = [fid]
+        # The results of the previous operations on the same files, which
+        # must be finished before this one starts
+        self.previous = []
+        # The number of bytes held in memory, within the budget of the
+        # service
+        self.held = 0
+        # Whether the worker holds one of the transfers of the service,
+        # which is only the case of the workers started by the Dealer
+        self.admitted = False
 
         self.context = zmq.Context()
 
-        # Each worker use its own client in order to avoid locking
+        # Each worker use its own clients in order to avoid locking
         self.escalator = self.dealer.escalator.clone(context=self.context)
+        self.queues = self.dealer.queues.clone(context=self.context)
 
     def __call__(self):
         try:
-            self.metadata = Metadata.get_by_id(self.dealer.plug, self.fid)
+            # The previous workers have been stopped, but they may still
+            # be aborting their transfer
+            for result in self.previous:
+                result.wait()
+            self.previous = []
 
-            if not self.metadata:
+            if self._stop.is_set():
                 return
 
-            self.filename = self.metadata.filename
-
-            self.do()
+            if self.load():
+                self.do()
         except Exception:
             log_traceback(self.logger)
         except EscalatorClosed:
             pass
         finally:
+            self.release()
+            if self.admitted:
+                self.dealer.plug.transfers.release()
             self.escalator.close()
+            self.queues.close()
             self.context.destroy()
 
-            if self.fid in self.dealer.in_progress:
-                self.dealer.in_progress.pop(self.fid)
+            # A new worker could have been started on the same files
+            for fid in self.fids:
+                if self.dealer.in_progress.get(fid, (None,))[0] is self:
+                    self.dealer.in_progress.pop(fid, None)
+
+    def load(self):
+        """Read the metadata of the file. Return whether the operation
+        should be done.
+        """
+        self.metadata = Metadata.get_by_id(self.dealer.plug, self.fid)
+
+        if not self.metadata:
+            return False
+
+        self.filename = self.metadata.filename
+
+        # The file is about to change, so the Router should not send
+        # the content it read in advance
+        self.dealer.plug.router.invalidate(self.fid)
+        return True
 
     def do(self):
         raise NotImplementedError()
 
-    def stop(self):
-        self._stop.set()
+    def stop(self, fid=None):
+        """Ask the worker to stop. This method does not wait for the
+        transfer to be aborted, but only for the end of the commit of
+        its result if it already began.
+
+        `fid` is the file which caused the stop, if there is one.
+        """
+        with self._commit:
+            self._stop.set()
+
+    def throttle(self, size):
+        """Wait until `size` bytes can be written to the service, and
+        raise :class:`.AbortOperation` if the worker is stopped meanwhile.
+        """
+        self.dealer.plug.upload_bucket.consume(size, self._stop)
+
+        if self._stop.is_set():
+            raise AbortOperation()
+
+    def save_progress(self, key, value):
+        """Write the progress of the operation, unless the worker has
+        been stopped. The stop waits for the write, so the key can be
+        safely deleted once the worker is stopped.
+        """
+        with self._commit:
+            if self._stop.is_set():
+                raise AbortOperation()
+
+            self.queues.put(key, value)
+
+    def hold(self, size):
+        """Wait until `size` more bytes can be held in memory, and raise
+        :class:`.AbortOperation` if the worker is stopped meanwhile.
+        """
+        if not self.dealer.plug.upload_buffers.acquire(size, self._stop):
+            raise AbortOperation()
+
+        self.held += size
+
+    def release(self, size=None):
+        """Release `size` bytes held in memory, or all of them."""
+        if size is None:
+            size = self.held
+
+        self.dealer.plug.upload_buffers.release(size)
+        self.held -= size
 
 
 class TransferWorker(Worker):
@@ -73,104 +252,360 @@ class TransferWorker(Worker):
 
         self.transfer_key = (u'service:{}:transfer:{}'
                              .format(self.dealer.name, self.fid))
+        self.signature_key = (u'service:{}:signature:{}'
+                              .format(self.dealer.name, self.fid))
+
+        # The signature of each block received, if the driver is able
+        # to patch its files during the next transfers
+        self.blocks = None
+        self.patch = False
+
+        if self.dealer.plug.options['compression']:
+            self.codecs = (compression.available(),)
+        else:
+            self.codecs = ()
+
+        # The number of bytes received, and their size once decompressed
+        self.received = 0
+        self.decompressed = 0
 
     def do(self):
+        if self.metadata.is_uptodate:
+            # The file has been reconciled with our copy since the
+            # event was sent
+            self.queues.delete(self.transfer_key)
+            self.logger.debug("'{}' is already up-to-date", self.filename)
+            return
+
+        if self.copy_duplicate():
+            return
+
         success = False
-        dealer = None
+        channel = None
 
         try:
+            channel = self.connect()
+
+            offsets = self.get_delta(channel)
+            self.patch = offsets is not None
+
             self.start_transfer()
-            dealer = self.context.socket(zmq.DEALER)
-            dealer.connect(get_brocker_uri(self.session))
 
-            if self.metadata.size < self.chunk_size * 2:
-                self.get_file_oneshot(dealer)
+            if self.patch:
+                self.patch_file(channel, offsets)
+            elif (self.metadata.size >= self.chunk_size * 2 and
+                    self.dealer.plug.has_handler('upload_chunk')):
+                self.get_file_multipart(channel)
+            elif self.dealer.plug.has_handler('upload_stream'):
+                self.get_file_stream(channel)
             else:
-                if self.dealer.plug.has_handler('upload_chunk'):
-                    self.get_file_multipart(dealer)
-                else:
-                    self.get_file_oneshot(dealer)
+                self.get_file_oneshot(channel)
         except AbortOperation:
             pass
         else:
             success = True
         finally:
-            if dealer:
-                dealer.close()
+            if channel:
+                channel.close()
 
         self.end_transfer(success)
 
+    def connect(self):
+        """Return the channel used to get the content of the file.
+
+        With the `direct_transfers` option, the Brocker only gives the
+        list of the sources, and the chunks are directly requested from
+        their Router.
+        """
+        brocker = BrockerChannel(self.context, self.session, self._stop)
+
+        if not self.dealer.plug.options['direct_transfers']:
+            return brocker
+
+        resp = brocker.request((GET_SOURCES, str(self.fid).encode()))
+
+        if is_error(resp):
+            self.logger.debug(
+                "Cannot get the sources of '{}', going through the Brocker",
+                self.filename
+            )
+            return brocker
+
+        brocker.close()
+
+        sources = [source.decode() for source in resp[1:]]
+        return DirectChannel(
+            self.context, self.session, self._stop, sources, self.logger
+        )
+
+    def copy_duplicate(self):
+        """If the service already has a file with the same content,
+        ask the driver to copy it instead of transferring the file.
+
+        Return whether the file has been copied.
+        """
+        if self.restart or not self.dealer.plug.has_handler('copy_file'):
+            return False
+
+        for fid in self.metadata.duplicates():
+            if self._stop.is_set():
+                return False
+
+            if not self.escalator.exists(
+                u'file:{}:uptodate:{}'.format(fid, self.dealer.name)
+            ):
+                continue
+
+            original = Metadata.get_by_id(self.dealer.plug, fid)
+
+            if (not original or original.checksum != self.metadata.checksum
+                    or original.size != self.metadata.size):
+                continue
+
+            self.logger.debug(
+                "Copying '{}' to '{}'", original.filename, self.filename
+            )
+
+            try:
+                self.call('copy_file', original, self.metadata)
+            except AbortOperation:
+                continue
+
+            signature = self.escalator.get(
+                u'service:{}:signature:{}'.format(self.dealer.name, fid),
+                default=None
+            )
+            if signature:
+                self.escalator.put(self.signature_key, signature)
+            else:
+                self.escalator.delete(self.signature_key)
+
+            self.metadata.set_uptodate()
+            self.metadata.write()
+
+            self.logger.info(
+                "'{}' copied from '{}' without transfer",
+                self.filename, original.filename
+            )
+            return True
+
+        return False
+
+    def get_delta(self, channel):
+        """Ask the source which blocks changed since the last transfer,
+        if the driver is able to patch its copy of the file.
+
+        Return the offsets of the blocks to transfer, or `None` if the
+        whole file should be transferred.
+        """
+        if not self.dealer.plug.has_handler('patch_chunk'):
+            return None
+
+        # The driver can patch the file during the next transfer, so we
+        # keep the signature of the blocks we receive
+        self.blocks = []
+
+        if self.restart:
+            return None
+
+        signature = self.escalator.get(self.signature_key, default=None)
+
+        if not signature or signature['block_size'] != self.chunk_size:
+            return None
+
+        resp = channel.request((
+            GET_DELTA,
+            str(self.fid).encode(),
+            str(self.chunk_size).encode(),
+            delta.pack(signature['blocks'])
+        ))
+
+        if len(resp) < 2 or is_error(resp):
+            self.logger.debug(
+                "Cannot get the delta of '{}', getting the whole file",
+                self.filename
+            )
+            return None
+
+        nb_blocks = -(-self.metadata.size // self.chunk_size)
+        self.blocks = list(signature['blocks'][:nb_blocks])
+        self.blocks.extend((None,) * (nb_blocks - len(self.blocks)))
+
+        return delta.unpack(resp[1])
+
     def start_transfer(self):
         if self.restart:
             self.call('restart_upload', self.metadata, self.offset)
 
             self.logger.info("Restarting transfer of '{}'", self.filename)
         else:
-            self.escalator.put(self.transfer_key, self.offset)
+            self.save_progress(self.transfer_key, self.offset)
+            # The content of the file is about to change, so the
+            # signature is not valid anymore
+            self.escalator.delete(self.signature_key)
 
-            self.call('start_upload', self.metadata)
+            if self.patch:
+                self.call('start_patch', self.metadata)
+            else:
+                self.call('start_upload', self.metadata)
 
             self.logger.info("Starting to get '{}'", self.filename)
 
-    def get_file_oneshot(self, dealer):
+    def get_file_oneshot(self, channel):
         self.logger.debug("Getting the content of '{}'", self.filename)
 
-        dealer.send_multipart((GET_FILE, str(self.fid).encode()))
-        resp = dealer.recv_multipart()
+        # The whole file is held in memory, so its size is taken from the
+        # budget at once
+        self.hold(self.metadata.size)
+        content = b''.join(self.iter_chunks(channel, hold=False))
 
-        if resp[0] == ERROR:
+        if self._stop.is_set():
             raise AbortOperation()
 
         self.logger.debug("Received content of file '{}'", self.filename)
 
         if self.dealer.plug.has_handler('upload_file'):
-            self.call('upload_file', self.metadata, resp[1])
+            self.call('upload_file', self.metadata, content)
         else:
-            self.call('upload_chunk', self.metadata, 0, resp[1])
+            self.call('upload_chunk', self.metadata, 0, content)
 
-    def get_file_multipart(self, dealer):
-        while self.offset < self.metadata.size:
+    def get_file_stream(self, channel):
+        self.logger.debug("Streaming the content of '{}'", self.filename)
+
+        self.call('upload_stream', self.metadata, self.iter_chunks(channel))
+
+    def iter_chunks(self, channel, hold=True):
+        """Get the content of the file chunk by chunk, so it is never
+        held in memory as a whole by the source or the Brocker.
+
+        If `hold` is true, each chunk is taken from the budget of the
+        memory until the next one is requested.
+        """
+        offset = 0
+
+        while offset < self.metadata.size:
             if self._stop.is_set():
                 raise AbortOperation()
 
-            dealer.send_multipart((
-                GET_CHUNK,
-                str(self.fid).encode(),
-                str(self.offset).encode(),
-                str(self.chunk_size).encode()
-            ))
-            resp = dealer.recv_multipart()
+            if hold:
+                self.release()
+                self.hold(self.chunk_size)
 
-            if len(resp) < 2 or resp[0] == ERROR:
-                raise AbortOperation()
+            chunk = self.get_chunk(channel, offset)
+
+            self.throttle(len(chunk))
 
-            chunk = resp[1]
+            if self.blocks is not None:
+                if offset % self.chunk_size:
+                    self.blocks = None
+                else:
+                    self.blocks.append(delta.block_signature(chunk))
 
-            if not chunk or len(chunk) == 0:
+            offset += len(chunk)
+            yield chunk
+
+    def get_file_multipart(self, channel):
+        if self.offset:
+            # We don't know the previous blocks
+            self.blocks = None
+
+        while self.offset < self.metadata.size:
+            if self._stop.is_set():
                 raise AbortOperation()
 
+            self.hold(self.chunk_size)
+            chunk = self.get_chunk(channel, self.offset)
+
+            self.throttle(len(chunk))
             self.call('upload_chunk', self.metadata, self.offset, chunk)
+            self.release(self.chunk_size)
+
+            if self.blocks is not None:
+                if self.offset % self.chunk_size:
+                    # The blocks are not aligned anymore
+                    self.blocks = None
+                else:
+                    self.blocks.append(delta.block_signature(chunk))
 
             self.offset += len(chunk)
-            self.escalator.put(self.transfer_key, self.offset)
+            self.save_progress(self.transfer_key, self.offset)
 
-    def end_transfer(self, success):
-        if self._stop.is_set():
-            # Last chance to see if the transfer should be aborted.
-            # It could happen if the stop is set after the upload of
-            # the last chunk
-            success = False
+    def patch_file(self, channel, offsets):
+        self.logger.debug(
+            "Patching {} blocks of '{}'", len(offsets), self.filename
+        )
 
-        if success:
+        for offset in offsets:
+            if self._stop.is_set():
+                raise AbortOperation()
+
+            self.hold(self.chunk_size)
+            chunk = self.get_chunk(channel, offset)
+
+            self.throttle(len(chunk))
+            self.call('patch_chunk', self.metadata, offset, chunk)
+            self.release(self.chunk_size)
+
+            self.blocks[offset // self.chunk_size] = (
+                delta.block_signature(chunk)
+            )
+
+        if None in self.blocks:
+            # The source did not send some of the new blocks
+            raise AbortOperation()
+
+    def get_chunk(self, channel, offset):
+        resp = channel.request((
+            GET_CHUNK,
+            str(self.fid).encode(),
+            str(offset).encode(),
+            str(self.chunk_size).encode()
+        ) + self.codecs, copy=False)
+
+        if len(resp) < 2 or is_error(resp):
+            raise AbortOperation()
+
+        chunk = self.get_content(resp)
+
+        if not chunk or len(chunk) == 0:
+            raise AbortOperation()
+
+        return chunk
+
+    def get_content(self, resp):
+        """Return the content of a CHUNK response, decompressed if the
+        source compressed it.
+
+        The frames are decompressed without being copied first. The
+        content is only copied once when it is not compressed, as the
+        drivers expect `bytes`.
+        """
+        frame = resp[1]
+        self.received += len(frame)
+
+        if len(resp) > 2:
+            codec = resp[2].bytes
             try:
-                self.call('end_upload', self.metadata)
-            except AbortOperation:
-                # If there is an error in this handler, we still
-                # want to abort the transfer
-                success = False
+                content = compression.decompress(codec, frame.buffer)
+            except Exception as e:
+                self.logger.error(
+                    "Cannot decompress content of '{}' with {}: {}",
+                    self.filename, codec, e
+                )
+                raise AbortOperation()
+        else:
+            content = frame.bytes
+
+        self.decompressed += len(content)
+        return content
+
+    def end_transfer(self, success):
+        if success:
+            # The worker cannot be stopped while the file is marked as
+            # up-to-date, otherwise the new metadata could be overwritten
+            with self._commit:
+                success = self.commit_transfer()
 
-        # Should not be in an elif branch as success could be set to False
-        # by the previous if
         if not success:
             try:
                 self.call('abort_upload', self.metadata)
@@ -179,15 +614,46 @@ class TransferWorker(Worker):
                 # much about it
                 pass
 
-        if success:
-            self.escalator.delete(self.transfer_key)
+            self.logger.info("Transfer of '{}' aborted", self.filename)
+            return
 
-            self.metadata.set_uptodate()
-            self.metadata.write()
+        self.logger.info("Transfer of '{}' successful", self.filename)
 
-            self.logger.info("Transfer of '{}' successful", self.filename)
-        else:
-            self.logger.info("Transfer of '{}' aborted", self.filename)
+        if self.received < self.decompressed:
+            self.logger.debug(
+                "Received {} bytes for '{}' instead of {} (ratio {:.2f})",
+                self.received, self.filename, self.decompressed,
+                float(self.decompressed) / self.received
+            )
+
+    def commit_transfer(self):
+        """Finish the upload and mark the file as up-to-date. Return
+        whether the transfer succeeded.
+        """
+        if self._stop.is_set():
+            # Last chance to see if the transfer should be aborted.
+            # It could happen if the stop is set after the upload of
+            # the last chunk
+            return False
+
+        try:
+            self.call('end_upload', self.metadata)
+        except AbortOperation:
+            # If there is an error in this handler, we still
+            # want to abort the transfer
+            return False
+
+        self.queues.delete(self.transfer_key)
+
+        if self.blocks is not None:
+            self.escalator.put(self.signature_key, {
+                'block_size': self.chunk_size,
+                'blocks': self.blocks
+            })
+
+        self.metadata.set_uptodate()
+        self.metadata.write()
+        return True
 
 
 class DeletionWorker(Worker):
@@ -195,16 +661,25 @@ class DeletionWorker(Worker):
         super(DeletionWorker, self).__init__(dealer, fid)
 
     def do(self):
-        self.logger.debug("Deleting '{}'", self.filename)
+        self.delete(self.metadata)
+
+    def delete(self, metadata):
+        self.logger.debug("Deleting '{}'", metadata.filename)
 
         try:
-            self.call('delete_file', self.metadata)
+            self.call('delete_file', metadata)
         except AbortOperation:
             pass
 
-        self.metadata.delete()
+        self.metadata_deleted(metadata)
+
+        self.logger.info("'{}' deleted", metadata.filename)
 
-        self.logger.info("'{}' deleted", self.filename)
+    def metadata_deleted(self, metadata):
+        metadata.delete()
+        self.escalator.delete(
+            u'service:{}:signature:{}'.format(self.dealer.name, metadata.fid)
+        )
 
 
 class MoveWorker(Worker):
@@ -214,36 +689,192 @@ class MoveWorker(Worker):
         self.new_fid = new_fid
 
     def do(self):
-        new_metadata = Metadata.get_by_id(self.dealer.plug, self.new_fid)
+        self.move(self.metadata, self.new_fid)
+
+    def move(self, metadata, new_fid):
+        new_metadata = Metadata.get_by_id(self.dealer.plug, new_fid)
         new_filename = new_metadata.filename
 
-        self.logger.debug("Moving '{}' to '{}'", self.filename, new_filename)
+        self.logger.debug(
+            "Moving '{}' to '{}'", metadata.filename, new_filename
+        )
 
         has_move_file = self.dealer.plug.has_handler('move_file')
 
         try:
-            if has_move_file and self.metadata.is_uptodate:
-                self.call('move_file', self.metadata, new_metadata)
-                self.metadata.delete()
+            if has_move_file and metadata.is_uptodate:
+                self.call('move_file', metadata, new_metadata)
+                metadata.delete()
                 new_metadata.set_uptodate()
+                self.dealer.plug.move_signature(metadata.fid, new_fid)
             else:
                 # If the driver doesn't have a handler for moving a file,
                 # we try to simulate it with a deletion and a transfer.
                 # We delete the file first to avoid needing twice the
                 # size during the transfer, and also for the situation
                 # where the transfer fails and has to be restarted
-                self.call('delete_file', self.metadata)
-                self.metadata.delete()
-                transfer = TransferWorker(self.dealer, self.new_fid)
+                self.call('delete_file', metadata)
+                metadata.delete()
+                self.escalator.delete(
+                    u'service:{}:signature:{}'.format(
+                        self.dealer.name, metadata.fid
+                    )
+                )
+                transfer = TransferWorker(self.dealer, new_fid)
                 transfer()
         except AbortOperation:
             pass
 
-        self.logger.info("'{}' moved to '{}'", self.filename, new_filename)
+        self.logger.info(
+            "'{}' moved to '{}'", metadata.filename, new_filename
+        )
+
+
+class DirectoryWorker(Worker):
+    """Base class of the workers handling an event on all the files of
+    a directory. The fid of the event does not belong to a file, so the
+    metadata of each file are read when needed.
+    """
+
+    def __init__(self, dealer, fid, folder_name, prefix, fids):
+        # The operations on the files are inherited from the workers of
+        # the subclasses, but not their arguments
+        Worker.__init__(self, dealer, fid)
+
+        self.folder_name = folder_name
+        self.prefix = prefix
+        self.fids.extend(fids)
+        # The files changed since the event, which are left alone
+        self.skipped = set()
+
+    def load(self):
+        self.folder = self.dealer.plug.folders.get(self.folder_name)
+
+        if not self.folder:
+            return False
+
+        self.filename = self.prefix
+
+        for fid in self.fids[1:]:
+            self.dealer.plug.router.invalidate(fid)
+        return True
+
+    def path(self, prefix):
+        """Return the path of a directory in the service."""
+        return self.folder.join(prefix.rstrip(u'/'))
+
+    def has_all_files(self):
+        """Return whether the service has exactly the files of the event
+        in the directory, in which case the driver can handle the whole
+        directory at once.
+        """
+        if self.skipped:
+            return False
+
+        files = self.dealer.plug.list(self.folder_name, self.prefix)
+        return set(files.values()) == set(self.fids[1:])
+
+    def stop(self, fid=None):
+        """Stop the operation on a file of the directory which changed,
+        or the whole operation.
+        """
+        if fid is None or fid == self.fid or fid not in self.fids:
+            return super(DirectoryWorker, self).stop(fid)
+
+        with self._commit:
+            self.skipped.add(fid)
+
+    def get_metadata(self):
+        for fid in self.fids[1:]:
+            if self._stop.is_set():
+                return
+
+            if fid in self.skipped:
+                continue
+
+            metadata = Metadata.get_by_id(self.dealer.plug, fid)
+            if metadata:
+                yield metadata
+
+
+class DirectoryDeletionWorker(DirectoryWorker, DeletionWorker):
+    def __init__(self, dealer, fid, folder_name, prefix, fids):
+        super(DirectoryDeletionWorker, self).__init__(
+            dealer, fid, folder_name, prefix, fids
+        )
+
+    def do(self):
+        if (self.dealer.plug.has_handler('delete_directory') and
+                self.has_all_files()):
+            self.logger.debug("Deleting directory '{}'", self.prefix)
+
+            try:
+                self.call('delete_directory', self.path(self.prefix))
+            except AbortOperation:
+                pass
+            else:
+                for metadata in self.get_metadata():
+                    self.metadata_deleted(metadata)
+
+                self.logger.info("Directory '{}' deleted", self.prefix)
+                return
+
+        for metadata in self.get_metadata():
+            self.delete(metadata)
+
+
+class DirectoryMoveWorker(DirectoryWorker, MoveWorker):
+    def __init__(self, dealer, fid, folder_name, old_prefix, new_prefix,
+                 pairs):
+        super(DirectoryMoveWorker, self).__init__(
+            dealer, fid, folder_name, old_prefix, [old for old, _ in pairs]
+        )
+
+        self.new_prefix = new_prefix
+        self.new_fids = dict(pairs)
+
+    def do(self):
+        if (self.dealer.plug.has_handler('move_directory') and
+                self.has_all_files()):
+            self.logger.debug(
+                "Moving directory '{}' to '{}'", self.prefix, self.new_prefix
+            )
+
+            try:
+                self.call(
+                    'move_directory', self.path(self.prefix),
+                    self.path(self.new_prefix)
+                )
+            except AbortOperation:
+                pass
+            else:
+                for metadata in self.get_metadata():
+                    new_fid = self.new_fids[metadata.fid]
+                    new_metadata = Metadata.get_by_id(
+                        self.dealer.plug, new_fid
+                    )
+
+                    metadata.delete()
+                    if new_metadata:
+                        new_metadata.set_uptodate()
+                    self.dealer.plug.move_signature(metadata.fid, new_fid)
+
+                self.logger.info(
+                    "Directory '{}' moved to '{}'",
+                    self.prefix, self.new_prefix
+                )
+                return
+
+        # The files are moved one by one, and transferred again if the
+        # driver cannot move them
+        for metadata in self.get_metadata():
+            self.move(metadata, self.new_fids[metadata.fid])
 
 
 WORKERS = {
     UP: TransferWorker,
     DEL: DeletionWorker,
     MOV: MoveWorker,
+    MOV_DIR: DirectoryMoveWorker,
+    DEL_DIR: DirectoryDeletionWorker,
 }
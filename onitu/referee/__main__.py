@@ -1,7 +1,7 @@
 """
 Start the Referee.
 
-Launch it as : `python -m onitu.referee`
+Launch it as : `python -m onitu.referee <session> [partition partitions]`
 """
 
 import sys
@@ -17,8 +17,13 @@ from .referee import Referee
 if __name__ == '__main__':
     session = u(sys.argv[1])
 
+    if len(sys.argv) > 3:
+        partition, partitions = int(sys.argv[2]), int(sys.argv[3])
+    else:
+        partition, partitions = 0, 1
+
     with ZeroMQHandler(get_logs_uri(session), multi=True).applicationbound():
-        referee = Referee(session)
+        referee = Referee(session, partition, partitions)
 
         at_exit(referee.close)
 
@@ -1,3 +1,10 @@
 UP = b'\x01'
 DEL = b'\x02'
 MOV = b'\x03'
+
+# Sent to the Referee when the options of the folders changed
+RELOAD = b'\x04'
+
+# Events on all the files of a directory, sent as a single event
+MOV_DIR = b'\x05'
+DEL_DIR = b'\x06'
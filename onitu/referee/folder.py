@@ -1,4 +1,209 @@
-from fnmatch import fnmatchcase
+"""
+This module decides which services should receive the events of the
+files of each folder.
+
+The options of the folders, and of the services in each folder, are
+compiled once into :class:`Rules`, so the events can be checked without
+parsing the sizes or the glob patterns again.
+"""
+import re
+import numbers
+
+from fnmatch import translate
+
+from onitu.utils import UNICODE
+
+# The maximum number of mimetypes whose result is kept by each rule
+MIMETYPES_CACHE_SIZE = 1024
+
+MODES = ('r', 'w', 'rw')
+
+
+def to_bytes(size):
+    units = {
+        '': 1e0,
+        'b': 1e0,
+        'o': 1e0,
+
+        'k': 1e3,
+        'ko': 1e3,
+        'kb': 1e3,
+
+        'm': 1e6,
+        'mo': 1e6,
+        'mb': 1e6,
+
+        'g': 1e9,
+        'go': 1e9,
+        'gb': 1e9,
+
+        't': 1e12,
+        'to': 1e12,
+        'tb': 1e12,
+
+        'p': 1e15,
+        'po': 1e15,
+        'pb': 1e15,
+
+        'ki': 2 ** 10,
+        'mi': 2 ** 20,
+        'gi': 2 ** 30,
+        'ti': 2 ** 40,
+        'pi': 2 ** 50,
+    }
+
+    if size is None:
+        return None
+
+    try:
+        return int(size)
+    except ValueError:
+        pass
+
+    size = size.replace(' ', '')
+    unit = size.lstrip('0123456789.').lower()
+    size = size[:-len(unit)] if len(unit) else size
+
+    if unit not in units:
+        return None
+
+    try:
+        return int(float(size) * units[unit])
+    except ValueError:
+        pass
+
+    return None
+
+
+def validate(options):
+    """Raise a `ValueError` if the options of a folder, or of a service
+    in a folder, are not valid. The :class:`Rules` ignore the invalid
+    values instead, so this should be checked before they are stored.
+    """
+    if not isinstance(options, dict):
+        raise ValueError("the options must be an object")
+
+    if options.get("mode", "rw") not in MODES:
+        raise ValueError(
+            u"the mode must be one of {}".format(", ".join(MODES))
+        )
+
+    file_size = options.get("file_size", {})
+
+    if not isinstance(file_size, dict):
+        raise ValueError("file_size must be an object")
+
+    for bound in ("min", "max"):
+        size = file_size.get(bound)
+
+        if size is None:
+            continue
+
+        if (isinstance(size, bool) or
+                not isinstance(size, (numbers.Number, str, UNICODE)) or
+                to_bytes(size) is None):
+            raise ValueError(u"invalid {} file size: {}".format(bound, size))
+
+    for name in ("mimetypes", "blacklist", "whitelist"):
+        patterns = options.get(name)
+
+        if patterns is None:
+            continue
+
+        if (not isinstance(patterns, list) or
+                not all(isinstance(p, (str, UNICODE)) for p in patterns)):
+            raise ValueError(u"{} must be a list of strings".format(name))
+
+
+class Globs(object):
+    """A list of glob patterns, matched in a case-sensitive way like
+    :func:`fnmatch.fnmatchcase`. The patterns without wildcards are
+    looked up in a set, the others are combined in a single regex.
+    """
+
+    def __init__(self, patterns):
+        self.names = set()
+        globs = []
+
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                globs.append(translate(pattern))
+            else:
+                self.names.add(pattern)
+
+        self.regex = re.compile('|'.join(globs)) if globs else None
+
+    def match(self, name):
+        if name in self.names:
+            return True
+        return bool(self.regex and self.regex.match(name))
+
+
+class Rules(object):
+    """The options of a folder, or of a service in a folder, compiled."""
+
+    def __init__(self, options):
+        self.mode = options.get("mode", "rw")
+
+        file_size = options.get("file_size", {})
+        self.min_size = to_bytes(file_size.get("min"))
+        self.max_size = to_bytes(file_size.get("max"))
+
+        self.mimetypes = self._globs(options.get("mimetypes"))
+        self.blacklist = self._globs(options.get("blacklist"))
+        self.whitelist = self._globs(options.get("whitelist"))
+
+        # The result of the mimetypes already checked, as there are
+        # only a few of them
+        self._mimetypes_cache = {}
+
+    def check(self, metadata, mode=""):
+        """Return `None` if the file is accepted, or the reason of its
+        rejection as a message and its arguments.
+        """
+        if any(c not in self.mode for c in mode):
+            return "because mode is '{}'", self.mode
+
+        size = metadata['size']
+
+        if self.min_size is not None and size < self.min_size:
+            return "due to its size: {} bytes", size
+
+        if self.max_size is not None and size > self.max_size:
+            return "due to its size: {} bytes", size
+
+        if not self.match_mimetype(metadata['mimetype']):
+            return "due to its mimetype: {}", metadata['mimetype']
+
+        filename = metadata['filename']
+
+        if self.blacklist and self.blacklist.match(filename):
+            return "because it is blacklisted",
+
+        if self.whitelist and not self.whitelist.match(filename):
+            return "because it is not whitelisted",
+
+        return None
+
+    def match_mimetype(self, mimetype):
+        if self.mimetypes is None:
+            return True
+
+        result = self._mimetypes_cache.get(mimetype)
+
+        if result is None:
+            if len(self._mimetypes_cache) >= MIMETYPES_CACHE_SIZE:
+                self._mimetypes_cache.clear()
+
+            result = self.mimetypes.match(mimetype)
+            self._mimetypes_cache[mimetype] = result
+
+        return result
+
+    def _globs(self, patterns):
+        if patterns is None:
+            return None
+        return Globs(patterns)
 
 
 class Folder(object):
@@ -8,6 +213,12 @@ class Folder(object):
         self.logger = logger
         self.options = options
 
+        self.rules = Rules(options)
+        self.service_rules = {
+            service: Rules(service_options)
+            for service, service_options in services.items()
+        }
+
     def __str__(self):
         return self.name
 
@@ -44,145 +255,47 @@ class Folder(object):
 
         # Step 1: Do we (the folder) want the file?
 
-        if not self.assert_options(self.options, metadata, 'rw'):
+        if not self.assert_options(self.rules, metadata, 'rw'):
             return set()
 
         # Step 2: Does the source want to share it?
 
-        options = self.services[source]
-        if not self.assert_options(options, metadata, 'r',
+        if not self.assert_options(self.service_rules[source], metadata, 'r',
                                    authority=u"{} (source)".format(source)):
             return set()
 
         # Step 3: Check who else is interested.
 
         targets = set()
-        for service, options in self.services.items():
+        for service, rules in self.service_rules.items():
             if service == source:
                 continue
-            if self.assert_options(options, metadata, 'w', authority=service):
+            if self.assert_options(rules, metadata, 'w', authority=service):
                 targets.add(service)
 
         return targets
 
     def assert_options(self, options, metadata, mode="", authority=None):
-
-        def check_list(l, c):
-            if l is None:
-                return None
-            return any(fnmatchcase(c, rule) for rule in l)
-
         # Those options are either our own or those of a service.
         # This is because there is no difference between
         # service/folder and folder options.
 
+        if not isinstance(options, Rules):
+            options = Rules(options)
+
+        reason = options.check(metadata, mode)
+
+        if reason is None:
+            return True
+
         if authority is None:
             authority = u"Folder <{}>".format(self.name)
         else:
             authority = u"Service <{}> in Folder <{}>".format(
                 authority, self.name)
 
-        # mode
-
-        modeopts = options.get("mode", "rw")
-        if any(c not in modeopts for c in mode):
-            self.logger.info(
-                "{} ignores event for '{}' because mode is '{}'",
-                authority, metadata['filename'], modeopts)
-            return False
-
-        # min/max size
-
-        minsz = options.get("file_size", {}).get("min")
-        maxsz = options.get("file_size", {}).get("max")
-
-        if minsz is not None and metadata['size'] < self._to_bytes(minsz):
-            self.logger.info(
-                "{} ignores event for '{}' due to its size: {} bytes",
-                authority, metadata['filename'], metadata['size'])
-            return False
-
-        if maxsz is not None and metadata['size'] > self._to_bytes(maxsz):
-            self.logger.info(
-                "{} ignores event for '{}' due to its size: {} bytes",
-                authority, metadata['filename'], metadata['size'])
-            return False
-
-        # mimetypes
-
-        if check_list(options.get("mimetypes"), metadata['mimetype']) is False:
-            self.logger.info(
-                "{} ignores event for '{}' due to its mimetype: {}",
-                authority, metadata['filename'], metadata['mimetype'])
-            return False
-
-        # black/white list
-
-        if check_list(options.get("blacklist"), metadata['filename']) is True:
-            self.logger.info(
-                "{} ignores event for '{}' because it is blacklisted",
-                authority, metadata['filename'])
-            return False
-
-        if check_list(options.get("whitelist"), metadata['filename']) is False:
-            self.logger.info(
-                "{} ignores event for '{}' because it is not whitelisted",
-                authority, metadata['filename'])
-            return False
-
-        return True
-
-    def _to_bytes(self, size):
-        units = {
-            '': 1e0,
-            'b': 1e0,
-            'o': 1e0,
-
-            'k': 1e3,
-            'ko': 1e3,
-            'kb': 1e3,
-
-            'm': 1e6,
-            'mo': 1e6,
-            'mb': 1e6,
-
-            'g': 1e9,
-            'go': 1e9,
-            'gb': 1e9,
-
-            't': 1e12,
-            'to': 1e12,
-            'tb': 1e12,
-
-            'p': 1e15,
-            'po': 1e15,
-            'pb': 1e15,
-
-            'ki': 2 ** 10,
-            'mi': 2 ** 20,
-            'gi': 2 ** 30,
-            'ti': 2 ** 40,
-            'pi': 2 ** 50,
-        }
-
-        if size is None:
-            return None
-
-        try:
-            return int(size)
-        except ValueError:
-            pass
-
-        size = size.replace(' ', '')
-        unit = size.lstrip('0123456789.').lower()
-        size = size[:-len(unit)] if len(unit) else size
-
-        if unit not in units:
-            return None
-
-        try:
-            return int(float(size) * units[unit])
-        except ValueError:
-            pass
-
-        return None
+        self.logger.info(
+            u"{} ignores event for '{}' " + reason[0],
+            authority, metadata['filename'], *reason[1:]
+        )
+        return False
@@ -1,22 +1,29 @@
-import functools
+import time
 
 import zmq
 
 from logbook import Logger
 
-from onitu.escalator.client import Escalator, EscalatorClosed
-from onitu.utils import get_events_uri, b, log_traceback
+from onitu.escalator.client import Escalator, EscalatorClosed, Log
+from onitu.utils import get_referee_uri, get_partition, b, log_traceback
 
-from .cmd import UP, DEL, MOV
+from .cmd import UP, DEL, MOV, RELOAD, MOV_DIR, DEL_DIR
 from .folder import Folder
 
+# The events handled are deleted from the logs at most once per
+# interval, in seconds
+TRUNCATE_INTERVAL = 60
+
 
 class Referee(object):
     """Referee class, receive all events and deal with them.
 
-    The events are represented as Redis List 'events' that should be
-    appended with RPUSH. Each item is the file id (fid) of the file
-    which triggered the event.
+    Each service appends its events to its own log, with increasing
+    sequence numbers. Each item is the file id (fid) of the file which
+    triggered the event, the arguments of the event and the time it was
+    sent, which orders the events of the different services. The Referee
+    keeps the sequence number of the last event it handled from each
+    log.
 
     The Referee give orders to the entries via his PUB ZMQ socket,
     whose port is stored in the Redis 'referee:publisher' key.
@@ -31,36 +38,71 @@ class Referee(object):
     - The id of the file
     """
 
-    def __init__(self, session):
+    def __init__(self, session, partition=0, partitions=1):
         super(Referee, self).__init__()
 
-        self.logger = Logger("Referee")
+        # The events are partitioned by fid between several Referees,
+        # each of them handling the events of its files in order
+        self.partition = partition
+        self.partitions = partitions
+        self.prefix = u'referee:{}:'.format(partition)
+
+        if partitions > 1:
+            self.logger = Logger(u"Referee {}".format(partition))
+        else:
+            self.logger = Logger("Referee")
         self.context = zmq.Context.instance()
         self.escalator = Escalator(session)
-        self.get_events_uri = functools.partial(get_events_uri, session)
+        self.queues = Escalator.queues(session)
+        self.session = session
+
+        self.services = []
+        self.folders = {}
+        # The version of the options of the folders loaded
+        self.folders_version = None
+        self.reload_folders()
+
+        # The number of the last event sent to the services, which gives
+        # the order of their queues
+        self.sequence = self.queues.get(
+            self.prefix + u'sequence', default=0
+        )
 
-        self.services = self.escalator.get('services', default=[])
-        self.folders = Folder.get_folders(
-            self.escalator, self.services, self.logger
+        # The sequence number of the last event handled from the log of
+        # each service, and when they were last truncated
+        self.cursors = self.queues.get(
+            self.prefix + u'cursors', default={}
         )
+        self.truncated = {}
+        self.last_truncation = time.time()
+        self.logs = {}
+
+        # The metadata of the files of the batch being handled, and the
+        # notifications to send at the end of the batch
+        self.metadata = {}
+        self.notifications = []
 
         self.handlers = {
             UP: self._handle_update,
             DEL: self._handle_deletion,
             MOV: self._handle_move,
+            MOV_DIR: self._handle_move_directory,
+            DEL_DIR: self._handle_delete_directory,
         }
 
     def start(self):
         """Listen to all the events, and handle them
         """
         self.publisher = self.context.socket(zmq.PUB)
-        self.publisher.bind(self.get_events_uri('referee', 'publisher'))
+        self.publisher.bind(
+            get_referee_uri(self.session, self.partition, 'publisher')
+        )
 
         self.logger.info("Started")
 
         try:
             listener = self.context.socket(zmq.PULL)
-            listener.bind(self.get_events_uri('referee'))
+            listener.bind(get_referee_uri(self.session, self.partition))
             self.listen(listener)
         except zmq.ZMQError as e:
             if e.errno == zmq.ETERM:
@@ -76,22 +118,174 @@ class Referee(object):
                 listener.close()
 
     def listen(self, listener):
+        # The events of the previous versions, which were indexed by fid,
+        # first without partitions
+        legacy = [
+            (key, args) for key, args in
+            self.escalator.range(prefix=u'referee:event:')
+            if get_partition(key.split(':')[-1], self.partitions) ==
+            self.partition
+        ]
+        legacy.extend(self.escalator.range(prefix=self.prefix + u'event:'))
+        if legacy:
+            self.handle_events(
+                [(key.split(':')[-1], args) for key, args in legacy]
+            )
+
+            with self.escalator.write_batch() as batch:
+                for key, _ in legacy:
+                    batch.delete(key)
+
         while True:
-            events = self.escalator.range(prefix='referee:event:')
+            events, cursors = self.read_logs()
+
+            if events:
+                self.handle_events(events, cursors)
+
+            if time.time() - self.last_truncation >= TRUNCATE_INTERVAL:
+                self.truncate()
+
+            if not listener.poll(TRUNCATE_INTERVAL * 1000):
+                continue
+
+            messages = [listener.recv()]
+
+            # The events sent meanwhile are read by the next range
+            while listener.poll(0):
+                messages.append(listener.recv())
+
+            if RELOAD in messages:
+                self.reload_folders()
+
+    def reload_folders(self):
+        """Compile the rules of the folders again if their options
+        changed. This is requested by the REST API, so the new rules
+        apply without restarting Onitu.
+        """
+        version = self.escalator.get('folders:version', default=0)
+
+        if version == self.folders_version:
+            return
+
+        self.services = self.escalator.get('services', default=[])
+        self.folders = Folder.get_folders(
+            self.escalator, self.services, self.logger
+        )
+
+        if self.folders_version is not None:
+            self.logger.info("Folder rules reloaded")
+
+        self.folders_version = version
+
+    def log(self, name):
+        """Return the log of the events sent by a service to this
+        partition.
+        """
+        if name not in self.logs:
+            self.logs[name] = Log(
+                self.queues, u'{}log:{}:'.format(self.prefix, name)
+            )
+        return self.logs[name]
+
+    def read_logs(self):
+        """Return the events not handled yet from the logs of all the
+        services as (fid, args) tuples, in the order they were sent, and
+        the new cursors of the logs.
+        """
+        events = []
+        cursors = {}
+
+        for name in self.services:
+            records = self.log(name).read(self.cursors.get(name, 0))
+
+            if not records:
+                continue
+
+            cursors[name] = records[-1][0]
+            timestamp = 0
+
+            for _, event in records:
+                # The events of a log stay in order even if the clock
+                # went backwards. The ones of the previous versions have
+                # no time.
+                if len(event) > 2:
+                    timestamp = max(timestamp, event[2])
+                events.append((timestamp, event[0], event[1]))
+
+        # The sort is stable, so the events sent at the same time keep
+        # the order of their log
+        events.sort(key=lambda event: event[0])
+        return [(fid, args) for _, fid, args in events], cursors
+
+    def truncate(self):
+        """Delete the events handled from the logs."""
+        for name, cursor in self.cursors.items():
+            if self.truncated.get(name) == cursor:
+                continue
+
+            deleted = self.log(name).truncate(cursor)
+            self.truncated[name] = cursor
+
+            if deleted:
+                self.logger.debug(
+                    "Truncated {} events from the log of {}", deleted, name
+                )
+
+        self.last_truncation = time.time()
+
+    def handle_events(self, events, cursors=None):
+        """Handle a batch of (fid, args) events. The metadata of all
+        the files are read with a single request, and the notifications
+        are written with the new cursors of the logs in a single batch.
+        """
+        # An update followed by another update of the same file is
+        # superseded by it. The other events are all handled in order,
+        # e.g. a file can be moved then created again.
+        following = {}
+        kept = []
+        for fid, args in reversed(events):
+            cmd = args[0] if args else None
+            if cmd != UP or following.get(fid) != UP:
+                kept.append((fid, args))
+            following[fid] = cmd
+        events = kept[::-1]
+
+        fids = set()
+        for fid, args in events:
+            fids.add(fid)
+            if args and args[0] == MOV:
+                fids.add(args[2])
+            elif args and args[0] == MOV_DIR:
+                for pair in args[5]:
+                    fids.update(pair)
+            elif args and args[0] == DEL_DIR:
+                fids.update(args[4])
+
+        fids = list(fids)
+        values = self.escalator.multi_get(
+            u'file:{}'.format(fid) for fid in fids
+        )
+        self.metadata = dict(zip(fids, values))
+
+        try:
+            for fid, args in events:
+                cmd = args[0]
+                if cmd not in self.handlers:
+                    continue
 
-            for key, args in events:
                 try:
-                    cmd = args[0]
-                    if cmd in self.handlers:
-                        fid = key.split(':')[-1]
-                        self.handlers[cmd](fid, *args[1:])
-                finally:
-                    self.escalator.delete(key)
+                    self.handlers[cmd](fid, *args[1:])
+                except Exception:
+                    log_traceback(self.logger)
 
-            listener.recv()
+            self.flush(cursors)
+        finally:
+            self.metadata = {}
+            self.notifications = []
 
     def close(self):
         self.escalator.close()
+        self.queues.close()
         self.publisher.close()
         self.context.term()
 
@@ -99,9 +293,8 @@ class Referee(object):
         """
         Notify the owners when a file is deleted
         """
-        try:
-            metadata = self.escalator.get('file:{}'.format(fid))
-        except KeyError:
+        metadata = self.metadata.get(fid)
+        if not metadata:
             return
 
         folder = self.folders[metadata['folder_name']]
@@ -117,16 +310,17 @@ class Referee(object):
         """
         Notify the owners when a file is moved
         """
-        try:
-            metadata = self.escalator.get('file:{}'.format(old_fid))
-        except KeyError:
+        metadata = self.metadata.get(old_fid)
+        if not metadata:
             # If we can't find the metadata, the source was the only
             # owner, so we can handle it as a new file
             return self._handle_update(new_fid, source)
 
         folder = self.folders[metadata['folder_name']]
 
-        new_metadata = self.escalator.get('file:{}'.format(new_fid))
+        new_metadata = self.metadata.get(new_fid)
+        if not new_metadata:
+            return
 
         self.logger.info(
             "Moving of '{}' to '{}' from {} in folder {}",
@@ -137,6 +331,72 @@ class Referee(object):
             folder.targets(new_metadata, source), MOV, old_fid, new_fid
         )
 
+    def _handle_move_directory(self, fid, source, folder_name, old_prefix,
+                               new_prefix, pairs):
+        """
+        Notify the owners when a directory is moved. Each service gets
+        a single event with the files it owns.
+        """
+        folder = self.folders.get(folder_name)
+        if not folder:
+            return
+
+        self.logger.info(
+            "Moving of directory '{}' to '{}' from {} in folder {}",
+            old_prefix, new_prefix, source, folder
+        )
+
+        targets = {}
+
+        for old_fid, new_fid in pairs:
+            if not self.metadata.get(old_fid):
+                # The source was the only owner of the file
+                self._handle_update(new_fid, source)
+                continue
+
+            new_metadata = self.metadata.get(new_fid)
+            if not new_metadata:
+                continue
+
+            for name in folder.targets(new_metadata, source):
+                targets.setdefault(name, []).append((old_fid, new_fid))
+
+        for name, service_pairs in targets.items():
+            self.notify(
+                (name,), MOV_DIR, fid, folder_name, old_prefix, new_prefix,
+                service_pairs
+            )
+
+    def _handle_delete_directory(self, fid, source, folder_name, prefix,
+                                 fids):
+        """
+        Notify the owners when a directory is deleted. Each service gets
+        a single event with the files it owns.
+        """
+        folder = self.folders.get(folder_name)
+        if not folder:
+            return
+
+        self.logger.info(
+            "Deletion of directory '{}' from {} in folder {}",
+            prefix, source, folder
+        )
+
+        targets = {}
+
+        for file_fid in fids:
+            metadata = self.metadata.get(file_fid)
+            if not metadata:
+                continue
+
+            for name in folder.targets(metadata, source):
+                targets.setdefault(name, []).append(file_fid)
+
+        for name, service_fids in targets.items():
+            self.notify(
+                (name,), DEL_DIR, fid, folder_name, prefix, service_fids
+            )
+
     def _handle_update(self, fid, source):
         """Choose who are the entries that are concerned by the event
         and send a notification to them.
@@ -144,7 +404,10 @@ class Referee(object):
         For the moment all the entries are notified for each event, but
         this should change when the rules will be introduced.
         """
-        metadata = self.escalator.get('file:{}'.format(fid))
+        metadata = self.metadata.get(fid)
+        if not metadata:
+            return
+
         folder = self.folders[metadata['folder_name']]
 
         self.logger.info(
@@ -155,12 +418,40 @@ class Referee(object):
         self.notify(folder.targets(metadata, source), UP, fid)
 
     def notify(self, services, cmd, fid, *args):
-        if not services:
-            return
+        """Queue an event for the given services. It is sent at the end
+        of the batch, by :meth:`flush`.
+        """
+        if services:
+            self.notifications.append((services, cmd, fid, args))
 
-        for name in services:
-            self.escalator.put(
-                u'service:{}:event:{}'.format(name, fid), (cmd, args)
-            )
+    def flush(self, cursors=None):
+        """Append the queued events to the queue of each service, move
+        the cursors of the logs after the handled events, and wake up
+        each service once.
+        """
+        woken = set()
+
+        with self.queues.write_batch() as batch:
+            for services, cmd, fid, args in self.notifications:
+                self.sequence += 1
+
+                for name in services:
+                    batch.put(
+                        u'service:{}:queue:{}:{:016x}'.format(
+                            name, self.partition, self.sequence
+                        ),
+                        (fid, cmd, args)
+                    )
+                    woken.add(name)
+
+            if woken:
+                batch.put(self.prefix + u'sequence', self.sequence)
+
+            if cursors:
+                self.cursors.update(cursors)
+                batch.put(self.prefix + u'cursors', self.cursors)
+
+        self.notifications = []
 
+        for name in woken:
             self.publisher.send(b(name))
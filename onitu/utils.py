@@ -4,15 +4,19 @@ parts of Onitu.
 """
 import os
 import sys
+import time
 import uuid
 import string
 import signal
 import socket
 import random
+import hashlib
 import tempfile
 import mimetypes
+import threading
 import traceback
 import pkg_resources
+import zlib
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
@@ -23,6 +27,10 @@ TMPDIR = tempfile.gettempdir()
 
 NAMESPACE_ONITU = uuid.UUID('bcd336f2-d023-4856-bc92-e79dd24b64d7')
 
+# The default maximum number of threads of the pools running IO bound
+# tasks, whatever the number of CPUs
+MAX_THREADS = 32
+
 UNICODE = unicode if PY2 else str
 
 
@@ -104,6 +112,22 @@ def get_mimetype(filename):
     return mimetype
 
 
+def get_checksum(chunks):
+    """
+    Get the checksum of a content, given as an iterable of chunks so it
+    can be computed without loading the whole content in memory.
+
+    The checksum is the hexadecimal MD5 digest of the content, which is
+    also what some services (like Amazon S3) use as an ETag.
+    """
+    checksum = hashlib.md5()
+
+    for chunk in chunks:
+        checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
 def get_random_string(length):
     """
     Return a string containing `length` random alphanumerical chars.
@@ -158,6 +182,26 @@ def get_events_uri(session, name, suffix=None):
     return _get_uri(session, name)
 
 
+def get_referee_uri(session, partition=0, suffix=None):
+    """
+    Return the URI of the given partition of the Referee. The first
+    partition keeps the URI of a single Referee.
+    """
+    name = u'referee{}'.format(partition) if partition else u'referee'
+    return get_events_uri(session, name, suffix)
+
+
+def get_partition(fid, partitions):
+    """
+    Return the partition of the Referee handling the events of a file.
+    All the events of a file go to the same partition, so they are
+    handled in order.
+    """
+    if partitions <= 1:
+        return 0
+    return (zlib.crc32(b(fid)) & 0xffffffff) % partitions
+
+
 def get_brocker_uri(session):
     return _get_uri(session, 'brocker')
 
@@ -225,3 +269,176 @@ def cpu_count(default=1):
         return multiprocessing.cpu_count()
     except NotImplementedError:
         return default
+
+
+def pool_size(max_threads=0):
+    """
+    Return the number of threads of a pool running IO bound tasks,
+    which is given by the `max_threads` option if it is set
+    """
+    if max_threads:
+        return max_threads
+    return min(cpu_count() * 3, MAX_THREADS)
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of an operation, like the number of bytes transferred
+    per second. A rate of 0 means that there is no limit.
+
+    The bucket holds at most one second worth of tokens, so short bursts
+    are allowed after an idle period. It can be shared between threads.
+    """
+
+    def __init__(self, rate=0):
+        self._rate = rate
+        self._tokens = rate
+        self._timestamp = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, value):
+        with self._lock:
+            if value != self._rate:
+                self._rate = value
+                self._tokens = min(self._tokens, value)
+
+    def consume(self, amount, stop=None):
+        """
+        Take `amount` tokens from the bucket, and block until they are
+        available or the `stop` event, if given, is set.
+        """
+        with self._lock:
+            if not self._rate:
+                return
+
+            now = time.time()
+            self._tokens = min(
+                self._rate,
+                self._tokens + (now - self._timestamp) * self._rate
+            )
+            self._timestamp = now
+            # The tokens are taken right away, so the next callers
+            # will wait for the ones we borrowed
+            self._tokens -= amount
+            delay = -self._tokens / float(self._rate)
+
+        if delay > 0 and stop:
+            stop.wait(delay)
+        elif delay > 0:
+            time.sleep(delay)
+
+
+class Budget(object):
+    """
+    Bound an amount in use, like the number of transfers in progress or
+    the number of bytes held in memory. A limit of 0 means that there is
+    no limit, but the amount in use is still counted.
+
+    An amount bigger than the limit is accepted when nothing else is in
+    use, so it cannot wait forever. It can be shared between threads.
+    """
+
+    def __init__(self, limit=0):
+        self._limit = limit
+        self._used = 0
+        self._peak = 0
+        self._condition = threading.Condition()
+        self._listeners = []
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, value):
+        with self._condition:
+            self._limit = value
+            self._condition.notify_all()
+
+        self._notify()
+
+    @property
+    def used(self):
+        return self._used
+
+    def available(self):
+        """
+        Return the amount which can still be acquired, or `None` if
+        there is no limit.
+        """
+        with self._condition:
+            if not self._limit:
+                return None
+            return max(self._limit - self._used, 0)
+
+    def try_acquire(self, amount=1):
+        """
+        Take `amount` from the budget if it is available, and return
+        whether it was.
+        """
+        with self._condition:
+            if not self._fits(amount):
+                return False
+
+            self._take(amount)
+            return True
+
+    def acquire(self, amount=1, stop=None):
+        """
+        Take `amount` from the budget, and block until it is available
+        or the `stop` event, if given, is set. Return whether it was
+        taken.
+        """
+        with self._condition:
+            while not self._fits(amount):
+                if stop and stop.is_set():
+                    return False
+                # The stop event cannot wake us up, so we check it
+                # regularly
+                self._condition.wait(0.1)
+
+            self._take(amount)
+            return True
+
+    def release(self, amount=1):
+        with self._condition:
+            # Releasing more than what was acquired is a bug, which would
+            # let more than the limit in
+            assert amount <= self._used, "Released more than acquired"
+            self._used -= amount
+            self._condition.notify_all()
+
+        self._notify()
+
+    def subscribe(self, callback):
+        """
+        Call `callback` each time a part of the budget is released or
+        its limit changes, from the thread which did it. It allows the
+        waiters which cannot block on the budget to try again.
+        """
+        self._listeners.append(callback)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'used': self._used,
+                'peak': self._peak,
+                'limit': self._limit,
+            }
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    def _fits(self, amount):
+        return (not self._limit or not self._used or
+                self._used + amount <= self._limit)
+
+    def _take(self, amount):
+        self._used += amount
+        self._peak = max(self._peak, self._used)
@@ -0,0 +1,103 @@
+"""
+Measure the number of bytes copied in Python for each byte of a chunk
+transferred from a Router to a worker through the Brocker.
+
+The sockets are connected with the inproc transport, so libzmq does not
+copy the messages itself. The copies made by libzmq when a frame is sent
+with `copy=True` are not traced, so the figures of the copying path are a
+lower bound.
+"""
+import os
+import time
+
+import zmq
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from tests.utils.benchmark import Benchmark, BenchmarkData
+from tests.utils.units import MB
+
+CHUNK_SIZE = 4 * MB
+CHUNKS = 32
+
+
+class BenchmarkChunkCopies(Benchmark):
+    def setup(self):
+        if not tracemalloc:
+            raise RuntimeError("This benchmark requires tracemalloc")
+
+        self.context = zmq.Context()
+
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind('inproc://router')
+
+        self.brocker = self.context.socket(zmq.ROUTER)
+        self.brocker.bind('inproc://brocker')
+        self.backend = self.context.socket(zmq.DEALER)
+        self.backend.connect('inproc://router')
+
+        self.worker = self.context.socket(zmq.DEALER)
+        self.worker.connect('inproc://brocker')
+
+        self.chunk = os.urandom(CHUNK_SIZE)
+
+    def teardown(self):
+        self.context.destroy(linger=0)
+
+    def transfer(self, copy):
+        self.worker.send_multipart([b'1', b'fid'])
+
+        request = self.brocker.recv_multipart()
+        self.backend.send_multipart(request[1:])
+
+        identity = self.router.recv_multipart()[0]
+        self.router.send_multipart([identity, b'C', self.chunk], copy=copy)
+
+        forwarded = self.backend.recv_multipart(copy=copy)
+        self.brocker.send_multipart([request[0]] + forwarded, copy=copy)
+
+        response = self.worker.recv_multipart(copy=copy)
+
+        if copy:
+            return forwarded, response[1]
+        # The drivers expect bytes
+        return forwarded, response[1].bytes
+
+    def measure(self, title, copy):
+        result = BenchmarkData(title, None, unit='bytes/byte')
+        # We keep all the frames received, so every allocation made
+        # during the transfers is still traced at the end
+        frames = []
+
+        tracemalloc.start()
+        start = time.time()
+
+        for _ in range(CHUNKS):
+            frames.append(self.transfer(copy))
+
+        elapsed = time.time() - start
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        transferred = float(CHUNK_SIZE * CHUNKS)
+        result.add_result(allocated / transferred)
+        result.description = '{:.1f} MB/s'.format(
+            transferred / MB / elapsed
+        )
+        return result
+
+    def test_copy(self):
+        return self.measure('copy', True)
+
+    def test_zero_copy(self):
+        return self.measure('zero copy', False)
+
+
+if __name__ == '__main__':
+    bench = BenchmarkChunkCopies('BENCH_CHUNK_COPIES', verbose=True)
+    bench.run()
+    print('{:=^28}'.format(' chunk copies '))
+    bench.display()
@@ -0,0 +1,92 @@
+"""
+Measure the number of requests per second the Brocker can send to the
+Router of a source, when it connects a new DEALER socket for each
+request and when it reuses the sockets.
+"""
+import time
+import threading
+
+import zmq
+
+from onitu.utils import get_events_uri, get_random_string
+from onitu.brocker.commands import GET_CHUNK
+from onitu.brocker.responses import CHUNK
+
+from tests.utils.benchmark import Benchmark, BenchmarkData
+from tests.utils.units import KB
+
+REQUESTS = 5000
+
+
+class BenchmarkDealers(Benchmark):
+    def setup(self):
+        self.context = zmq.Context()
+        self.session = get_random_string(15)
+        self.uri = get_events_uri(self.session, 'source', 'router')
+        self.chunk = b'0' * (64 * KB)
+
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind(self.uri)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        self.context.term()
+        self.thread.join()
+
+    def serve(self):
+        try:
+            while True:
+                identity = self.router.recv_multipart()[0]
+                self.router.send_multipart([identity, CHUNK, self.chunk])
+        except zmq.ZMQError:
+            self.router.close(linger=0)
+
+    def request(self, dealer):
+        dealer.send_multipart((GET_CHUNK, b'fid', b'0', b'65536'))
+        return dealer.recv_multipart(copy=False)
+
+    def measure(self, title, get_dealer, release_dealer):
+        result = BenchmarkData(title, None, unit='requests/s')
+
+        start = time.time()
+
+        for _ in range(REQUESTS):
+            dealer = get_dealer()
+            self.request(dealer)
+            release_dealer(dealer)
+
+        result.add_result(REQUESTS / (time.time() - start))
+        return result
+
+    def test_new_socket(self):
+        def get_dealer():
+            dealer = self.context.socket(zmq.DEALER)
+            dealer.connect(self.uri)
+            return dealer
+
+        return self.measure('new socket', get_dealer, zmq.Socket.close)
+
+    def test_pooled_socket(self):
+        dealers = []
+
+        def get_dealer():
+            if dealers:
+                return dealers.pop()
+            dealer = self.context.socket(zmq.DEALER)
+            dealer.connect(self.uri)
+            return dealer
+
+        try:
+            return self.measure('pooled socket', get_dealer, dealers.append)
+        finally:
+            for dealer in dealers:
+                dealer.close()
+
+
+if __name__ == '__main__':
+    bench = BenchmarkDealers('BENCH_BROCKER_DEALERS', verbose=True)
+    bench.run()
+    print('{:=^28}'.format(' brocker dealers '))
+    bench.display()
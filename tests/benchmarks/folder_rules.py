@@ -0,0 +1,71 @@
+"""
+Measure the number of events per second the Referee can dispatch
+through :meth:`Folder.targets`, with simple options and with long lists
+of patterns.
+"""
+import time
+
+from logbook import Logger, WARNING
+
+from onitu.referee.folder import Folder
+
+from tests.utils.benchmark import Benchmark, BenchmarkData
+
+EVENTS = 50000
+SERVICES = 10
+
+FILES = [
+    {'filename': u'photos/2014/IMG_{:04d}.jpg'.format(i),
+     'size': i * 1000, 'mimetype': u'image/jpeg'}
+    for i in range(50)
+] + [
+    {'filename': u'src/module_{}.py'.format(i),
+     'size': i * 100, 'mimetype': u'text/x-python'}
+    for i in range(50)
+]
+
+
+class BenchmarkFolderRules(Benchmark):
+    def setup(self):
+        self.logger = Logger("Benchmark", level=WARNING)
+
+    def measure(self, title, options):
+        services = {u'service{}'.format(i): options for i in range(SERVICES)}
+        folder = Folder(u'folder', services, self.logger, options)
+
+        result = BenchmarkData(title, None, unit='events/s')
+
+        start = time.time()
+
+        for i in range(EVENTS):
+            folder.targets(FILES[i % len(FILES)], u'service0')
+
+        result.add_result(EVENTS / (time.time() - start))
+        return result
+
+    def test_no_rules(self):
+        return self.measure('no rules', {})
+
+    def test_simple_rules(self):
+        return self.measure('simple rules', {
+            'file_size': {'min': '1 Ki', 'max': '10 Mb'},
+            'mimetypes': ['image/*', 'text/*'],
+            'blacklist': ['*.tmp'],
+        })
+
+    def test_many_patterns(self):
+        return self.measure('many patterns', {
+            'file_size': {'max': '1 Gb'},
+            'mimetypes': ['image/jpeg', 'image/png', 'text/x-python',
+                          'application/vnd.oasis.opendocument.*'],
+            'blacklist': ['*.{}'.format(i) for i in range(100)],
+            'whitelist': (['photos/*', 'src/*.py', 'docs/*'] +
+                          ['dir{}/*'.format(i) for i in range(50)]),
+        })
+
+
+if __name__ == '__main__':
+    bench = BenchmarkFolderRules('BENCH_FOLDER_RULES', verbose=True)
+    bench.run()
+    print('{:=^28}'.format(' folder rules '))
+    bench.display()
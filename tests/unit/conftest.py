@@ -0,0 +1,160 @@
+import pytest
+
+from logbook import Logger
+
+from onitu.plug import Plug
+from onitu.plug.folder import Folder
+from onitu.plug.metadata import Metadata
+
+
+class Batch(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+
+class FakeEscalator(object):
+    """An Escalator client keeping the values in a dict, so the Plug
+    components can be tested without the database.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def clone(self, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def multi_get(self, keys, default=None):
+        return tuple(self.data.get(key, default) for key in keys)
+
+    def exists(self, key):
+        return key in self.data
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def range(self, prefix=None, start=None, stop=None, include_start=True,
+              include_stop=False, include_key=True, include_value=True):
+        if prefix is not None:
+            start, stop = prefix, prefix + u'\xff'
+
+        keys = sorted(
+            key for key in self.data
+            if (start is None or start < key or
+                (include_start and key == start)) and
+            (stop is None or key < stop or (include_stop and key == stop))
+        )
+
+        if not include_value:
+            return tuple(keys)
+        if not include_key:
+            return tuple(self.data[key] for key in keys)
+        return tuple((key, self.data[key]) for key in keys)
+
+    def write_batch(self, transaction=False):
+        return Batch(self)
+
+
+@pytest.fixture
+def escalator():
+    return FakeEscalator()
+
+
+class Component(object):
+    """Stand for the Router or the Dealer of a Plug, which are not
+    started by the unit tests.
+    """
+
+    def __init__(self):
+        self.invalidated = []
+        self.stopped = []
+
+    def invalidate(self, fid):
+        self.invalidated.append(fid)
+
+    def stop_transfer(self, fid):
+        self.stopped.append(fid)
+
+
+class Dealer(object):
+    """The attributes of the Dealer used by the workers."""
+
+    def __init__(self, plug):
+        self.plug = plug
+        self.name = plug.name
+        self.logger = plug.logger
+        self.escalator = plug.escalator
+        self.queues = plug.queues
+        self.in_progress = {}
+
+
+@pytest.fixture
+def plug(escalator):
+    plug = Plug()
+    plug.name = u'A'
+    plug.session = u'test'
+    plug.logger = Logger("test")
+    plug.escalator = escalator
+    plug.queues = escalator
+    plug.router = Component()
+    plug.dealer = Component()
+    plug.publishers = [None]
+    plug.options = {
+        'event_debounce': 0, 'chunk_size': 16, 'compression': False,
+        'direct_transfers': False
+    }
+    plug.folders = {u'f': Folder(u'f', u'/f')}
+    plug.notified = []
+    plug.notify_referee = lambda *args: plug.notified.append(args)
+    return plug
+
+
+@pytest.fixture
+def queues(plug):
+    """Give the Plug its own database of the queues, like the one of
+    :meth:`.Escalator.queues`.
+    """
+    plug.queues = FakeEscalator()
+    return plug.queues
+
+
+@pytest.fixture
+def dealer(plug):
+    return Dealer(plug)
+
+
+@pytest.fixture
+def create(plug):
+    """Return a function writing the metadata of a file of the folder
+    `f`, up-to-date on the service by default.
+    """
+    def create(filename, uptodate=True, **properties):
+        metadata = Metadata(
+            plug, filename=filename, folder=plug.folders[u'f'], **properties
+        )
+        metadata.write()
+        if uptodate:
+            metadata.set_uptodate()
+        return metadata
+
+    return create
@@ -0,0 +1,119 @@
+import time
+import threading
+from collections import deque
+
+import pytest
+import zmq
+
+from concurrent.futures import Future
+
+from logbook import Logger
+
+from onitu.brocker import brocker
+from onitu.brocker.brocker import Brocker
+from onitu.brocker.cache import ChunkCache
+from onitu.brocker.commands import GET_CHUNK, GET_DELTA, GET_SOURCES
+from onitu.brocker.responses import ERROR
+from onitu.utils import TokenBucket, Budget
+
+
+@pytest.fixture
+def context():
+    context = zmq.Context()
+    yield context
+    context.term()
+
+
+@pytest.fixture
+def source(context):
+    """A source which never answers."""
+    router = context.socket(zmq.ROUTER)
+    router.bind('inproc://source')
+    yield router
+    router.close(linger=0)
+
+
+@pytest.fixture
+def b(context, source, escalator, monkeypatch):
+    monkeypatch.setattr(brocker, 'RESPONSE_TIMEOUT', 0.05)
+
+    b = Brocker.__new__(Brocker)
+    b.logger = Logger("test")
+    b.context = context
+    b.escalator = escalator
+    b.dealers = {}
+    b.dealers_lock = threading.Lock()
+    b.stats = {}
+    b.stats_lock = threading.Lock()
+    b.closed = False
+    b.bucket = TokenBucket()
+    b.velocities = {u'A': (time.time(), 0.5)}
+    b.uptodate = {}
+    b.cache = ChunkCache(1000)
+
+    escalator.put(u'file:fid:uptodate:A', 1)
+    dealer = context.socket(zmq.DEALER)
+    dealer.connect('inproc://source')
+    b.dealers[u'A'] = [dealer]
+
+    yield b
+    dealer.close(linger=0)
+
+
+def test_source_timeout(b):
+    dealer = b.dealers[u'A'][0]
+    response = b.get_response(GET_CHUNK, b'fid', b'0', b'16')
+
+    assert response == [ERROR]
+    assert b.stats[u'A'].in_flight == 0
+    assert b.stats[u'A'].error_rate > 0
+    # The socket waiting for the reply is not reused
+    assert dealer.closed
+    assert not b.dealers[u'A']
+
+
+def test_resume_after_update(b, escalator):
+    # The chunks of the previous content are cached
+    b.uptodate[u'fid'] = (time.time(), frozenset((u'A',)), 1)
+    b.cache.put((b'fid', 1, b'16', b'16'), [b'C', b'old'])
+
+    # The file is updated, and the transfer resumed after the first chunk
+    escalator.put(u'file:fid:uptodate:A', 2)
+    response = b.get_response(GET_CHUNK, b'fid', b'16', b'16')
+
+    assert response == [ERROR]
+    assert b.get_revision(u'fid') == 2
+
+
+class Pool(object):
+    def submit(self, func, *args):
+        return Future()
+
+
+class Loop(object):
+    def add_future(self, future, callback):
+        pass
+
+
+def test_admission(b):
+    b.pool = Pool()
+    b.loop = Loop()
+    b.futures = {}
+    b.buffered = {}
+    b.waiting = deque()
+    b.buffers = Budget(16)
+    b.buffers.acquire(16)
+
+    b.handle([b'x', GET_CHUNK, b'fid', b'0', b'16'])
+    assert len(b.waiting) == 1
+
+    # The requests which hold no chunk are not stuck behind it
+    b.handle([b'y', GET_SOURCES, b'fid'])
+    b.handle([b'z', GET_DELTA, b'fid', b'16', b''])
+    assert len(b.waiting) == 1
+    assert (GET_SOURCES, b'fid') in b.futures
+    assert (GET_DELTA, b'fid', b'16', b'') in b.futures
+
+    b.buffers.release(16)
+    b.admit_waiting()
+    assert not b.waiting
@@ -0,0 +1,77 @@
+import time
+import threading
+
+import pytest
+
+from onitu.utils import Budget
+
+
+def test_unlimited():
+    budget = Budget()
+
+    assert budget.try_acquire(10 ** 9)
+    assert budget.available() is None
+    assert budget.stats() == {'used': 10 ** 9, 'peak': 10 ** 9, 'limit': 0}
+
+
+def test_limit():
+    budget = Budget(10)
+
+    assert budget.try_acquire(6)
+    assert budget.available() == 4
+    assert not budget.try_acquire(6)
+
+    budget.release(6)
+    assert budget.try_acquire(6)
+
+
+def test_bigger_than_limit():
+    budget = Budget(10)
+
+    # Nothing else is in use, so it does not wait forever
+    assert budget.try_acquire(100)
+    assert not budget.try_acquire(1)
+
+
+def test_acquire():
+    budget = Budget(10)
+    budget.acquire(10)
+    threading.Timer(0.1, budget.release, (5,)).start()
+
+    start = time.time()
+    assert budget.acquire(5)
+
+    assert 0.05 < time.time() - start < 1
+    assert budget.stats()['peak'] == 10
+
+
+def test_stop():
+    budget = Budget(10)
+    budget.acquire(10)
+    stop = threading.Event()
+    threading.Timer(0.1, stop.set).start()
+
+    start = time.time()
+    assert not budget.acquire(5, stop)
+
+    assert time.time() - start < 1
+
+
+def test_subscribe():
+    budget = Budget(10)
+    calls = []
+    budget.subscribe(lambda: calls.append(budget.used))
+
+    budget.acquire(5)
+    budget.release(5)
+    budget.limit = 20
+
+    assert calls == [0, 0]
+
+
+def test_over_release():
+    budget = Budget(10)
+    budget.acquire(5)
+
+    with pytest.raises(AssertionError):
+        budget.release(6)
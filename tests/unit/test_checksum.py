@@ -0,0 +1,125 @@
+import pytest
+
+from onitu.plug.metadata import Metadata
+from onitu.plug.workers import TransferWorker
+
+
+@pytest.fixture
+def plug(plug):
+    plug.copied = []
+
+    @plug.handler()
+    def copy_file(old_metadata, new_metadata):
+        plug.copied.append((old_metadata.filename, new_metadata.filename))
+
+    return plug
+
+
+@pytest.fixture
+def add(create):
+    """Write the metadata of a file which is not up-to-date yet."""
+    return lambda filename, checksum: create(
+        filename, uptodate=False, size=10, checksum=checksum
+    )
+
+
+def test_duplicates(add):
+    a = add(u'a', u'c1')
+    b = add(u'b', u'c1')
+    c = add(u'c', u'c2')
+
+    assert a.duplicates() == (b.fid,)
+    assert b.duplicates() == (a.fid,)
+    assert c.duplicates() == ()
+
+
+def test_index(plug, add, escalator):
+    a = add(u'a', u'c1')
+    assert escalator.exists(u'checksum:c1:{}'.format(a.fid))
+
+    a = Metadata.get_by_id(plug, a.fid)
+    a.checksum = u'c2'
+    a.write()
+    assert not escalator.exists(u'checksum:c1:{}'.format(a.fid))
+    assert escalator.exists(u'checksum:c2:{}'.format(a.fid))
+
+    # An update made without computing the checksum drops it
+    a = Metadata.get_by_id(plug, a.fid)
+    a.checksum = None
+    a.write()
+    assert not escalator.range(u'checksum:')
+
+    a = add(u'a', u'c1')
+    a.delete()
+    assert not escalator.range(u'checksum:')
+
+
+def copy_duplicate(dealer, fid):
+    worker = TransferWorker(dealer, fid)
+
+    try:
+        worker.metadata = Metadata.get_by_id(dealer.plug, fid)
+        worker.filename = worker.metadata.filename
+        return worker.copy_duplicate()
+    finally:
+        worker.context.destroy()
+
+
+def test_copy_duplicate(plug, dealer, add):
+    original = add(u'original', u'c1')
+    original.set_uptodate()
+    copy = add(u'copy', u'c1')
+
+    assert copy_duplicate(dealer, copy.fid)
+    assert plug.copied == [(u'original', u'copy')]
+    assert copy.is_uptodate
+
+
+def test_copy_outdated_duplicate(plug, dealer, add):
+    original = add(u'original', u'c1')
+    original.set_uptodate()
+    copy = add(u'copy', u'c1')
+
+    # The original has been modified, but its checksum was not computed
+    original = Metadata.get_by_id(plug, original.fid)
+    original.checksum = None
+    original.write()
+
+    assert not copy_duplicate(dealer, copy.fid)
+    assert plug.copied == []
+
+    # Not up-to-date on the service
+    add(u'other', u'c1')
+    assert not copy_duplicate(dealer, copy.fid)
+    assert plug.copied == []
+
+
+@pytest.fixture
+def updating_plug(plug, add, escalator):
+    # The file is known with this content, on another service
+    original = add(u'file', u'c1')
+    escalator.put(u'file:{}:uptodate:B'.format(original.fid), 0)
+    return plug
+
+
+def test_same_size_edit(updating_plug):
+    plug = updating_plug
+    metadata = Metadata.get(plug, u'f', u'file')
+
+    # The driver does not compute the checksum of the new content
+    plug.update_file(metadata)
+
+    assert [args[1] for args in plug.notified] == [metadata.fid]
+    assert metadata.uptodate_services == (u'A',)
+    assert Metadata.get(plug, u'f', u'file').checksum is None
+
+
+def test_same_content(updating_plug):
+    plug = updating_plug
+    metadata = Metadata.get(plug, u'f', u'file')
+    metadata.checksum = u'c1'
+
+    plug.update_file(metadata)
+
+    assert plug.notified == []
+    assert sorted(metadata.uptodate_services) == [u'A', u'B']
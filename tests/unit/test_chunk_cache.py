@@ -0,0 +1,74 @@
+import time
+
+from onitu.brocker.cache import ChunkCache
+
+
+def test_get_put():
+    cache = ChunkCache(1000)
+
+    assert cache.get('a') is None
+
+    cache.put('a', [b'C', b'0' * 100])
+
+    assert cache.get('a') == [b'C', b'0' * 100]
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hit_rate'] == 0.5
+
+
+def test_disabled():
+    cache = ChunkCache(0)
+    cache.put('a', [b'C', b'0'])
+
+    assert cache.get('a') is None
+
+
+def test_eviction():
+    cache = ChunkCache(250)
+
+    cache.put('a', [b'0' * 100])
+    cache.put('b', [b'1' * 100])
+    cache.get('a')
+    cache.put('c', [b'2' * 100])
+
+    # b is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['memory_size'] == 200
+
+    cache.put('d', [b'3' * 300])
+    assert cache.get('d') is None
+
+
+def test_expiration():
+    cache = ChunkCache(1000, ttl=0.05)
+
+    cache.put('a', [b'0'])
+    assert cache.get('a') is not None
+
+    time.sleep(0.1)
+    assert cache.get('a') is None
+
+    cache.put('b', [b'0'])
+    time.sleep(0.1)
+    cache.purge()
+    assert cache.stats()['entries'] == 0
+
+
+def test_spill():
+    cache = ChunkCache(150, disk_size=1000)
+
+    try:
+        cache.put('a', [b'C', b'0' * 100])
+        cache.put('b', [b'C', b'1' * 100])
+
+        assert cache.stats()['disk_size'] == 101
+
+        assert cache.get('a') == [b'C', b'0' * 100]
+        # a is back in memory, so b has been spilled
+        assert cache.get('b') == [b'C', b'1' * 100]
+        assert cache.stats()['hits'] == 2
+    finally:
+        cache.close()
@@ -0,0 +1,32 @@
+from onitu.plug import compression
+
+
+def test_is_compressed():
+    assert compression.is_compressed('image/jpeg') is True
+    assert compression.is_compressed('video/ogg') is True
+    assert compression.is_compressed('application/zip') is True
+
+    assert compression.is_compressed('image/svg+xml') is False
+    assert compression.is_compressed('text/csv') is False
+    assert compression.is_compressed('application/octet-stream') is False
+
+
+def test_choose():
+    assert compression.choose(b'zlib') == b'zlib'
+    assert compression.choose(b'foo,zlib') == b'zlib'
+    assert compression.choose(b'foo') is None
+    assert compression.choose(b'') is None
+
+    assert compression.choose(compression.available()) == next(
+        name for name in compression.PREFERENCE if name in compression.CODECS
+    )
+
+
+def test_roundtrip():
+    content = b'onitu,' * 10000
+
+    for codec in compression.CODECS:
+        compressed = compression.compress(codec, content)
+
+        assert len(compressed) < len(content)
+        assert compression.decompress(codec, compressed) == content
@@ -0,0 +1,53 @@
+import pytest
+
+from tornado import gen, ioloop
+from logbook import Logger
+
+from onitu.plug import Plug
+from onitu.plug.exceptions import AbortOperation, DriverError
+
+
+@pytest.fixture
+def plug():
+    plug = Plug()
+    plug.logger = Logger("test")
+
+    @plug.handler()
+    @gen.coroutine
+    def get_chunk(metadata, offset, size):
+        yield gen.moment
+        raise gen.Return(b'0' * size)
+
+    @plug.handler()
+    @gen.coroutine
+    def upload_chunk(metadata, offset, chunk):
+        raise DriverError("Nope")
+
+    @plug.handler()
+    def set_chunk_size(chunk_size):
+        return chunk_size
+
+    return plug
+
+
+def test_is_coroutine(plug):
+    assert plug.is_coroutine('get_chunk')
+    assert not plug.is_coroutine('set_chunk_size')
+    assert not plug.is_coroutine('end_upload')
+
+
+def test_call_coroutine(plug):
+    loop = ioloop.IOLoop()
+
+    try:
+        chunk = loop.run_sync(
+            lambda: plug.call_coroutine('get_chunk', None, 0, 10)
+        )
+        assert chunk == b'0' * 10
+
+        with pytest.raises(AbortOperation):
+            loop.run_sync(
+                lambda: plug.call_coroutine('upload_chunk', None, 0, b'')
+            )
+    finally:
+        loop.close()
@@ -0,0 +1,79 @@
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from onitu.plug.dealer import Dealer
+from onitu.referee import UP, MOV, DEL_DIR
+
+
+def test_nested_worker(plug, create):
+    old = create(u'old')
+    new = create(u'new')
+
+    dealer = Dealer(plug)
+    plug.transfers.limit = 2
+    # Another transfer is in progress
+    plug.transfers.acquire()
+
+    # Without a move_file handler, the file is transferred again by a
+    # worker run inside the move
+    dealer.call(MOV, old.fid, new.fid)
+    dealer.pool.close()
+    dealer.pool.join()
+
+    assert plug.transfers.used == 1
+
+
+def test_move_then_update(plug, create):
+    old = create(u'old')
+    new = create(u'new', uptodate=False)
+    moved = []
+
+    @plug.handler()
+    def move_file(old_metadata, new_metadata):
+        moved.append(new_metadata.filename)
+
+    dealer = Dealer(plug)
+    dealer.pool.terminate()
+    dealer.pool = ThreadPool(1)
+    busy = threading.Event()
+    dealer.pool.apply_async(busy.wait)
+
+    # The file is created again while the move is waiting
+    dealer.call(MOV, old.fid, new.fid)
+    dealer.call(UP, old.fid)
+    busy.set()
+    dealer.pool.close()
+    dealer.pool.join()
+
+    assert moved == [u'new']
+
+
+def test_update_during_directory_deletion(plug, create):
+    a = create(u'dir/a')
+    b = create(u'dir/b')
+    deleted = []
+
+    @plug.handler()
+    def delete_file(metadata):
+        deleted.append(metadata.filename)
+
+    dealer = Dealer(plug)
+    dealer.pool.terminate()
+    dealer.pool = ThreadPool(1)
+    busy = threading.Event()
+    dealer.pool.apply_async(busy.wait)
+
+    dealer.call(DEL_DIR, u'event', u'f', u'dir/', [a.fid, b.fid])
+    # The worker can be found from the files of the directory
+    assert dealer.in_progress[a.fid] == dealer.in_progress[b.fid]
+
+    # The file is updated before the directory is deleted
+    dealer.stop_transfer(a.fid)
+    busy.set()
+    dealer.pool.close()
+    dealer.pool.join()
+
+    assert deleted == [u'dir/b']
+    assert plug.list(u'f') == {u'dir/a': a.fid}
+    assert not dealer.in_progress
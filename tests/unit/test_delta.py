@@ -0,0 +1,48 @@
+import os
+
+from onitu.plug import delta
+
+
+def test_file_signature():
+    content = os.urandom(2500)
+
+    signature = delta.file_signature(content, 1000)
+
+    assert len(signature) == 3
+    assert signature[0] == delta.block_signature(content[:1000])
+    assert signature[2] == delta.block_signature(content[2000:])
+
+    assert delta.file_signature(b'', 1000) == []
+
+
+def test_block_changed():
+    content = os.urandom(3000)
+    signature = delta.file_signature(content, 1000)
+
+    assert delta.block_changed(signature, 0, content[:1000]) is False
+    assert delta.block_changed(signature, 1, content[1000:2000]) is False
+    assert delta.block_changed(signature, 1, content[:1000]) is True
+    assert delta.block_changed(signature, 2, content[2000:2500]) is True
+    assert delta.block_changed(signature, 3, content[:1000]) is True
+
+
+def test_changed_blocks():
+    old = os.urandom(4000)
+    new = old[:1000] + os.urandom(1000) + old[2000:] + os.urandom(500)
+    signature = delta.file_signature(old, 1000)
+
+    changed = [
+        offset for offset in range(0, len(new), 1000)
+        if delta.block_changed(
+            signature, offset // 1000, new[offset:offset + 1000]
+        )
+    ]
+
+    assert changed == [1000, 4000]
+
+
+def test_pack():
+    signature = delta.file_signature(os.urandom(2000), 1000)
+
+    assert delta.unpack(delta.pack(signature)) == tuple(signature)
+    assert delta.unpack(delta.pack([0, 1000])) == (0, 1000)
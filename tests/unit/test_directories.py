@@ -0,0 +1,165 @@
+import pytest
+
+from logbook import Logger
+
+from onitu.plug.metadata import Metadata
+from onitu.plug.workers import DirectoryDeletionWorker, DirectoryMoveWorker
+from onitu.referee import Referee, UP, MOV_DIR, DEL_DIR
+from onitu.referee.folder import Folder as RefereeFolder
+
+
+@pytest.fixture
+def plug(plug):
+    plug.calls = []
+    return plug
+
+
+def handler(plug, name):
+    @plug.handler(name)
+    def record(*args):
+        plug.calls.append((name,) + tuple(
+            arg.filename if isinstance(arg, Metadata) else arg
+            for arg in args
+        ))
+
+
+def run(dealer, worker_class, *args):
+    worker = worker_class(dealer, u'event', *args)
+
+    try:
+        assert worker.load()
+        worker.do()
+    finally:
+        worker.context.destroy()
+
+
+def move(dealer, create, filenames):
+    pairs = []
+    for filename in filenames:
+        old = create(u'dir/' + filename)
+        new = create(u'new/' + filename, uptodate=False)
+        pairs.append((old.fid, new.fid))
+
+    run(dealer, DirectoryMoveWorker, u'f', u'dir/', u'new/', pairs)
+
+
+def test_has_all_files(dealer, create):
+    a = create(u'dir/a')
+    b = create(u'dir/b')
+    create(u'other/c')
+    worker = DirectoryDeletionWorker(
+        dealer, u'event', u'f', u'dir/', [a.fid]
+    )
+
+    try:
+        worker.load()
+        # The service has another file in the directory
+        assert not worker.has_all_files()
+
+        worker.fids.append(b.fid)
+        assert worker.has_all_files()
+    finally:
+        worker.context.destroy()
+
+
+def test_move_directory(plug, dealer, create):
+    handler(plug, 'move_directory')
+    handler(plug, 'move_file')
+
+    move(dealer, create, [u'a', u'b'])
+
+    assert plug.calls == [(u'move_directory', u'/f/dir', u'/f/new')]
+    assert sorted(plug.list(u'f')) == [u'new/a', u'new/b']
+
+
+def test_move_directory_fallback(plug, dealer, create):
+    handler(plug, 'move_directory')
+    handler(plug, 'move_file')
+    # The file is only on this service, so the directory cannot be moved
+    # as a whole
+    create(u'dir/c')
+
+    move(dealer, create, [u'a', u'b'])
+
+    assert sorted(plug.calls) == [
+        (u'move_file', u'dir/a', u'new/a'),
+        (u'move_file', u'dir/b', u'new/b'),
+    ]
+    assert sorted(plug.list(u'f')) == [u'dir/c', u'new/a', u'new/b']
+
+
+def test_delete_directory(plug, dealer, create):
+    handler(plug, 'delete_file')
+    a = create(u'dir/a')
+    b = create(u'dir/b')
+
+    # Without a delete_directory handler, the files are deleted one by one
+    run(dealer, DirectoryDeletionWorker, u'f', u'dir/', [a.fid, b.fid])
+
+    assert sorted(plug.calls) == [
+        (u'delete_file', u'dir/a'), (u'delete_file', u'dir/b')
+    ]
+    assert plug.list(u'f') == {}
+
+
+@pytest.fixture
+def referee():
+    referee = Referee.__new__(Referee)
+    referee.logger = Logger("test")
+    referee.folders = {u'f': RefereeFolder(
+        u'f', {u'A': {}, u'B': {}, u'C': {u'blacklist': [u'*.tmp']}},
+        Logger("test"), {}
+    )}
+    referee.notifications = []
+    referee.metadata = {}
+
+    for fid, filename in ((u'1', u'dir/a'), (u'2', u'dir/b.tmp'),
+                          (u'3', u'new/a'), (u'4', u'new/b.tmp'),
+                          (u'5', u'new/c')):
+        referee.metadata[fid] = {
+            'filename': filename, 'folder_name': u'f', 'size': 0,
+            'mimetype': u'text/plain'
+        }
+
+    return referee
+
+
+def notifications(referee):
+    return sorted(
+        (tuple(services), cmd, args[-1])
+        for services, cmd, _, args in referee.notifications
+    )
+
+
+def test_referee_delete_directory(referee):
+    referee._handle_delete_directory(
+        u'event', u'A', u'f', u'dir/', [u'1', u'2']
+    )
+
+    assert notifications(referee) == [
+        ((u'B',), DEL_DIR, [u'1', u'2']),
+        ((u'C',), DEL_DIR, [u'1']),
+    ]
+
+
+def test_referee_move_directory(referee):
+    # The file 6 was only on the source
+    referee._handle_move_directory(
+        u'event', u'A', u'f', u'dir/', u'new/',
+        [(u'1', u'3'), (u'2', u'4'), (u'6', u'5')]
+    )
+
+    assert sorted(
+        (tuple(sorted(services)), cmd, fid)
+        for services, cmd, fid, _ in referee.notifications
+        if cmd == UP
+    ) == [((u'B', u'C'), UP, u'5')]
+
+    assert sorted(
+        (tuple(services), args[-1])
+        for services, cmd, _, args in referee.notifications
+        if cmd == MOV_DIR
+    ) == [
+        ((u'B',), [(u'1', u'3'), (u'2', u'4')]),
+        ((u'C',), [(u'1', u'3')]),
+    ]
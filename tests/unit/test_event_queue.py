@@ -0,0 +1,160 @@
+from onitu.referee import UP, DEL, MOV, MOV_DIR, DEL_DIR
+from onitu.plug.events import EventQueue, MAX_DELAY_FACTOR
+
+
+def test_no_debounce():
+    queue = EventQueue()
+
+    queue.push('a', UP, (), now=10)
+
+    assert queue.pop_ready(now=10) == [('a', UP, ())]
+    assert queue.timeout() is None
+
+
+def test_debounce():
+    queue = EventQueue(1)
+
+    for now in range(5):
+        queue.push('a', UP, (), now=now)
+
+    assert queue.pop_ready(now=4.5) == []
+    assert queue.timeout(now=4.5) == 0.5
+    assert queue.pop_ready(now=5) == [('a', UP, ())]
+    assert queue.stats() == {'received': 5, 'coalesced': 4, 'pending': 0}
+
+
+def test_max_delay():
+    queue = EventQueue(1)
+
+    for now in range(MAX_DELAY_FACTOR * 2):
+        queue.push('a', UP, (), now=now * 0.5)
+
+    assert queue.pop_ready(now=MAX_DELAY_FACTOR) == [('a', UP, ())]
+
+
+def test_update_then_delete():
+    queue = EventQueue(1)
+
+    queue.push('a', UP, (), now=0)
+    queue.push('a', DEL, (), now=0)
+
+    assert queue.pop_ready(now=1) == [('a', DEL, ())]
+
+
+def test_move_chain():
+    queue = EventQueue(1)
+
+    assert queue.push('a', MOV, ('b',), now=0) == 'a'
+    assert queue.push('b', MOV, ('c',), now=0) == 'a'
+    assert queue.get('a') == (MOV, ('c',))
+
+    assert queue.push('c', DEL, (), now=0) == 'a'
+    assert queue.pop_ready(now=1) == [('a', DEL, ())]
+    assert queue.stats()['coalesced'] == 2
+
+
+def test_directory():
+    queue = EventQueue(1)
+
+    queue.push('a', UP, (), now=0)
+    queue.push('b', UP, (), now=0)
+    queue.push('c', UP, (), now=0)
+
+    move = ('folder', 'd/', 'e/', [('a', 'x'), ('b', 'y')])
+    delete = ('folder', 'f/', ['c'])
+    queue.push('dir', MOV_DIR, move, now=0)
+    queue.push('dir2', DEL_DIR, delete, now=0)
+
+    assert sorted(queue.pop_ready(now=1)) == [
+        ('dir', MOV_DIR, move), ('dir2', DEL_DIR, delete)
+    ]
+    assert queue.stats()['coalesced'] == 3
+
+
+def test_limit():
+    queue = EventQueue(1)
+
+    queue.push('a', UP, (), now=1)
+    queue.push('b', UP, (), now=0)
+    queue.push('c', UP, (), now=2)
+
+    assert queue.pop_ready(now=5, limit=2) == [('b', UP, ()), ('a', UP, ())]
+    assert queue.pop_ready(now=5, limit=0) == []
+    assert queue.pop_ready(now=5) == [('c', UP, ())]
+
+
+def test_move_then_update():
+    queue = EventQueue(1)
+
+    queue.push('a', MOV, ('b',), now=0)
+    queue.push('a', UP, (), now=0)
+    queue.push('a', UP, (), now=0)
+
+    # The file is created again after the move
+    assert queue.pop_ready(now=1) == [('a', MOV, ('b',)), ('a', UP, ())]
+    assert queue.stats()['coalesced'] == 1
+    assert not queue.moves
+
+
+def test_move_then_delete():
+    queue = EventQueue(1)
+
+    queue.push('a', MOV, ('b',), now=0)
+    queue.push('a', UP, (), now=0)
+    queue.push('a', DEL, (), now=0)
+    # The destination of the move is deleted
+    queue.push('b', DEL, (), now=0)
+
+    assert queue.pop_ready(now=1) == [('a', DEL, ()), ('a', DEL, ())]
+
+
+def test_move_index():
+    queue = EventQueue(1)
+
+    queue.push('a', MOV, ('b',), now=0)
+    queue.push('b', MOV, ('c',), now=0)
+    assert queue.moves == {'c': 'a'}
+
+    queue.push('dir', DEL_DIR, ('folder', 'd/', ['a']), now=0)
+    assert not queue.moves
+
+
+def test_limit_events_of_a_file():
+    queue = EventQueue(1)
+
+    queue.push('a', MOV, ('b',), now=0)
+    queue.push('a', UP, (), now=0)
+
+    assert queue.pop_ready(now=1, limit=1) == [('a', MOV, ('b',))]
+    assert 'a' in queue
+    assert queue.pop_ready(now=1) == [('a', UP, ())]
+    assert 'a' not in queue
+
+
+def test_deadlines():
+    queue = EventQueue(1)
+
+    for now in range(1000):
+        queue.push('a', UP, (), now=now * 0.001)
+    queue.push('b', UP, (), now=0.5)
+
+    # The outdated deadlines of the file are dropped
+    assert len(queue.deadlines) < 50
+    assert queue.timeout(now=1) == 0.5
+    assert queue.pop_ready(now=1.5) == [('b', UP, ())]
+    assert queue.pop_ready(now=2) == [('a', UP, ())]
+    assert queue.timeout() is None
+    assert not queue.deadlines
+
+
+def test_removed_deadline():
+    queue = EventQueue(1)
+
+    queue.push('a', UP, (), now=0)
+    queue.push('b', UP, (), now=1)
+    queue.push('dir', DEL_DIR, ('folder', 'd/', ['a']), now=1)
+
+    assert queue.timeout(now=1) == 1
+    assert queue.pop_ready(now=2) == [('b', UP, ()), ('dir', DEL_DIR, (
+        'folder', 'd/', ['a']
+    ))]
@@ -0,0 +1,70 @@
+from onitu.escalator.client import Log
+
+
+class Batch(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.data.pop(key, None)
+
+
+class FakeEscalator(object):
+    def __init__(self):
+        self.data = {}
+        self.compacted = []
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def range(self, start, stop, include_start=True, include_stop=False,
+              include_value=True):
+        keys = sorted(
+            key for key in self.data
+            if (start < key or (include_start and key == start)) and
+            (key < stop or (include_stop and key == stop))
+        )
+        if include_value:
+            return tuple((key, self.data[key]) for key in keys)
+        return tuple(keys)
+
+    def write_batch(self):
+        return Batch(self)
+
+    def compact(self, start, stop):
+        self.compacted.append((start, stop))
+
+
+def test_read():
+    escalator = FakeEscalator()
+    log = Log(escalator, u'log:')
+
+    for sequence in range(1, 20):
+        log.append(sequence, sequence * 10)
+    escalator.put(u'other', 0)
+
+    assert log.read() == [(i, i * 10) for i in range(1, 20)]
+    assert log.read(17) == [(18, 180), (19, 190)]
+    assert log.lag(17) == 2
+
+
+def test_truncate():
+    escalator = FakeEscalator()
+    log = Log(escalator, u'log:')
+
+    for sequence in range(1, 5):
+        log.append(sequence, None)
+
+    assert log.truncate(2) == 2
+    assert log.read() == [(3, None), (4, None)]
+    assert escalator.compacted == [(u'log:', log.key(2))]
+    assert log.truncate(2) == 0
@@ -0,0 +1,66 @@
+import pytest
+
+from onitu.plug.metadata import Metadata
+from onitu.referee import UP, MOV, MOV_DIR
+from onitu.utils import get_fid, get_partition
+
+PARTITIONS = 4
+
+
+@pytest.fixture
+def plug(plug):
+    plug.publishers = [None] * PARTITIONS
+    return plug
+
+
+def other_partition(fid):
+    """Return a name whose file is in another partition than `fid`."""
+    partition = get_partition(fid, PARTITIONS)
+    return next(
+        name for name in (u'new{}'.format(i) for i in range(100))
+        if get_partition(get_fid(u'f', name), PARTITIONS) != partition
+    )
+
+
+def test_move(plug, create):
+    metadata = create(u'old')
+    partition = plug.partition(metadata)
+    new_name = other_partition(metadata.fid)
+
+    plug.move_file(metadata, u'/f/' + new_name)
+    assert plug.notified[-1][:3] == (partition, metadata.fid, MOV)
+
+    # The next events of the new file follow the move
+    new_metadata = Metadata.get(plug, u'f', new_name)
+    new_metadata.size = 10
+    plug.update_file(new_metadata)
+    assert plug.notified[-1] == (partition, new_metadata.fid, UP, u'A')
+
+
+def test_move_directory(plug, create):
+    files = [create(u'dir/{}'.format(i)) for i in range(10)]
+    partitions = set(plug.partition(metadata) for metadata in files)
+    assert len(partitions) > 1
+
+    moved = plug.move_directory(plug.folders[u'f'], u'dir', u'new')
+
+    # The files are in several partitions, so they are moved one by one
+    assert sorted(args[2] for args in plug.notified) == [MOV] * 10
+    assert sorted(
+        (metadata.partition, metadata.filename) for metadata in moved
+    ) == sorted(
+        (plug.partition(metadata), u'new/' + metadata.filename[4:])
+        for metadata in files
+    )
+
+
+def test_move_directory_single_partition(plug, create):
+    plug.publishers = [None]
+    create(u'dir/a')
+    create(u'dir/b')
+
+    plug.move_directory(plug.folders[u'f'], u'dir', u'new')
+
+    assert len(plug.notified) == 1
+    assert plug.notified[0][0] == 0
+    assert plug.notified[0][2] == MOV_DIR
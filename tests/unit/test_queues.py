@@ -0,0 +1,47 @@
+from onitu.plug.dealer import Dealer
+from onitu.referee import UP
+
+
+def test_resume_transfers(plug, queues, escalator):
+    # A transfer written by a previous version in the metadata database
+    escalator.put(u'service:A:transfer:X', 32)
+    queues.put(u'service:A:transfer:Y', 16)
+
+    dealer = Dealer(plug)
+    try:
+        dealer.resume_transfers()
+    finally:
+        dealer.pool.terminate()
+
+    assert not escalator.range(prefix=u'service:A:transfer:')
+    assert queues.range(prefix=u'service:A:transfer:') == (
+        (u'service:A:transfer:X', 32), (u'service:A:transfer:Y', 16)
+    )
+    assert dealer.queue.get(u'X') == (UP, (32, True))
+    assert dealer.queue.get(u'Y') == (UP, (16, True))
+
+
+def test_update_file(plug, queues, create):
+    metadata = create(u'file')
+    key = u'service:A:transfer:{}'.format(metadata.fid)
+    queues.put(key, 16)
+
+    plug.update_file(metadata)
+
+    assert not queues.exists(key)
+    assert plug.dealer.stopped == [metadata.fid]
+
+
+def test_usage(plug, queues, escalator):
+    escalator.put(u'options', {'max_transfers': 4})
+    escalator.put(u'services', [u'A', u'B'])
+    queues.put(u'service:B:usage', {'transfers': {'used': 3}})
+    plug.transfers.acquire()
+
+    plug.refresh_budgets({'max_transfers': 2})
+
+    assert plug.other_transfers == 3
+    assert queues.get(u'service:A:usage')['transfers'] == {
+        'used': 1, 'peak': 1, 'limit': 2
+    }
+    assert not escalator.exists(u'service:A:usage')
@@ -1,61 +1,60 @@
-from logbook import Logger
-from onitu.referee.folder import Folder
-
+import pytest
 
-def test_init_size():
+from logbook import Logger
+from onitu.referee.folder import Folder, validate, to_bytes
 
-    f = Folder('folder', {}, Logger(), {})
 
-    assert f._to_bytes(10) == 10
-    assert f._to_bytes(15.3) == 15
+def test_to_bytes():
+    assert to_bytes(10) == 10
+    assert to_bytes(15.3) == 15
 
-    assert f._to_bytes(0) == 0
-    assert f._to_bytes(None) is None
-    assert f._to_bytes('') is None
-    assert f._to_bytes('toto') is None
-    assert f._to_bytes('2toto') is None
+    assert to_bytes(0) == 0
+    assert to_bytes(None) is None
+    assert to_bytes('') is None
+    assert to_bytes('toto') is None
+    assert to_bytes('2toto') is None
 
-    assert f._to_bytes('10') == 10
-    assert f._to_bytes('  10 ') == 10
-    assert f._to_bytes('10B') == 10
-    assert f._to_bytes('10o') == 10
+    assert to_bytes('10') == 10
+    assert to_bytes('  10 ') == 10
+    assert to_bytes('10B') == 10
+    assert to_bytes('10o') == 10
 
-    assert f._to_bytes('10 000') == 10000
-    assert f._to_bytes('10000') == 10000
-    assert f._to_bytes(' 10 000') == 10000
+    assert to_bytes('10 000') == 10000
+    assert to_bytes('10000') == 10000
+    assert to_bytes(' 10 000') == 10000
 
-    assert f._to_bytes('15k') == 15000
-    assert f._to_bytes('15 k') == 15000
-    assert f._to_bytes(' 15 k ') == 15000
-    assert f._to_bytes('15K') == 15000
-    assert f._to_bytes('15ko') == 15000
-    assert f._to_bytes('15Kb') == 15000
+    assert to_bytes('15k') == 15000
+    assert to_bytes('15 k') == 15000
+    assert to_bytes(' 15 k ') == 15000
+    assert to_bytes('15K') == 15000
+    assert to_bytes('15ko') == 15000
+    assert to_bytes('15Kb') == 15000
 
-    assert f._to_bytes('11m') == 11000000
-    assert f._to_bytes('11 Mb') == 11000000
-    assert f._to_bytes(' 11MB') == 11000000
+    assert to_bytes('11m') == 11000000
+    assert to_bytes('11 Mb') == 11000000
+    assert to_bytes(' 11MB') == 11000000
 
-    assert f._to_bytes('123 456.0 Mo') == 123456000000
+    assert to_bytes('123 456.0 Mo') == 123456000000
 
-    assert f._to_bytes('7.5g') == 7500000000
-    assert f._to_bytes('7.5 G') == 7500000000
-    assert f._to_bytes('7.5go') == 7500000000
-    assert f._to_bytes('7.5 Gb') == 7500000000
+    assert to_bytes('7.5g') == 7500000000
+    assert to_bytes('7.5 G') == 7500000000
+    assert to_bytes('7.5go') == 7500000000
+    assert to_bytes('7.5 Gb') == 7500000000
 
-    assert f._to_bytes('42t') == 42000000000000
-    assert f._to_bytes('42 Tb') == 42000000000000
-    assert f._to_bytes('42 to') == 42000000000000
+    assert to_bytes('42t') == 42000000000000
+    assert to_bytes('42 Tb') == 42000000000000
+    assert to_bytes('42 to') == 42000000000000
 
-    assert f._to_bytes('3P') == 3000000000000000
-    assert f._to_bytes('3 pb') == 3000000000000000
-    assert f._to_bytes('3 Po') == 3000000000000000
+    assert to_bytes('3P') == 3000000000000000
+    assert to_bytes('3 pb') == 3000000000000000
+    assert to_bytes('3 Po') == 3000000000000000
 
-    assert f._to_bytes('2 Ki') == 2048
-    assert f._to_bytes('2ki') == 2048
-    assert f._to_bytes('6mi') == 6291456
-    assert f._to_bytes('  7  GI') == 7516192768
-    assert f._to_bytes('13Ti') == 14293651161088
-    assert f._to_bytes('1 000 Pi') == 1125899906842624000
+    assert to_bytes('2 Ki') == 2048
+    assert to_bytes('2ki') == 2048
+    assert to_bytes('6mi') == 6291456
+    assert to_bytes('  7  GI') == 7516192768
+    assert to_bytes('13Ti') == 14293651161088
+    assert to_bytes('1 000 Pi') == 1125899906842624000
 
 
 def test_no_size():
@@ -247,3 +246,43 @@ def test_whitelist():
     assert do_test('titi') is True
     assert do_test('tuto') is True
     assert do_test('tototo') is False
+
+
+def test_targets():
+    f = Folder('folder', {
+        'A': {},
+        'B': {'mode': 'r'},
+        'C': {'mimetypes': ['image/*']},
+        'D': {'blacklist': ['*.tmp'], 'file_size': {'max': '1k'}},
+    }, Logger(), {})
+
+    def do_test(filename, size, mimetype, source='A'):
+        return f.targets(
+            {'filename': filename, 'size': size, 'mimetype': mimetype},
+            source)
+
+    assert do_test('foo.png', 10, 'image/png') == {'C', 'D'}
+    assert do_test('foo.tmp', 10, 'image/png') == {'C'}
+    assert do_test('foo.txt', 2000, 'text/plain') == set()
+    assert do_test('foo.txt', 10, 'text/plain', source='B') == {'A', 'D'}
+    assert do_test('foo.txt', 10, 'text/plain', source='C') == set()
+
+
+def test_validate():
+    validate({})
+    validate({'mode': 'r', 'file_size': {'min': 10, 'max': '10 Mi'},
+              'mimetypes': ['image/*'], 'blacklist': ['*.tmp']})
+
+    for options in (
+        [],
+        {'mode': 'zz'},
+        {'file_size': 10},
+        {'file_size': {'max': '10 XB'}},
+        {'file_size': {'min': ''}},
+        {'file_size': {'min': True}},
+        {'blacklist': '*.tmp'},
+        {'whitelist': [1]},
+        {'mimetypes': {}},
+    ):
+        with pytest.raises(ValueError):
+            validate(options)
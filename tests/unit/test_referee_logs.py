@@ -0,0 +1,125 @@
+from logbook import Logger
+
+from onitu.escalator.client import Log
+from onitu.referee import Referee, UP, DEL, MOV
+from onitu.referee.folder import Folder
+
+
+def make_referee(escalator, services):
+    referee = Referee.__new__(Referee)
+    referee.prefix = u'referee:0:'
+    referee.queues = escalator
+    referee.services = services
+    referee.cursors = {}
+    referee.logs = {}
+    return referee
+
+
+def test_order(escalator):
+    referee = make_referee(escalator, [u'B', u'A'])
+    a = Log(escalator, u'referee:0:log:A:')
+    b = Log(escalator, u'referee:0:log:B:')
+
+    a.append(1, (u'X', (DEL, u'A'), 10.))
+    b.append(1, (u'X', (UP, u'B'), 11.))
+    a.append(2, (u'Y', (UP, u'A'), 12.))
+
+    events, cursors = referee.read_logs()
+
+    assert events == [
+        (u'X', (DEL, u'A')), (u'X', (UP, u'B')), (u'Y', (UP, u'A'))
+    ]
+    assert cursors == {u'A': 2, u'B': 1}
+
+
+def test_order_in_log(escalator):
+    referee = make_referee(escalator, [u'A', u'B'])
+    a = Log(escalator, u'referee:0:log:A:')
+    b = Log(escalator, u'referee:0:log:B:')
+
+    # An event of a previous version, without time
+    a.append(1, (u'X', (UP, u'A')))
+    a.append(2, (u'Y', (UP, u'A'), 12.))
+    # The clock went backwards
+    a.append(3, (u'Y', (DEL, u'A'), 11.))
+    b.append(1, (u'Y', (UP, u'B'), 13.))
+
+    events, _ = referee.read_logs()
+
+    assert events == [
+        (u'X', (UP, u'A')), (u'Y', (UP, u'A')), (u'Y', (DEL, u'A')),
+        (u'Y', (UP, u'B'))
+    ]
+
+
+def test_handle_events(escalator):
+    referee = make_referee(escalator, [u'A'])
+    referee.escalator = escalator
+    referee.flush = lambda cursors: None
+    handled = []
+
+    def handler(cmd):
+        return lambda fid, *args: handled.append((cmd, fid))
+
+    referee.handlers = dict((cmd, handler(cmd)) for cmd in (UP, DEL, MOV))
+
+    referee.handle_events([
+        (u'X', (MOV, u'A', u'Y')), (u'X', (UP, u'A')),
+        (u'Z', (UP, u'A')), (u'Z', (UP, u'B')),
+        (u'W', (UP, u'A')), (u'W', (DEL, u'A')), (u'W', (UP, u'A')),
+    ])
+
+    # Only the update followed by another update is dropped
+    assert handled == [
+        (MOV, u'X'), (UP, u'X'), (UP, u'Z'),
+        (UP, u'W'), (DEL, u'W'), (UP, u'W'),
+    ]
+
+
+class Publisher(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+def test_batch(escalator):
+    referee = make_referee(escalator, [u'A', u'B', u'C'])
+    referee.partition = 0
+    referee.escalator = escalator
+    referee.logger = Logger("test")
+    referee.publisher = Publisher()
+    referee.sequence = 0
+    referee.notifications = []
+    referee.folders = {u'f': Folder(
+        u'f', {u'A': {}, u'B': {}, u'C': {}}, Logger("test"), {}
+    )}
+    referee.handlers = {
+        UP: referee._handle_update, DEL: referee._handle_deletion
+    }
+
+    for fid in (u'X', u'Y'):
+        escalator.put(u'file:{}'.format(fid), {
+            'filename': fid, 'folder_name': u'f', 'size': 0,
+            'mimetype': u'text/plain'
+        })
+
+    reads = []
+    multi_get = escalator.multi_get
+    escalator.multi_get = lambda keys: reads.append(keys) or multi_get(keys)
+
+    referee.handle_events([
+        (u'X', (UP, u'A')), (u'Y', (UP, u'A')), (u'X', (DEL, u'B')),
+    ], {u'A': 2, u'B': 1})
+
+    # The metadata are read at once
+    assert len(reads) == 1
+    assert [
+        event for _, event in
+        escalator.range(prefix=u'service:C:queue:0:')
+    ] == [(u'X', UP, ()), (u'Y', UP, ()), (u'X', DEL, ())]
+    assert escalator.get(u'referee:0:cursors') == {u'A': 2, u'B': 1}
+    assert escalator.get(u'referee:0:sequence') == 3
+    # Each service is woken up once
+    assert sorted(referee.publisher.sent) == [b'A', b'B', b'C']
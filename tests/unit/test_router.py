@@ -0,0 +1,111 @@
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, ioloop, locks
+
+from onitu.plug.metadata import Metadata
+from onitu.plug.router import Router
+
+
+@pytest.fixture
+def loop():
+    loop = ioloop.IOLoop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def router(plug, loop):
+    plug.options.update({'prefetch_chunks': 2, 'prefetch_memory': 1000})
+    plug.reads = []
+
+    @plug.handler()
+    @gen.coroutine
+    def get_chunk(metadata, offset, size):
+        plug.reads.append(offset)
+        raise gen.Return(b'0' * size)
+
+    router = Router(plug)
+    router.loop = loop
+    router.released = locks.Condition()
+    router.pool = ThreadPoolExecutor(1)
+    plug.router = router
+
+    yield router
+    router.pool.shutdown()
+
+
+@pytest.fixture
+def metadata(create):
+    return create(u'file', size=64)
+
+
+def test_prefetch(plug, loop, router, metadata):
+    @gen.coroutine
+    def read(offset):
+        chunk = yield router._get_chunk(metadata, offset, 16)
+        # The chunks read in advance are read in the background
+        yield gen.moment
+        raise gen.Return(chunk)
+
+    loop.run_sync(lambda: read(0))
+    loop.run_sync(lambda: read(16))
+    # The file is read sequentially, so the next chunks are prefetched
+    assert sorted(plug.reads) == [0, 16, 32, 48]
+    assert plug.download_buffers.used == 32
+
+    assert loop.run_sync(lambda: read(32)) == b'0' * 16
+    assert sorted(plug.reads) == [0, 16, 32, 48]
+    # The last chunk is still in advance
+    assert plug.download_buffers.used == 16
+
+
+def test_invalidate(plug, loop, router, metadata):
+    loop.run_sync(lambda: router._get_chunk(metadata, 0, 16))
+    loop.run_sync(lambda: router._get_chunk(metadata, 16, 16))
+    loop.run_sync(lambda: gen.moment)
+    assert router.get_metadata(metadata.fid) is router.get_metadata(
+        metadata.fid
+    )
+
+    router.invalidate(metadata.fid)
+    loop.run_sync(lambda: gen.moment)
+
+    # The chunks and the metadata read before the change are dropped
+    assert not router.prefetched
+    assert plug.download_buffers.used == 0
+    assert metadata.fid not in router.sessions
+
+
+def test_session(plug, router, metadata):
+    session = router.get_metadata(metadata.fid)
+
+    # The chunks of a transfer use the metadata read at its beginning
+    updated = Metadata.get_by_id(plug, metadata.fid)
+    updated.size = 10
+    updated.write()
+    assert router.get_metadata(metadata.fid) is session
+    assert router.get_metadata(metadata.fid, refresh=True).size == 10
+
+
+def test_admit(plug, loop, router):
+    plug.download_buffers.limit = 10
+    plug.download_buffers.acquire(10)
+
+    @gen.coroutine
+    def handler(metadata):
+        raise gen.Return(metadata)
+
+    @gen.coroutine
+    def admit():
+        future = router.admit(5, handler, u'metadata')
+        yield gen.moment
+        assert not future.done()
+
+        # The request is admitted as soon as memory is released
+        plug.download_buffers.release(10)
+        result = yield gen.with_timeout(loop.time() + 1, future)
+        raise gen.Return(result)
+
+    assert loop.run_sync(admit) == u'metadata'
+    assert plug.download_buffers.used == 5
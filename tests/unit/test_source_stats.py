@@ -0,0 +1,58 @@
+from onitu.brocker.stats import SourceStats, ewma
+
+
+def test_ewma():
+    assert ewma(None, 10.) == 10.
+    assert ewma(10., 20., alpha=0.5) == 15.
+
+
+def test_unused_source():
+    stats = SourceStats()
+
+    assert stats.cost() == 0.
+    assert stats.get()['latency'] is None
+
+
+def test_cost():
+    stats = SourceStats()
+
+    started = stats.start() - 0.1
+    stats.end(started, 1000)
+
+    assert stats.in_flight == 0
+    assert 0.1 <= stats.latency < 0.2
+    assert 5000 < stats.throughput <= 10000
+
+    cost = stats.cost()
+    assert cost == stats.latency
+
+    # The requests in progress make the source more expensive
+    stats.start()
+    assert stats.cost() == 2 * cost
+
+
+def test_errors():
+    stats = SourceStats()
+
+    stats.end(stats.start() - 0.1, 1000)
+    cost = stats.cost()
+
+    stats.end(stats.start(), error=True)
+
+    assert stats.error_rate > 0
+    assert stats.cost() > cost
+    assert stats.requests == 2
+
+
+def test_least_loaded():
+    fast, slow = SourceStats(), SourceStats()
+
+    fast.end(fast.start() - 0.01, 1000)
+    slow.end(slow.start() - 0.03, 1000)
+
+    assert fast.cost() < slow.cost()
+
+    for _ in range(3):
+        fast.start()
+
+    assert fast.cost() > slow.cost()
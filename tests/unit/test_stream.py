@@ -0,0 +1,63 @@
+import os
+
+from onitu.plug.stream import FileStream
+
+
+def test_read_content():
+    content = os.urandom(2500)
+    stream = FileStream(content)
+
+    assert stream.read(1000) == content[:1000]
+    assert stream.read(1000) == content[1000:2000]
+    assert stream.read(1000) == content[2000:]
+    assert stream.read(1000) == b''
+    assert stream.offset == 2500
+
+
+def test_read_iterator():
+    content = os.urandom(2500)
+    parts = [content[:300], content[300:1700], b'', content[1700:]]
+    stream = FileStream(iter(parts))
+
+    assert stream.read(1000) == content[:1000]
+    assert stream.read(1000) == content[1000:2000]
+    assert stream.read(1000) == content[2000:]
+    assert stream.read(1000) == b''
+
+
+def test_skip():
+    content = os.urandom(2500)
+    stream = FileStream(content[i:i + 100] for i in range(0, 2500, 100))
+
+    stream.skip(1500, 1000)
+
+    assert stream.offset == 1500
+    assert stream.read(1000) == content[1500:]
+
+
+def test_close():
+    closed = []
+
+    def parts():
+        try:
+            yield b'onitu'
+            yield b'onitu'
+        finally:
+            closed.append(True)
+
+    stream = FileStream(parts())
+    assert stream.read(5) == b'onitu'
+
+    stream.close()
+    assert closed == [True]
+
+
+def test_buffers():
+    content = bytearray(os.urandom(2500))
+    stream = FileStream([memoryview(content)[:1500], content[1500:]])
+
+    chunk = stream.read(1000)
+    assert isinstance(chunk, memoryview)
+    assert chunk == content[:1000]
+    assert stream.read(1000) == content[1000:2000]
+    assert stream.read(1000) == content[2000:]
@@ -0,0 +1,45 @@
+import time
+import threading
+
+from onitu.utils import TokenBucket
+
+
+def test_unlimited():
+    bucket = TokenBucket()
+
+    start = time.time()
+    bucket.consume(10 ** 9)
+
+    assert time.time() - start < 0.1
+
+
+def test_rate():
+    bucket = TokenBucket(1000)
+
+    start = time.time()
+    # The first 1000 tokens are already in the bucket
+    for _ in range(5):
+        bucket.consume(300)
+
+    assert 0.4 < time.time() - start < 0.8
+
+
+def test_change_rate():
+    bucket = TokenBucket(1000)
+    bucket.rate = 0
+
+    start = time.time()
+    bucket.consume(10 ** 6)
+
+    assert time.time() - start < 0.1
+
+
+def test_stop():
+    bucket = TokenBucket(1000)
+    stop = threading.Event()
+    threading.Timer(0.1, stop.set).start()
+
+    start = time.time()
+    bucket.consume(10000, stop)
+
+    assert time.time() - start < 1
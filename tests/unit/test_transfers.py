@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+import zmq
+
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from onitu.brocker.responses import CHUNK
+from onitu.plug.dealer import Dealer
+from onitu.plug.exceptions import AbortOperation
+from onitu.plug.metadata import Metadata
+from onitu.plug.workers import TransferWorker
+
+
+class Channel(object):
+    """Answer all the requests for chunks."""
+
+    def request(self, frames, copy=True):
+        return [CHUNK, zmq.Frame(b'0' * 16)]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def loop(plug):
+    loop = ioloop.IOLoop()
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+    plug.router.loop = loop
+    yield loop
+    loop.add_callback(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def worker(plug, create):
+    plug.dealer = Dealer(plug)
+    metadata = create(u'file', uptodate=False, size=64)
+
+    worker = TransferWorker(plug.dealer, metadata.fid)
+    assert worker.load()
+    plug.dealer.in_progress[metadata.fid] = (worker, None)
+
+    yield worker
+    worker.context.destroy()
+    plug.dealer.pool.terminate()
+
+
+def transfer(worker):
+    """Run the transfer in a thread, and return an event set if the
+    transfer has been aborted.
+    """
+    aborted = threading.Event()
+
+    def run():
+        try:
+            worker.start_transfer()
+            worker.get_file_multipart(Channel())
+        except AbortOperation:
+            aborted.set()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, aborted
+
+
+def test_abort_coroutine_handler(plug, loop):
+    @plug.handler()
+    @gen.coroutine
+    def upload_chunk(metadata, offset, chunk):
+        # Never finishes
+        yield Future()
+
+    stop = threading.Event()
+    threading.Timer(0.1, stop.set).start()
+
+    with pytest.raises(AbortOperation):
+        plug.call_abortable(stop, 'upload_chunk', None, 0, b'')
+
+
+def test_update_during_transfer(plug, worker, escalator):
+    uploading = threading.Event()
+    updated = threading.Event()
+
+    @plug.handler()
+    def upload_chunk(metadata, offset, chunk):
+        if offset == 16:
+            uploading.set()
+            updated.wait()
+
+    thread, aborted = transfer(worker)
+    uploading.wait()
+
+    # The file is updated while the second chunk is written
+    metadata = Metadata.get_by_id(plug, worker.fid)
+    metadata.size = 32
+    plug.update_file(metadata)
+    updated.set()
+    thread.join()
+
+    assert aborted.is_set()
+    # The progress of the aborted transfer is not written again
+    assert not escalator.exists(worker.transfer_key)
+
+
+def test_update_during_coroutine(plug, loop, worker, escalator):
+    uploading = threading.Event()
+
+    @plug.handler()
+    @gen.coroutine
+    def upload_chunk(metadata, offset, chunk):
+        if offset == 16:
+            uploading.set()
+            yield Future()
+
+    thread, aborted = transfer(worker)
+    uploading.wait()
+
+    plug.update_file(Metadata.get_by_id(plug, worker.fid))
+    thread.join()
+
+    assert aborted.is_set()
+    assert not escalator.exists(worker.transfer_key)